@@ -0,0 +1,15 @@
+""" Benchmarks for pyTivo's hot paths
+
+    Builds synthetic shares (see shares), with a stand-in for FFmpeg,
+    and times the plugins' entry points and the code under them --
+    folder listings, item_count(), metadata, probes, QueryContainer
+    rendering, LRUCache -- through a fake handler, so it all runs
+    offline, with no TiVo. Results can be saved as a baseline, and
+    later runs compared with it:
+
+        python -m benchmark --save baseline.json
+        python -m benchmark --baseline baseline.json
+
+    See run.py for the options.
+
+"""
@@ -0,0 +1,52 @@
+""" A stand-in for TivoHTTPHandler
+
+    Enough of the handler for the plugins' QueryContainer, QueryItem
+    and TVBusQuery: it has the headers, share and server they look at,
+    and keeps whatever they send in memory, instead of writing to a
+    socket.
+
+"""
+
+import logging
+
+class Headers(dict):
+    def getheader(self, name, default=None):
+        return self.get(name.lower(), default)
+
+class Server(object):
+    logger = logging.getLogger('pyTivo.benchmark')
+    streamloop = None
+
+class FakeHandler(object):
+    pooled = False
+    deferred = None
+
+    def __init__(self, cname, container, tsn=''):
+        self.cname = cname
+        self.container = container
+        self.headers = Headers()
+        if tsn:
+            self.headers['tsn'] = tsn
+        self.server = Server()
+        self.client_address = ('127.0.0.1', 0)
+        self.path = '/TiVoConnect'
+        self.command = 'GET'
+        self.code = None
+        self.body = ''
+
+    def send_fixed(self, page, mime, code=200, refresh=''):
+        self.code = code
+        self.body = page
+
+    def send_xml(self, page):
+        self.send_fixed(page, 'text/xml')
+
+    def send_html(self, page, code=200, refresh=''):
+        self.send_fixed(page, 'text/html; charset=utf-8', code)
+
+    def send_saved(self, response):
+        self.send_fixed(response.page, response.mime)
+
+    def send_error(self, code, message=None):
+        self.code = code
+        self.body = ''
@@ -0,0 +1,434 @@
+""" Simulate TiVos, to see how many one pyTivo can keep up with
+
+    python -m benchmark.load [options] [http://host:port]
+
+        -c, --clients N       simulated TiVos (default 4)
+        -d, --duration SECS   how long to run (30)
+        -r, --rate N          actions a second, per TiVo (1)
+        -m, --mix SPEC        weights of the actions, as in the default,
+                              browse=6,recurse=1,tvbus=2,stream=1,photo=1
+        -p, --page N          items asked for at a time (8)
+        -s, --stream-mb N     megabytes pulled per stream, half of them
+                              after a Range resume (8)
+        -B, --bitrate MBPS    pace each stream at this rate, as a TiVo
+                              playing it would (0, as fast as it comes)
+        -n, --files N         with no server given, files in each share
+                              of the local one (500)
+        -o, --option KEY=VAL  a [Server] setting for the local server;
+                              may be repeated
+
+    Each TiVo browses the server's shares much as a real one does: a
+    QueryContainer for the shares, then pages of ItemCount items, each
+    anchored (AnchorItem) on the last item of the page before, opening
+    folders as it finds them. It also asks for recursive listings,
+    TVBusQuery details, photos at a given Width and Height, and pulls
+    videos, breaking off half way and resuming with a Range header.
+
+    With no server given, one is started (pyTivo.py, in its own
+    process) on synthetic video, music and photo shares, with a
+    stand-in for FFmpeg. At the end, each action's latency percentiles
+    and throughput are reported.
+
+"""
+
+import getopt
+import httplib
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib
+import urlparse
+from xml.etree import cElementTree as ElementTree
+
+from benchmark import shares
+
+MIX = 'browse=6,recurse=1,tvbus=2,stream=1,photo=1'
+TIMEOUT = 60
+BLOCKSIZE = 64 * 1024
+
+def tag(element):
+    """ An element's tag, without the namespace. """
+    return element.tag.split('}')[-1]
+
+def child_text(element, name):
+    for child in element:
+        if tag(child) == name:
+            return child.text or ''
+    return ''
+
+def parse_items(page):
+    """ The Items in a QueryContainer response, as (content type,
+        {link name: Url}) pairs.
+    """
+    items = []
+    for element in ElementTree.fromstring(page).getiterator():
+        if tag(element) != 'Item':
+            continue
+        content_type = ''
+        links = {}
+        for part in element:
+            if tag(part) == 'Details':
+                content_type = child_text(part, 'ContentType')
+            elif tag(part) == 'Links':
+                for link in part:
+                    links[tag(link)] = child_text(link, 'Url')
+        items.append((content_type, links))
+    return items
+
+class Stats(object):
+    """ What happened, by action. """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}     # action -> [seconds]
+        self.errors = {}        # action -> count
+        self.bytes = {}         # action -> bytes received
+
+    def record(self, action, latency, size=0):
+        self.lock.acquire()
+        self.latencies.setdefault(action, []).append(latency)
+        self.bytes[action] = self.bytes.get(action, 0) + size
+        self.lock.release()
+
+    def error(self, action):
+        self.lock.acquire()
+        self.errors[action] = self.errors.get(action, 0) + 1
+        self.lock.release()
+
+    def report(self, elapsed):
+        def percentile(values, p):
+            return values[min(len(values) - 1, int(len(values) * p))]
+
+        print ('%-10s %7s %6s %7s %8s %8s %8s %8s %8s' %
+               ('action', 'count', 'errors', 'per sec', 'p50 ms', 'p90 ms',
+                'p99 ms', 'max ms', 'MB/s'))
+        actions = sorted(set(self.latencies) | set(self.errors))
+        total = 0
+        for action in actions:
+            values = sorted(self.latencies.get(action, []))
+            total += len(values)
+            if values:
+                times = ['%8.1f' % (percentile(values, p) * 1000)
+                         for p in (0.5, 0.9, 0.99)]
+                times.append('%8.1f' % (values[-1] * 1000))
+            else:
+                times = ['%8s' % '-'] * 4
+            mb = self.bytes.get(action, 0) / 1048576.0 / elapsed
+            print '%-10s %7d %6d %7.2f %s %8s' % (action, len(values),
+                  self.errors.get(action, 0), len(values) / elapsed,
+                  ' '.join(times), mb and '%.2f' % mb or '-')
+        print '%d requests in %.1f seconds, %.1f per second' % (total,
+              elapsed, total / elapsed)
+
+class TiVo(threading.Thread):
+    """ One simulated TiVo. """
+    def __init__(self, number, host, port, options, stats, deadline):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.host = host
+        self.port = port
+        self.options = options
+        self.stats = stats
+        self.deadline = deadline
+        self.tsn = '65200019%07d' % number
+        self.rng = random.Random(number)
+        self.conn = None
+        self.shares = {}    # content type -> [share Urls]
+        self.folders = []   # Urls of folders seen
+        self.videos = []    # (content Url, mime, TVBus Url) of videos seen
+        self.photos = []    # Urls of photos seen
+        self.actions = []
+        for part in options['mix'].split(','):
+            name, weight = part.split('=')
+            self.actions += [name.strip()] * int(weight)
+
+    def request(self, url, headers=None):
+        """ GET url on the kept-alive connection; returns the body. """
+        if self.conn is None:
+            self.conn = httplib.HTTPConnection(self.host, self.port,
+                                               timeout=TIMEOUT)
+        all_headers = {'tsn': self.tsn}
+        if headers:
+            all_headers.update(headers)
+        try:
+            self.conn.request('GET', url, headers=all_headers)
+            response = self.conn.getresponse()
+            body = response.read()
+        except (httplib.HTTPException, socket.error):
+            self.conn.close()
+            self.conn = None
+            raise
+        if response.status >= 400:
+            raise httplib.HTTPException('%d for %s' % (response.status, url))
+        return body
+
+    def timed(self, action, url, headers=None):
+        start = time.time()
+        body = self.request(url, headers)
+        self.stats.record(action, time.time() - start, len(body))
+        return body
+
+    def query(self, action, url, **params):
+        for key, value in params.items():
+            url += '&%s=%s' % (key, urllib.quote(str(value), safe='/'))
+        items = parse_items(self.timed(action, url))
+        for content_type, links in items:
+            content = links.get('Content', '')
+            if 'folder' in content_type:
+                if content not in self.folders:
+                    self.folders.append(content)
+            elif content_type.startswith('video'):
+                self.videos.append((content, content_type,
+                                    links.get('TiVoVideoDetails')))
+            elif content_type.startswith('image'):
+                self.photos.append(content)
+        del self.videos[:-200]
+        del self.photos[:-200]
+        del self.folders[:-200]
+        return items
+
+    def discover(self):
+        for content_type, links in self.query('root',
+                '/TiVoConnect?Command=QueryContainer&Container=/'):
+            self.shares.setdefault(content_type, []).append(links['Content'])
+
+    def browse(self, urls=None):
+        """ Open a share or folder, and page through some of it. """
+        if urls is None:
+            urls = sum(self.shares.values(), []) + self.folders
+        if not urls:
+            return
+        url = self.rng.choice(urls)
+        page = self.options['page']
+        items = self.query('browse', url, ItemCount=page)
+        for i in xrange(self.rng.randint(0, 3)):
+            if len(items) < page:
+                break
+            anchor = items[-1][1].get('Content', '')
+            items = self.query('browse', url, ItemCount=page,
+                               AnchorItem=anchor, AnchorOffset=0)
+
+    def recurse(self):
+        urls = self.shares.get('x-container/tivo-videos', [])
+        if urls:
+            self.query('recurse', self.rng.choice(urls),
+                       ItemCount=self.options['page'], Recurse='Yes',
+                       SortOrder='!CaptureDate')
+
+    def known(self, items, share_type):
+        """ Browse a share of share_type, if nothing's been found yet. """
+        if not items:
+            self.browse(self.shares.get(share_type))
+        return items
+
+    def tvbus(self):
+        videos = [v for v in self.known(self.videos,
+                                        'x-container/tivo-videos') if v[2]]
+        if videos:
+            self.timed('tvbus', self.rng.choice(videos)[2])
+
+    def photo(self):
+        if self.known(self.photos, 'x-container/tivo-photos'):
+            self.timed('photo', self.rng.choice(self.photos) +
+                       '?Width=640&Height=480&PixelShape=1:1&Rotation=0')
+
+    def pull(self, action, url, offset, size):
+        """ Read size bytes of url from offset, on a connection of its
+            own; returns the number of bytes read.
+        """
+        conn = httplib.HTTPConnection(self.host, self.port, timeout=TIMEOUT)
+        headers = {'tsn': self.tsn}
+        if offset:
+            headers['Range'] = 'bytes=%d-' % offset
+        start = time.time()
+        try:
+            conn.request('GET', url, headers=headers)
+            response = conn.getresponse()
+            if response.status >= 400:
+                raise httplib.HTTPException('%d for %s' %
+                                            (response.status, url))
+            bitrate = self.options['bitrate'] * 1000000 / 8.0
+            count = 0
+            first = None
+            while count < size:
+                block = response.read(min(BLOCKSIZE, size - count))
+                if not block:
+                    break
+                if first is None:
+                    first = time.time() - start
+                count += len(block)
+                if bitrate:
+                    ahead = start + count / bitrate - time.time()
+                    if ahead > 0:
+                        time.sleep(ahead)
+        finally:
+            conn.close()
+        self.stats.record(action, first or time.time() - start, count)
+        return count
+
+    def stream(self):
+        """ Pull a video, break off half way, and resume. """
+        if not self.known(self.videos, 'x-container/tivo-videos'):
+            return
+        url, mime, details = self.rng.choice(self.videos)
+        url += '?Format=' + urllib.quote(mime)
+        half = self.options['stream_bytes'] / 2
+        got = self.pull('stream', url, 0, half)
+        if got == half and not self.pull('resume', url, got, half):
+            self.stats.error('resume')
+
+    def run(self):
+        interval = 1.0 / self.options['rate']
+        next_time = time.time() + self.rng.random() * interval
+        try:
+            self.discover()
+        except Exception:
+            self.stats.error('root')
+            return
+        while True:
+            now = time.time()
+            if now >= self.deadline:
+                break
+            if next_time > now:
+                time.sleep(min(next_time - now, self.deadline - now))
+                continue
+            next_time += self.rng.expovariate(1.0) * interval
+            action = self.rng.choice(self.actions)
+            try:
+                getattr(self, action)()
+            except Exception:
+                self.stats.error(action)
+
+def start_local(root, files, stream_bytes, options):
+    """ Build shares under root, and start pyTivo on them; returns the
+        process and its port.
+    """
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+
+    paths = {}
+    for name, exts, size in (('Videos', shares.VIDEO_EXTS, 64 * 1048576),
+                             ('Music', shares.MUSIC_EXTS, 0),
+                             ('Photos', ('.jpg',), 1048576)):
+        paths[name] = os.path.join(root, name)
+        shares.make_share(paths[name], files, exts=exts, size=size,
+                          text_sidecars=name == 'Videos' and 0.5 or 0,
+                          nfo_sidecars=name == 'Videos' and 0.2 or 0)
+    ffmpeg = shares.write_ffmpeg(root, stream_bytes)
+
+    server = {'port': port, 'ffmpeg': ffmpeg, 'zeroconf': 'False',
+              'beacon': '127.0.0.1', 'index_workers': '0'}
+    server.update(options)
+    conf = os.path.join(root, 'pyTivo.conf')
+    f = open(conf, 'w')
+    f.write('[Server]\n')
+    for item in server.items():
+        f.write('%s=%s\n' % item)
+    for name, ptype in (('Videos', 'video'), ('Music', 'music'),
+                        ('Photos', 'photo')):
+        f.write('\n[%s]\ntype=%s\npath=%s\n' % (name, ptype, paths[name]))
+    f.close()
+
+    script = os.path.join(os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))), 'pyTivo.py')
+    log = open(os.path.join(root, 'pyTivo.log'), 'w')
+    process = subprocess.Popen([sys.executable, script, '-c', conf],
+                               stdout=log, stderr=subprocess.STDOUT)
+    for i in xrange(100):
+        try:
+            conn = httplib.HTTPConnection('127.0.0.1', port, timeout=1)
+            conn.request('GET', '/TiVoConnect?Command=QueryServer')
+            conn.getresponse().read()
+            conn.close()
+            return process, port
+        except (httplib.HTTPException, socket.error):
+            if process.poll() is not None:
+                break
+            time.sleep(0.2)
+    if process.poll() is None:
+        process.kill()
+        process.wait()
+    log.close()
+    # The log goes with root, so show the end of it here
+    f = open(log.name)
+    tail = f.read()[-2000:]
+    f.close()
+    raise RuntimeError('pyTivo did not start:\n%s' % tail)
+
+def main(argv):
+    try:
+        opts, args = getopt.getopt(argv, 'c:d:r:m:p:s:B:n:o:h',
+            ['clients=', 'duration=', 'rate=', 'mix=', 'page=',
+             'stream-mb=', 'bitrate=', 'files=', 'option=', 'help'])
+    except getopt.GetoptError, msg:
+        print msg
+        print __doc__
+        return 2
+
+    clients, duration, files = 4, 30.0, 500
+    options = {'rate': 1.0, 'mix': MIX, 'page': 8,
+               'stream_bytes': 8 * 1048576, 'bitrate': 0.0}
+    server_options = {}
+    for opt, value in opts:
+        if opt in ('-c', '--clients'):
+            clients = int(value)
+        elif opt in ('-d', '--duration'):
+            duration = float(value)
+        elif opt in ('-r', '--rate'):
+            options['rate'] = float(value)
+        elif opt in ('-m', '--mix'):
+            options['mix'] = value
+        elif opt in ('-p', '--page'):
+            options['page'] = int(value)
+        elif opt in ('-s', '--stream-mb'):
+            options['stream_bytes'] = int(float(value) * 1048576)
+        elif opt in ('-B', '--bitrate'):
+            options['bitrate'] = float(value)
+        elif opt in ('-n', '--files'):
+            files = int(value)
+        elif opt in ('-o', '--option'):
+            key, value = value.split('=', 1)
+            server_options[key.strip()] = value.strip()
+        else:
+            print __doc__
+            return 0
+
+    process = root = None
+    try:
+        if args:
+            url = urlparse.urlparse(args[0])
+            host, port = url.hostname, url.port or 9032
+        else:
+            root = tempfile.mkdtemp(prefix='pytivo-load-')
+            print 'Starting pyTivo on synthetic shares in %s' % root
+            process, port = start_local(root, files,
+                                        options['stream_bytes'],
+                                        server_options)
+            host = '127.0.0.1'
+
+        stats = Stats()
+        start = time.time()
+        tivos = [TiVo(i, host, port, options, stats, start + duration)
+                 for i in xrange(clients)]
+        for tivo in tivos:
+            tivo.start()
+        for tivo in tivos:
+            tivo.join(duration + TIMEOUT)
+        stats.report(time.time() - start)
+    finally:
+        if process:
+            process.kill()
+            process.wait()
+        if root:
+            shutil.rmtree(root, ignore_errors=True)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
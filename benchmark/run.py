@@ -0,0 +1,451 @@
+""" Run the benchmarks
+
+    python -m benchmark [options] [name-prefix ...]
+
+        -n, --files N        files in each synthetic share (default 1000)
+        -d, --depth N        levels of folders (default 2)
+        -t, --time SECONDS   least time to spend timing each one (0.5)
+        -k, --keep DIR       build the shares in DIR, and keep them
+        -s, --save FILE      save the results, as a baseline
+        -b, --baseline FILE  compare the results with a saved baseline
+        -T, --tolerance PCT  how much slower counts as a regression (20)
+
+    Only the benchmarks whose names start with one of the given
+    prefixes are run, if any are given. The exit status is 1 if any
+    benchmark ran slower than the baseline allows.
+
+    Beside each rate is how much the process grew while the benchmark
+    ran (its resident size after, less before; Linux only), which shows
+    the memory a cache or a leak holds on to.
+
+    benchmark/baseline.json is a reference baseline, made with the
+    default options by
+
+        python -m benchmark --save benchmark/baseline.json
+
+    Rates depend on the machine, so before changing anything, save a
+    baseline of your own the same way, and compare with that. Update
+    the committed one, on the same machine as before if you can, when a
+    change is meant to move the numbers.
+
+"""
+
+import gc
+import getopt
+import hashlib
+import json
+import logging
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import time
+
+import config
+from benchmark import shares
+from benchmark.handler import FakeHandler
+
+REPEAT = 3      # timings of each benchmark; the best one counts
+PAGE = 50       # ItemCount, as a TiVo asks
+ITEMS = 50000   # entries in the listing the item_count benchmarks page
+
+class Context(object):
+    """ The shares, plugins and handlers the benchmarks work on. """
+    def __init__(self, root, files, depth):
+        import lrucache
+        import metadata
+        import respcache
+        import walker
+        from plugin import GetPlugin
+        from plugins.video import transcode
+
+        self.lrucache = lrucache
+        self.metadata = metadata
+        self.respcache = respcache
+        self.walker = walker
+        self.transcode = transcode
+
+        self.video_path = os.path.join(root, 'Videos')
+        self.music_path = os.path.join(root, 'Music')
+        self.video = GetPlugin('video')
+        self.music = GetPlugin('music')
+        shares_ = dict(config.getShares())
+        self.video_handler = FakeHandler('Videos', shares_['Videos'],
+                                         tsn='6520001900000000')
+        self.music_handler = FakeHandler('Music', shares_['Music'])
+
+        entries = walker.scan(self.video_path, True, None, False)
+        self.video_files = sorted(e.name for e in entries
+                                  if not e.isdir and
+                                  os.path.splitext(e.name)[1] in
+                                  shares.VIDEO_EXTS)
+        self.position = 0
+
+    def next_file(self):
+        """ The video files in turn, round and round. """
+        f = self.video_files[self.position % len(self.video_files)]
+        self.position += 1
+        return f
+
+    def clear_listings(self):
+        for plugin in (self.video, self.music):
+            for cache in (plugin.dir_cache, plugin.recurse_cache):
+                for key in cache:
+                    try:
+                        del cache[key]
+                    except KeyError:
+                        pass
+
+    def query(self, container='Videos', **extra):
+        query = {'Container': [container], 'ItemCount': [str(PAGE)],
+                 'SortOrder': ['Normal']}
+        for key, value in extra.items():
+            query[key] = [value]
+        return query
+
+# Each benchmark is a function of the Context, returning the operation
+# to time -- a function of no arguments.
+
+def lrucache_hit(ctx):
+    cache = ctx.lrucache.LRUCache(10000)
+    for i in xrange(10000):
+        cache[i] = i
+    keys = iter(xrange(sys.maxint))
+    def op():
+        cache[(keys.next() * 7919) % 10000]
+    return op
+
+def lrucache_miss(ctx):
+    cache = ctx.lrucache.LRUCache(10000)
+    keys = iter(xrange(sys.maxint))
+    def op():
+        cache[keys.next()] = None
+    return op
+
+def walker_scan(ctx):
+    def op():
+        ctx.walker.scan(ctx.video_path, True)
+    return op
+
+def get_files_cold(ctx):
+    query = ctx.query(Recurse='Yes')
+    def op():
+        ctx.clear_listings()
+        ctx.video.get_files(ctx.video_handler, query)
+    return op
+
+def get_files_warm(ctx):
+    query = ctx.query(Recurse='Yes', SortOrder='!CaptureDate')
+    ctx.video.get_files(ctx.video_handler, query)
+    def op():
+        ctx.video.get_files(ctx.video_handler, query)
+    return op
+
+def item_entries(ctx):
+    """ ITEMS entries, in name order, in folders of 500 under the video
+        share -- made up, not on disk, so the size doesn't depend on
+        --files. Returns them with a query anchored 3/4 of the way in.
+    """
+    entries = [ctx.walker.Entry(os.path.join(ctx.video_path,
+                                             'folder%03d' % (i / 500),
+                                             'video%05d.mpg' % i),
+                                False, 1000000L, 1e9, 1e9)
+               for i in xrange(ITEMS)]
+    anchor = entries[ITEMS * 3 / 4].name
+    query = ctx.query(AnchorItem=anchor.replace(ctx.video_path, '/Videos'))
+    return entries, query
+
+def item_count_list(ctx):
+    # A plain list of objects, as listings were before listing.View:
+    # the anchor is found by listing every name, then list.index()
+    entries, query = item_entries(ctx)
+    def op():
+        ctx.video.item_count(ctx.video_handler, query, 'Videos', entries)
+    return op
+
+def item_count_view(ctx):
+    import listing
+    entries, query = item_entries(ctx)
+    view = listing.Listing(entries).sort('Normal', lambda x: x.name)
+    def op():
+        ctx.video.item_count(ctx.video_handler, query, 'Videos', view)
+    return op
+
+def metadata_basic(ctx):
+    def op():
+        ctx.metadata.basic(ctx.next_file())
+    return op
+
+def metadata_from_text(ctx):
+    def op():
+        ctx.metadata.from_text(ctx.next_file())
+    return op
+
+def video_info_probe(ctx):
+    def op():
+        ctx.transcode.video_info(ctx.next_file(), cache=False)
+    return op
+
+def video_query_cold(ctx):
+    query = ctx.query()
+    def op():
+        ctx.clear_listings()
+        ctx.respcache.clear()
+        ctx.video.QueryContainer(ctx.video_handler, query)
+    return op
+
+def video_query_render(ctx):
+    query = ctx.query(Recurse='Yes')
+    for f in ctx.video_files[:PAGE * 2]:
+        ctx.transcode.video_info(f)
+    def op():
+        ctx.respcache.clear()
+        ctx.video.QueryContainer(ctx.video_handler, query)
+    return op
+
+def video_query_saved(ctx):
+    query = ctx.query(Recurse='Yes')
+    ctx.video.QueryContainer(ctx.video_handler, query)
+    def op():
+        ctx.video.QueryContainer(ctx.video_handler, query)
+    return op
+
+def video_tvbus(ctx):
+    files = ctx.video_files[:PAGE]
+    for f in files:
+        ctx.transcode.video_info(f)
+    queries = [{'Container': ['Videos'],
+                'File': [f.replace(ctx.video_path, '', 1)]} for f in files]
+    state = {'n': 0}
+    def op():
+        ctx.video.TVBusQuery(ctx.video_handler,
+                             queries[state['n'] % len(queries)])
+        state['n'] += 1
+    return op
+
+def video_tvbus_render(ctx):
+    files = ctx.video_files[:PAGE]
+    for f in files:
+        ctx.transcode.video_info(f)
+    tsn = ctx.video_handler.headers['tsn']
+    state = {'n': 0}
+    def op():
+        ctx.video.render_details(tsn, files[state['n'] % len(files)])
+        state['n'] += 1
+    return op
+
+def turing_setkey(ctx):
+    import turing
+    keys = [hashlib.sha1(str(i)).digest() for i in xrange(4)]
+    state = {'n': 0}
+    def op():
+        turing.Turing(keys[state['n'] % 4], keys[0])
+        state['n'] += 1
+    return op
+
+def turing_stream(ctx):
+    import turing
+    cipher = turing.Turing(hashlib.sha1('key').digest(),
+                           hashlib.sha1('iv').digest())
+    block = '\0' * 65536
+    def op():
+        cipher.stream(block)
+    return op
+
+def tivodecoder_decode(ctx):
+    import StringIO
+    import tivodecoder
+    # 1 MB of scrambled video packets, 2K each, with a new block every
+    # fourth packet; the ciphertext is just zeroes
+    packets = []
+    for i in xrange(512):
+        private = '\x80\x00' + chr(i / 4 >> 2 & 0xff) + \
+                  chr((i / 4 & 3) << 6) + '\0' * 12
+        header = '\xb0\x81\x16' + '\0' * 5 + '\x80' + private
+        payload = '\0' * (2048 - 6 - len(header))
+        packets.append('\0\0\1\xe0' +
+                       struct.pack('>H', len(header) + len(payload)) +
+                       header + payload)
+    data = ''.join(packets)
+    key = hashlib.sha1('key').digest()[:16]
+    def op():
+        out = StringIO.StringIO()
+        tivodecoder.Decoder(key).decode(StringIO.StringIO(data), out)
+    return op
+
+def music_query(ctx):
+    query = ctx.query('Music', Recurse='Yes')
+    def op():
+        ctx.music.QueryContainer(ctx.music_handler, query)
+    return op
+
+BENCHMARKS = [
+    ('lrucache.hit', lrucache_hit),
+    ('lrucache.miss', lrucache_miss),
+    ('walker.scan', walker_scan),
+    ('get_files.cold', get_files_cold),
+    ('get_files.warm', get_files_warm),
+    ('item_count.list', item_count_list),
+    ('item_count.view', item_count_view),
+    ('metadata.basic', metadata_basic),
+    ('metadata.from_text', metadata_from_text),
+    ('video_info.probe', video_info_probe),
+    ('video.QueryContainer.cold', video_query_cold),
+    ('video.QueryContainer.render', video_query_render),
+    ('video.QueryContainer.saved', video_query_saved),
+    ('video.TVBusQuery', video_tvbus),
+    ('video.TVBusQuery.render', video_tvbus_render),
+    ('music.QueryContainer', music_query),
+    ('turing.setkey', turing_setkey),
+    ('turing.stream.64k', turing_stream),
+    ('tivodecoder.decode.1m', tivodecoder_decode),
+]
+
+def resident_memory():
+    """ The resident size of this process, in MB, or None if it can't
+        be read.
+    """
+    try:
+        f = open('/proc/self/statm')
+        pages = int(f.read().split()[1])
+        f.close()
+        return pages * os.sysconf('SC_PAGE_SIZE') / 1048576.0
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+def measure(op, least_time):
+    """ Return the best rate of op() in calls per second, over REPEAT
+        timings of at least least_time seconds each.
+    """
+    op()
+    count = 1
+    best = 0
+    for i in xrange(REPEAT):
+        while True:
+            start = time.time()
+            for j in xrange(count):
+                op()
+            elapsed = time.time() - start
+            if elapsed >= least_time:
+                break
+            count = max(count * 2, int(count * least_time * 1.2 /
+                                       max(elapsed, 1e-6)))
+        best = max(best, count / elapsed)
+    return best
+
+def setup(root, files, depth):
+    """ Build the shares and the config for them under root. """
+    video = os.path.join(root, 'Videos')
+    music = os.path.join(root, 'Music')
+    if not os.path.isdir(video):
+        shares.make_share(video, files, depth)
+        shares.make_share(music, files, depth, exts=shares.MUSIC_EXTS,
+                          text_sidecars=0, nfo_sidecars=0)
+    ffmpeg = shares.write_ffmpeg(root)
+    conf = os.path.join(root, 'pyTivo.conf')
+    f = open(conf, 'w')
+    f.write('[Server]\nffmpeg=%s\nindex_workers=0\n\n'
+            '[Videos]\ntype=video\npath=%s\n\n'
+            '[Music]\ntype=music\npath=%s\n' % (ffmpeg, video, music))
+    f.close()
+    config.init(['-c', conf])
+
+def compare(results, baseline, tolerance):
+    """ Print how results compare with baseline; return the number of
+        regressions.
+    """
+    slower = 0
+    print
+    print '%-30s %12s %12s %8s' % ('', 'baseline', 'now', 'change')
+    for name, result in results:
+        old = baseline.get(name)
+        if not old:
+            continue
+        change = result['ops'] / old['ops'] - 1
+        flag = ''
+        if change < -tolerance:
+            flag = '  SLOWER'
+            slower += 1
+        print '%-30s %12.1f %12.1f %+7.1f%%%s' % (name, old['ops'],
+              result['ops'], change * 100, flag)
+    return slower
+
+def main(argv):
+    try:
+        opts, prefixes = getopt.getopt(argv, 'n:d:t:k:s:b:T:h',
+            ['files=', 'depth=', 'time=', 'keep=', 'save=', 'baseline=',
+             'tolerance=', 'help'])
+    except getopt.GetoptError, msg:
+        print msg
+        print __doc__
+        return 2
+
+    files, depth, least_time = 1000, 2, 0.5
+    keep = save = baseline = None
+    tolerance = 0.2
+    for opt, value in opts:
+        if opt in ('-n', '--files'):
+            files = int(value)
+        elif opt in ('-d', '--depth'):
+            depth = int(value)
+        elif opt in ('-t', '--time'):
+            least_time = float(value)
+        elif opt in ('-k', '--keep'):
+            keep = value
+        elif opt in ('-s', '--save'):
+            save = value
+        elif opt in ('-b', '--baseline'):
+            baseline = value
+        elif opt in ('-T', '--tolerance'):
+            tolerance = float(value) / 100
+        else:
+            print __doc__
+            return 0
+
+    logging.basicConfig(level=logging.ERROR)
+    root = keep or tempfile.mkdtemp(prefix='pytivo-bench-')
+    try:
+        setup(root, files, depth)
+        ctx = Context(root, files, depth)
+        results = []
+        print '%-30s %12s %10s %10s' % ('', 'ops/sec', 'usec/op',
+                                        'grew MB')
+        for name, benchmark in BENCHMARKS:
+            if prefixes and not [p for p in prefixes if name.startswith(p)]:
+                continue
+            gc.collect()
+            before = resident_memory()
+            ops = measure(benchmark(ctx), least_time)
+            gc.collect()
+            after = resident_memory()
+            growth = None
+            if before is not None and after is not None:
+                growth = after - before
+            results.append((name, {'ops': ops, 'growth': growth}))
+            print '%-30s %12.1f %10.1f %10s' % (name, ops, 1e6 / ops,
+                  growth is not None and '%.1f' % growth or '-')
+    finally:
+        if not keep:
+            shutil.rmtree(root, ignore_errors=True)
+
+    status = 0
+    if baseline:
+        f = open(baseline)
+        saved = json.load(f)
+        f.close()
+        if saved.get('files') != files or saved.get('depth') != depth:
+            print ('\nThe baseline was made with %s files, %s deep' %
+                   (saved.get('files'), saved.get('depth')))
+        if compare(results, saved['results'], tolerance):
+            status = 1
+    if save:
+        f = open(save, 'w')
+        json.dump({'files': files, 'depth': depth,
+                   'python': sys.version.split()[0],
+                   'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+                   'results': dict(results)}, f, indent=1, sort_keys=True,
+                  separators=(',', ': '))
+        f.write('\n')
+        f.close()
+    return status
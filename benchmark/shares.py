@@ -0,0 +1,151 @@
+""" Synthetic shares for the benchmarks
+
+    make_share() builds a tree of small placeholder files -- the plugins
+    never read the media itself, only names, dates, sidecars and what
+    FFmpeg reports, except that mutagen and PIL read the start of each
+    MP3 and JPEG, so those begin with a real (silent or blank) frame --
+    and write_ffmpeg() a stand-in for FFmpeg that describes each file
+    the way ffmpeg -i would, without touching it.
+
+"""
+
+import os
+import random
+import stat
+import sys
+
+VIDEO_EXTS = ('.mpg', '.avi', '.mkv', '.mp4', '.ts')
+MUSIC_EXTS = ('.mp3',)
+
+# A silent MPEG-1 layer III frame (128 kb/s, 44.1 kHz), for mutagen
+MP3_FRAME = '\xff\xfb\x90\x64' + '\0' * 413
+
+# A 1x1 grey baseline JPEG, for PIL, which ignores anything after it
+JPEG = ('\xff\xd8' +
+        '\xff\xdb\x00\x43\x00' + '\x01' * 64 +          # quantization
+        '\xff\xc0\x00\x0b\x08\x00\x01\x00\x01\x01\x01\x11\x00' +  # frame
+        '\xff\xc4\x00\x14\x00\x01' + '\0' * 16 +         # DC: one code
+        '\xff\xc4\x00\x14\x10\x01' + '\0' * 16 +         # AC: just EOB
+        '\xff\xda\x00\x08\x01\x01\x00\x00\x3f\x00'       # scan
+        '\x3f\xff\xd9')
+
+TEXT_SIDECAR = """title : %(title)s
+seriesTitle : Series %(series)d
+episodeTitle : Episode %(n)d
+description : Synthetic file %(n)d, generated for benchmarking.
+vProgramGenre : Comedy
+vActor : Actor %(series)d
+originalAirDate : 2010-01-%(day)02dT00:00:00Z
+"""
+
+NFO_SIDECAR = """<?xml version="1.0" encoding="utf-8"?>
+<movie>
+  <title>%(title)s</title>
+  <plot>Synthetic movie %(n)d, generated for benchmarking.</plot>
+  <year>20%(day)02d</year>
+  <rating>7.5</rating>
+  <mpaa>PG</mpaa>
+  <genre>Drama</genre>
+</movie>
+"""
+
+# What the stand-in FFmpeg prints; .mpg files look TiVo-compatible, the
+# others need transcoding.
+FFMPEG = r'''#!%(python)s
+import os, sys
+args = sys.argv[1:]
+name = args[args.index('-i') + 1] if '-i' in args else ''
+if '-f' in args and args[-1] == '-':
+    if args[args.index('-f') + 1] == 'mjpeg':    # a photo
+        blocks = 1
+    else:
+        blocks = %(blocks)d
+    for i in xrange(blocks):
+        sys.stdout.write('\0' * 65536)
+    sys.exit(0)
+ext = os.path.splitext(name)[1].lower()
+if ext in ('.mpg', '.ts'):
+    video = ('mpeg2video (Main), yuv420p, 720x480 [SAR 8:9 DAR 4:3], '
+             '6000 kb/s, 29.97 fps, 29.97 tbr, 90k tbn')
+    audio = 'ac3, 48000 Hz, stereo, fltp, 192 kb/s'
+    fmt = 'mpeg'
+else:
+    video = ('h264 (High), yuv420p, 1280x720 [SAR 1:1 DAR 16:9], '
+             '3000 kb/s, 23.98 fps, 23.98 tbr, 1k tbn')
+    audio = 'aac (LC), 48000 Hz, stereo, fltp, 128 kb/s'
+    fmt = 'matroska,webm'
+minutes = 20 + len(name) %% 40
+sys.stderr.write("""Input #0, %%s, from '%%s':
+  Duration: 00:%%02d:00.00, start: 0.000000, bitrate: 6192 kb/s
+    Stream #0:0: Video: %%s
+    Stream #0:1(eng): Audio: %%s
+At least one output file must be specified
+""" %% (fmt, name, minutes, video, audio))
+sys.exit(1)
+'''
+
+def write_ffmpeg(directory, output=65536):
+    """ Write the stand-in FFmpeg into directory, and return its path.
+        Asked to transcode a video, it writes output bytes (rounded up
+        to 64K).
+    """
+    path = os.path.join(directory, 'ffmpeg')
+    f = open(path, 'w')
+    f.write(FFMPEG % {'python': sys.executable,
+                      'blocks': max(1, (output + 65535) / 65536)})
+    f.close()
+    os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP |
+                   stat.S_IXOTH)
+    return path
+
+def make_share(root, files=1000, depth=2, fanout=5, exts=VIDEO_EXTS,
+               text_sidecars=0.5, nfo_sidecars=0.2, size=64, seed=1):
+    """ Fill root with files placeholder files, spread over folders
+        depth levels deep, fanout to a folder. The given fractions of
+        the files get a .txt or .nfo sidecar. Files are up to size
+        bytes long, made sparse, so large ones take no space. The same
+        seed gives the same tree. Returns the number of files made.
+    """
+    rng = random.Random(seed)
+    folders = [root]
+    level = [root]
+    for d in xrange(depth):
+        next_level = []
+        for parent in level:
+            for i in xrange(fanout):
+                folder = os.path.join(parent, 'Folder %d-%d' % (d, i))
+                next_level.append(folder)
+        folders.extend(next_level)
+        level = next_level
+    for folder in folders:
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+
+    mtime = 1262304000   # 2010-01-01
+    for n in xrange(files):
+        folder = folders[n % len(folders)]
+        title = 'Show %d Part %d' % (rng.randint(1, 500), n)
+        name = os.path.join(folder, title + exts[n % len(exts)])
+        f = open(name, 'wb')
+        if name.endswith('.mp3'):
+            f.write(MP3_FRAME * rng.randint(4, 8))
+        elif name.endswith('.jpg'):
+            f.write(JPEG)
+            f.truncate(max(rng.randint(size / 2, size), len(JPEG)))
+        else:
+            f.truncate(rng.randint(size / 2, size))
+        f.close()
+        stamp = mtime + rng.randint(0, 3 * 365 * 86400)
+        os.utime(name, (stamp, stamp))
+
+        fields = {'title': title, 'n': n, 'series': n % 20,
+                  'day': n % 28 + 1}
+        if rng.random() < text_sidecars:
+            f = open(name + '.txt', 'w')
+            f.write(TEXT_SIDECAR % fields)
+            f.close()
+        if rng.random() < nfo_sidecars:
+            f = open(os.path.splitext(name)[0] + '.nfo', 'w')
+            f.write(NFO_SIDECAR % fields)
+            f.close()
+    return files
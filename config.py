@@ -9,6 +9,10 @@ import sys
 import uuid
 from ConfigParser import NoOptionError
 
+# Bumped by each reset(), so results that depend on the settings can
+# tell when they may be out of date
+generation = 0
+
 class Bdict(dict):
     def getboolean(self, x):
         return self.get(x, 'False').lower() in ('1', 'yes', 'true', 'on')
@@ -44,8 +48,10 @@ def reset():
     global config
     global configs_found
     global tivos_found
+    global generation
 
     bin_paths = {}
+    generation += 1
 
     config = ConfigParser.ConfigParser()
     configs_found = config.read(config_files)
@@ -240,6 +246,7 @@ def get_bin(fname):
             return fpath
 
     logger.warn('%s not found' % fname)
+    bin_paths[fname] = None
     return None
 
 def getFFmpegWait():
@@ -248,6 +255,110 @@ def getFFmpegWait():
     else:
         return 0
 
+def getTranscodeBuffer():
+    try:
+        return int(float(config.get('Server', 'transcode_buffer')) *
+                   1024 * 1024)
+    except:
+        return 32 * 1024 * 1024
+
+def getTranscodeCacheSize():
+    try:
+        return int(float(config.get('Server', 'transcode_cache_size')) *
+                   1024 * 1024 * 1024)
+    except:
+        return 10 * 1024 * 1024 * 1024
+
+def getWatchShares():
+    try:
+        return config.getboolean('Server', 'watch_shares')
+    except:
+        return False
+
+def getWatchInterval():
+    try:
+        return max(int(config.get('Server', 'watch_interval')), 1)
+    except:
+        return 60
+
+def getResponseCacheSize():
+    try:
+        return max(int(config.get('Server', 'response_cache')), 0)
+    except:
+        return 200
+
+def getMetadataCacheSize():
+    try:
+        return max(int(config.get('Server', 'metadata_cache')), 0)
+    except:
+        return 1000
+
+def getHTTPThreads():
+    try:
+        return max(int(config.get('Server', 'http_threads')), 0)
+    except:
+        return 0
+
+def getStreamThreads():
+    try:
+        return max(int(config.get('Server', 'stream_threads')), 1)
+    except:
+        return 8
+
+def getHTTPQueue():
+    try:
+        return max(int(config.get('Server', 'http_queue')), 1)
+    except:
+        return 32
+
+def getStreamLoop():
+    try:
+        return config.getboolean('Server', 'stream_loop')
+    except:
+        return False
+
+def getProfile():
+    try:
+        return config.getboolean('Server', 'profile')
+    except:
+        return False
+
+def getProfileDir():
+    return get_server('profile_dir', '')
+
+def getProfileClients():
+    return get_server('profile_clients', '127.0.0.1').split()
+
+def getIndexWorkers():
+    try:
+        return max(int(config.get('Server', 'index_workers')), 0)
+    except:
+        return 0
+
+def getIndexNice():
+    try:
+        return int(config.get('Server', 'index_nice'))
+    except:
+        return 10
+
+def getPreTranscodeTsn():
+    return get_server('pretranscode_tsn', '')
+
+def getPreTranscodeWorkers():
+    try:
+        return max(int(config.get('Server', 'pretranscode_workers')), 0)
+    except:
+        return 0
+
+def getPreTranscodeNice():
+    try:
+        return int(config.get('Server', 'pretranscode_nice'))
+    except:
+        return 10
+
+def getPreTranscodeWindow():
+    return get_server('pretranscode_window')
+
 def getFFmpegPrams(tsn):
     return get_tsn('ffmpeg_pram', tsn, True)
 
@@ -345,6 +456,15 @@ def getMaxAudioBR(tsn=None):
         return _trunc64(rate)
     return 448
 
+def get_tsn_class(tsn):
+    """ Something that's the same for any two TiVos that get the same
+        settings: the TiVo's own section, if it has one, or else its
+        kind.
+    """
+    if tsn and isTsnInConfig(tsn):
+        return tsn
+    return (get_section(tsn), is_ts_capable(tsn))
+
 def get_section(tsn):
     if is4Ktivo(tsn):
         return '_tivo_4K'
@@ -0,0 +1,152 @@
+""" Persistent key/value store for expensive per-file results
+
+    Values are pickled into an SQLite table, alongside a "stamp" that
+    the caller uses to decide whether the stored value is still valid
+    (e.g. the file's size and mtime). Writes are queued and committed
+    in batches by a background thread, so put() never waits on disk.
+
+"""
+
+import atexit
+import cPickle
+import logging
+import os
+import threading
+import time
+
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+import config
+
+logger = logging.getLogger('pyTivo.diskcache')
+
+FLUSH_DELAY = 2
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+class DiskCache(object):
+    def __init__(self, filename, table='cache'):
+        self.filename = filename
+        self.table = table
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.dirty = threading.Event()
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.text_factory = str
+        self.db.execute('CREATE TABLE IF NOT EXISTS %s (key TEXT PRIMARY KEY,'
+                        ' stamp TEXT, value BLOB)' % table)
+        self.db.commit()
+        self.writer = threading.Thread(target=self._write_behind)
+        self.writer.setDaemon(True)
+        self.writer.start()
+
+    def _row(self, key, columns):
+        self.lock.acquire()
+        try:
+            if key in self.pending:
+                return self.pending[key]
+            return self.db.execute('SELECT %s FROM %s WHERE key = ?' %
+                                   (columns, self.table), (key,)).fetchone()
+        except sqlite3.Error, msg:
+            logger.error('%s: %s' % (self.filename, msg))
+            return None
+        finally:
+            self.lock.release()
+
+    def has(self, key, stamp):
+        """Return True if a value with this stamp is stored for key."""
+        row = self._row(key, 'stamp')
+        return bool(row) and row[0] == repr(stamp)
+
+    def get(self, key, stamp):
+        """Return the value stored for key, or None if there is none or
+           it was stored with a different stamp.
+        """
+        row = self._row(key, 'stamp, value')
+        if not row or row[0] != repr(stamp):
+            return None
+        try:
+            return cPickle.loads(str(row[1]))
+        except Exception:
+            return None
+
+    def put(self, key, stamp, value):
+        """Queue value to be written under key. It's pickled now, so
+           the caller may go on to modify it.
+        """
+        row = (repr(stamp), cPickle.dumps(value, 2))
+        self.lock.acquire()
+        try:
+            self.pending[key] = row
+        finally:
+            self.lock.release()
+        self.dirty.set()
+
+    def __delitem__(self, key):
+        self.lock.acquire()
+        try:
+            self.pending.pop(key, None)
+            self.db.execute('DELETE FROM %s WHERE key = ?' % self.table,
+                            (key,))
+            self.db.commit()
+        finally:
+            self.lock.release()
+
+    def flush(self):
+        """Write out everything still queued."""
+        self.lock.acquire()
+        try:
+            rows = [(key, stamp, buffer(value))
+                    for key, (stamp, value) in self.pending.items()]
+            self.pending.clear()
+            if rows:
+                self.db.executemany('INSERT OR REPLACE INTO %s (key, stamp, '
+                                    'value) VALUES (?, ?, ?)' % self.table,
+                                    rows)
+                self.db.commit()
+        except sqlite3.Error, msg:
+            logger.error('%s: %s' % (self.filename, msg))
+        finally:
+            self.lock.release()
+
+    def _write_behind(self):
+        while True:
+            self.dirty.wait()
+            # Let a batch accumulate before writing
+            time.sleep(FLUSH_DELAY)
+            self.dirty.clear()
+            self.flush()
+
+def flush_all():
+    for cache in _caches.values():
+        if cache:
+            cache.flush()
+
+atexit.register(flush_all)
+
+def get_cache(name):
+    """Return the shared DiskCache called name, in the configured
+       cache_dir, or None if no cache_dir is set (or SQLite is
+       unavailable).
+    """
+    cache_dir = config.get_server('cache_dir')
+    if not cache_dir or not sqlite3:
+        return None
+    _caches_lock.acquire()
+    try:
+        if name not in _caches:
+            try:
+                if not os.path.isdir(cache_dir):
+                    os.makedirs(cache_dir)
+                filename = os.path.join(cache_dir, name + '.db')
+                _caches[name] = DiskCache(filename)
+            except Exception, msg:
+                logger.error('Unable to open cache %s: %s' % (name, msg))
+                _caches[name] = None
+        return _caches[name]
+    finally:
+        _caches_lock.release()
@@ -0,0 +1,317 @@
+""" Worker pools for the HTTP server
+
+    Instead of a new thread for every connection, requests are handled
+    by two fixed pools of threads: one for file transfers, which can
+    run for hours, and one for everything else (the TiVo's queries and
+    the web pages), so a burst of browsing can't hold up a stream, nor
+    a houseful of streams hold up browsing. Each pool takes its work
+    from a bounded queue; when that's full, the client gets a 503.
+
+    Between requests, kept-alive connections wait in a single thread
+    that watches them all, and goes back to a pool only when the next
+    request arrives -- or is closed after sitting idle for KEEPALIVE
+    seconds. Once in a pool, a client that stops sending its request,
+    or reading the response, for TIMEOUT seconds is disconnected, so it
+    can't hold a thread.
+
+"""
+
+import errno
+import logging
+import Queue
+import select
+import socket
+import threading
+import time
+
+logger = logging.getLogger('pyTivo.httppool')
+
+KEEPALIVE = 60   # seconds an idle connection is kept open
+TIMEOUT = 60     # seconds a request or response may stall
+PEEK_SIZE = 512
+BUSY = ('HTTP/1.1 503 Service Unavailable\r\nContent-Length: 0\r\n'
+        'Connection: close\r\n\r\n')
+DETACHED = 'detached'   # handle() result: the stream loop has it now
+
+def is_stream(data):
+    """ True if the start of a request (as peeked from the socket) is
+        for a file, rather than a query or a page.
+    """
+    try:
+        command, path = data.split(' ', 2)[:2]
+    except ValueError:
+        return False
+    return (command in ('GET', 'HEAD') and path not in ('/', '/metrics') and
+            not path.startswith('/TiVoConnect'))
+
+def socket_pair():
+    """ A connected pair of sockets, for waking up select(). """
+    try:
+        return socket.socketpair()
+    except (AttributeError, socket.error):
+        pass
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    a = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    a.connect(listener.getsockname())
+    b = listener.accept()[0]
+    listener.close()
+    return a, b
+
+class Connection(object):
+    """ A client connection, and the handler that reads its requests --
+        one handler for the life of the connection, so that anything it
+        has buffered isn't lost between requests.
+    """
+    def __init__(self, server, request, client_address):
+        cls = server.RequestHandlerClass
+        self.server = server
+        self.request = request
+        self.handler = cls.__new__(cls)
+        self.handler.request = request
+        self.handler.client_address = client_address
+        self.handler.server = server
+        self.handler.pooled = True
+        self.handler.setup()
+        self.idle_since = time.time()
+
+    def fileno(self):
+        return self.request.fileno()
+
+    def buffered(self):
+        """ True if the next request has already been read in. """
+        rbuf = getattr(self.handler.rfile, '_rbuf', None)
+        return bool(rbuf and rbuf.tell())
+
+    def handle(self):
+        """ Handle one request. Returns True if the connection stays
+            open for another, or DETACHED if the rest of the response
+            was passed to the stream loop, which will see to it.
+        """
+        handler = self.handler
+        handler.close_connection = 1
+        handler.deferred = None
+        try:
+            # Set each time, since the stream loop clears it
+            self.request.settimeout(TIMEOUT)
+            handler.handle_one_request()
+        except socket.timeout:
+            logger.info('Timed out: %s' % handler.client_address[0])
+            return False
+        except socket.error, msg:
+            if getattr(msg, 'errno', None) not in (errno.ECONNRESET,
+                                                   errno.EPIPE):
+                self.server.handle_error(self.request, handler.client_address)
+            return False
+        except Exception:
+            self.server.handle_error(self.request, handler.client_address)
+            return False
+        if handler.deferred:
+            source, callbacks = handler.deferred
+            handler.deferred = None
+            keep = not handler.close_connection
+            def sent(count, ok):
+                for callback in callbacks:
+                    callback(count)
+                self.server.dispatcher.finished(self, keep and ok)
+            self.server.streamloop.send(self.request, source, sent)
+            return DETACHED
+        return not handler.close_connection
+
+    def close(self):
+        try:
+            self.handler.finish()
+        except socket.error:
+            pass
+        self.server.shutdown_request(self.request)
+
+class Pool(object):
+    """ A fixed number of threads, working through a bounded queue of
+        Connections, each with a request waiting.
+    """
+    def __init__(self, name, threads, queue_size, done):
+        self.name = name
+        self.threads = threads
+        self.done = done
+        self.queue = Queue.Queue(queue_size)
+        self.lock = threading.Lock()
+        self.busy = 0
+        self.handled = 0
+        self.rejected = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def start(self):
+        for i in xrange(self.threads):
+            t = threading.Thread(target=self.work)
+            t.setDaemon(True)
+            t.start()
+
+    def stop(self):
+        for i in xrange(self.threads):
+            try:
+                self.queue.put_nowait(None)
+            except Queue.Full:
+                break    # they're daemon threads, anyway
+
+    def put(self, conn):
+        """ Queue conn; returns False if the queue is full. """
+        try:
+            self.queue.put_nowait((time.time(), conn))
+        except Queue.Full:
+            self.lock.acquire()
+            self.rejected += 1
+            self.lock.release()
+            return False
+        return True
+
+    def work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            queued, conn = item
+            wait = time.time() - queued
+            self.lock.acquire()
+            self.busy += 1
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+            self.lock.release()
+            try:
+                keep = conn.handle()
+            finally:
+                self.lock.acquire()
+                self.busy -= 1
+                self.handled += 1
+                self.lock.release()
+            if keep != DETACHED:
+                self.done(conn, keep)
+
+    def status_text(self):
+        text = '%s: %d of %d busy, %d queued, %d handled' % (self.name,
+               self.busy, self.threads, self.queue.qsize(), self.handled)
+        if self.handled:
+            text += (', wait %.1f ms average, %.1f ms most' %
+                     (self.wait_total * 1000 / self.handled,
+                      self.wait_max * 1000))
+        if self.rejected:
+            text += ', %d turned away' % self.rejected
+        return text
+
+class Dispatcher(object):
+    """ Watches new and kept-alive connections, and hands each to the
+        right pool when a request comes in.
+    """
+    def __init__(self, query_threads, stream_threads, queue_size):
+        self.queries = Pool('Queries', query_threads, queue_size,
+                            self.finished)
+        self.streams = Pool('Transfers', stream_threads, queue_size,
+                            self.finished)
+        self.idle = []
+        self.added = []
+        self.lock = threading.Lock()
+        self.stopped = False
+        self.wake_r, self.wake_w = socket_pair()
+
+    def start(self):
+        self.queries.start()
+        self.streams.start()
+        t = threading.Thread(target=self.run)
+        t.setDaemon(True)
+        t.start()
+
+    def stop(self):
+        self.stopped = True
+        self.wake()
+        self.queries.stop()
+        self.streams.stop()
+
+    def wake(self):
+        try:
+            self.wake_w.send('x')
+        except socket.error:
+            pass
+
+    def add(self, conn):
+        """ Wait for the next request on conn. """
+        conn.idle_since = time.time()
+        self.lock.acquire()
+        self.added.append(conn)
+        self.lock.release()
+        self.wake()
+
+    def finished(self, conn, keep):
+        if not keep or self.stopped:
+            conn.close()
+        elif conn.buffered():
+            self.dispatch(conn)
+        else:
+            self.add(conn)
+
+    def dispatch(self, conn):
+        """ Pass conn, which has a request waiting, to a pool. """
+        try:
+            if conn.buffered():
+                data = conn.handler.rfile._rbuf.getvalue()
+            else:
+                data = conn.request.recv(PEEK_SIZE, socket.MSG_PEEK)
+        except socket.error:
+            data = ''
+        if not data:    # closed by the client
+            conn.close()
+            return
+        if is_stream(data):
+            pool = self.streams
+        else:
+            pool = self.queries
+        if not pool.put(conn):
+            logger.warning('%s queue full; turning away %s' %
+                           (pool.name, conn.handler.client_address[0]))
+            try:
+                conn.request.sendall(BUSY)
+            except socket.error:
+                pass
+            conn.close()
+
+    def run(self):
+        while not self.stopped:
+            self.lock.acquire()
+            self.idle.extend(self.added)
+            self.added = []
+            self.lock.release()
+
+            try:
+                ready = select.select([self.wake_r] + self.idle, [], [],
+                                      KEEPALIVE / 4)[0]
+            except (select.error, socket.error):
+                # A connection closed under us; drop the dead ones
+                ready = []
+                for conn in self.idle[:]:
+                    try:
+                        select.select([conn], [], [], 0)
+                    except (select.error, socket.error):
+                        self.idle.remove(conn)
+
+            for conn in ready:
+                if conn is self.wake_r:
+                    conn.recv(PEEK_SIZE)
+                else:
+                    self.idle.remove(conn)
+                    self.dispatch(conn)
+
+            expired = time.time() - KEEPALIVE
+            for conn in self.idle[:]:
+                if conn.idle_since < expired:
+                    self.idle.remove(conn)
+                    conn.close()
+
+        for conn in self.idle + self.added:
+            conn.close()
+        self.wake_r.close()
+        self.wake_w.close()
+
+    def status_text(self):
+        return '<br>'.join([self.queries.status_text(),
+                            self.streams.status_text(),
+                            '%d idle connections' % len(self.idle)])
@@ -1,20 +1,24 @@
 import BaseHTTPServer
 import SocketServer
 import cgi
-import gzip
 import logging
 import mimetypes
 import os
-import shutil
 import socket
+import threading
 import time
-from cStringIO import StringIO
 from email.utils import formatdate
 from urllib import unquote_plus, quote
 from xml.sax.saxutils import escape
 
-from Cheetah.Template import Template
 import config
+import httppool
+import metrics
+import profiler
+import respcache
+import streamloop
+import tmplcache
+import zerocopy
 from plugin import GetPlugin, EncodeUnicode
 
 SCRIPTDIR = os.path.dirname(__file__)
@@ -48,15 +52,36 @@ BASE_HTML = """<!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 4.01//EN"
 RELOAD = '<p>The <a href="%s">page</a> will reload in %d seconds.</p>'
 UNSUP = '<h3>Unsupported Command</h3> <p>Query:</p> <ul>%s</ul>'
 
+# Commands timed separately on /metrics; any others are lumped together
+COMMANDS = ('QueryContainer', 'QueryItem', 'QueryFormats', 'QueryServer',
+            'TVBusQuery', 'FlushServer', 'ResetServer')
+
+metrics.histogram('pytivo_command_seconds', 'Time to answer a command.')
+metrics.histogram('pytivo_send_seconds', 'Time to send a file.', metrics.SLOW)
+metrics.counter('pytivo_bytes_sent_total', 'Bytes of files sent.')
+
+ROOT_CONTAINER_TEMPLATE = tmplcache.load(os.path.join(SCRIPTDIR, 'templates',
+                                                      'root_container.tmpl'))
+INFO_PAGE_TEMPLATE = tmplcache.load(os.path.join(SCRIPTDIR, 'templates',
+                                                 'info_page.tmpl'))
+
 class TivoHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
     def __init__(self, server_address, RequestHandlerClass):
         self.containers = {}
         self.stop = False
         self.restart = False
+        self.indexer = None
+        self.pretranscoder = None
+        self.dispatcher = None
+        self.streamloop = None
+        self.streams = 0
+        self.streams_lock = threading.Lock()
         self.logger = logging.getLogger('pyTivo')
         BaseHTTPServer.HTTPServer.__init__(self, server_address,
                                            RequestHandlerClass)
         self.daemon_threads = True
+        metrics.gauge('pytivo_active_streams', 'Files being sent.',
+                      lambda: self.streams)
 
     def add_container(self, name, settings):
         if name in self.containers or name == 'TiVoConnect':
@@ -68,9 +93,53 @@ class TivoHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
 
     def reset(self):
         self.containers.clear()
+        respcache.clear()
         for section, settings in config.getShares():
             self.add_container(section, settings)
 
+    def start_pools(self, query_threads, stream_threads, queue_size):
+        """ Handle requests with pools of threads, instead of a new
+            thread for each connection.
+        """
+        self.dispatcher = httppool.Dispatcher(query_threads, stream_threads,
+                                              queue_size)
+        self.dispatcher.start()
+        pools = (self.dispatcher.queries, self.dispatcher.streams)
+        metrics.gauge('pytivo_pool_busy_threads', 'Pool threads at work.',
+                      lambda: [({'pool': p.name}, p.busy) for p in pools])
+        metrics.gauge('pytivo_pool_queued', 'Requests waiting for a thread.',
+                      lambda: [({'pool': p.name}, p.queue.qsize())
+                               for p in pools])
+        self.logger.info('Handling requests with %d + %d threads' %
+                         (query_threads, stream_threads))
+
+    def start_stream_loop(self):
+        """ Send streams from an event loop, instead of from the pool
+            threads. Only used along with start_pools().
+        """
+        self.streamloop = streamloop.Loop()
+        self.streamloop.start()
+        metrics.gauge('pytivo_loop_streams', 'Files sent by the stream loop.',
+                      lambda: len(self.streamloop.transfers))
+
+    def stop_pools(self):
+        if self.dispatcher:
+            self.dispatcher.stop()
+        if self.streamloop:
+            self.streamloop.stop()
+
+    def process_request(self, request, client_address):
+        if not self.dispatcher:
+            SocketServer.ThreadingMixIn.process_request(self, request,
+                                                        client_address)
+            return
+        try:
+            conn = httppool.Connection(self, request, client_address)
+        except socket.error:
+            self.shutdown_request(request)
+            return
+        self.dispatcher.add(conn)
+
     def handle_error(self, request, client_address):
         self.logger.exception('Exception during request from %s' % 
                               (client_address,))
@@ -81,14 +150,28 @@ class TivoHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
     def set_service_status(self, status):
         self.in_service = status
 
-class TivoHTTPHandler(BaseHTTPServer.BaseHTTPRequestHandler):
-    def __init__(self, request, client_address, server):
-        self.wbufsize = 0x10000
-        self.server_version = 'pyTivo/1.0'
-        self.protocol_version = 'HTTP/1.1'
-        self.sys_version = ''
-        BaseHTTPServer.BaseHTTPRequestHandler.__init__(self, request,
-            client_address, server)
+    def set_indexer(self, indexer):
+        self.indexer = indexer
+
+    def stream_started(self):
+        self.streams_lock.acquire()
+        self.streams += 1
+        self.streams_lock.release()
+
+    def stream_finished(self):
+        self.streams_lock.acquire()
+        self.streams -= 1
+        self.streams_lock.release()
+
+class TivoHTTPHandler(BaseHTTPServer.BaseHTTPRequestHandler, object):
+    # A new-style class, with class attributes rather than an __init__(),
+    # so that httppool.Connection can make one without handling a request
+    wbufsize = 0x10000
+    server_version = 'pyTivo/1.0'
+    protocol_version = 'HTTP/1.1'
+    sys_version = ''
+    pooled = False      # set for handlers made by httppool.Connection
+    deferred = None     # (Source, callbacks) for the stream loop to send
 
     def address_string(self):
         host, port = self.client_address[:2]
@@ -104,9 +187,16 @@ class TivoHTTPHandler(BaseHTTPServer.BaseHTTPRequestHandler):
     def do_GET(self):
         tsn = self.headers.getheader('TiVo_TCD_ID',
                                      self.headers.getheader('tsn', ''))
-        if not self.authorize(tsn):
-            return
+        if self.authorize(tsn):
+            profiler.run(self, self.answer_get, tsn)
 
+    def do_POST(self):
+        tsn = self.headers.getheader('TiVo_TCD_ID',
+                                     self.headers.getheader('tsn', ''))
+        if self.authorize(tsn):
+            profiler.run(self, self.answer_post, tsn)
+
+    def answer_get(self, tsn):
         if tsn and (not config.tivos_found or tsn in config.tivos):
             attr = config.tivos.get(tsn, {})
             if 'address' not in attr:
@@ -124,6 +214,8 @@ class TivoHTTPHandler(BaseHTTPServer.BaseHTTPRequestHandler):
 
         if path == '/TiVoConnect':
             self.handle_query(query, tsn)
+        elif path == '/metrics':
+            self.send_fixed(metrics.render(), 'text/plain; version=0.0.4')
         else:
             ## Get File
             splitpath = [x for x in unquote_plus(path).split('/') if x]
@@ -133,11 +225,7 @@ class TivoHTTPHandler(BaseHTTPServer.BaseHTTPRequestHandler):
                 ## Not a file not a TiVo command
                 self.infopage()
 
-    def do_POST(self):
-        tsn = self.headers.getheader('TiVo_TCD_ID',
-                                     self.headers.getheader('tsn', ''))
-        if not self.authorize(tsn):
-            return
+    def answer_post(self, tsn):
         ctype, pdict = cgi.parse_header(self.headers.getheader('content-type'))
         if ctype == 'multipart/form-data':
             query = cgi.parse_multipart(self.rfile, pdict)
@@ -162,7 +250,17 @@ class TivoHTTPHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         return False
 
     def handle_query(self, query, tsn):
-        mname = False
+        command = query.get('Command', [''])[0]
+        if command not in COMMANDS:
+            command = 'other'
+        start = time.time()
+        try:
+            self.answer_query(query, tsn)
+        finally:
+            metrics.observe('pytivo_command_seconds', time.time() - start,
+                            command=command)
+
+    def answer_query(self, query, tsn):
         if 'Command' in query and len(query['Command']) >= 1:
 
             command = query['Command'][0]
@@ -229,12 +327,48 @@ class TivoHTTPHandler(BaseHTTPServer.BaseHTTPRequestHandler):
 
         # Send the body of the file
         try:
-            shutil.copyfileobj(handle, self.wfile)
+            self.send_file_data(handle)
         except:
             pass
         handle.close()
         self.wfile.flush()
 
+    def stream(self, source, done):
+        """ Send the rest of the response from source (a
+            streamloop.Source), then call done(count), with the number
+            of bytes of content sent. Where it can, this leaves the
+            sending to the stream loop, and returns at once -- so it
+            should be the last thing a request handler does.
+        """
+        ptype = self.container['type']
+        def sent(count):
+            metrics.add('pytivo_bytes_sent_total', count, type=ptype)
+            done(count)
+        if self.pooled and self.server.streamloop and source.pollable:
+            self.wfile.flush()
+            self.deferred = (source, [sent])
+            return
+        count = 0
+        try:
+            count = source.copy(self)
+            self.wfile.flush()
+        except Exception, msg:
+            self.server.logger.info(msg)
+            count = source.count
+        try:
+            source.close()
+        except Exception, msg:
+            self.server.logger.info(msg)
+        sent(count)
+
+    def send_file_data(self, handle, offset=0):
+        """ Send the open file handle, from offset to the end, straight
+            from the file to the socket where possible. Anything already
+            written to wfile goes first. Returns the number of bytes sent.
+        """
+        self.wfile.flush()
+        return zerocopy.copy(handle, self.connection, offset, self.wfile)
+
     def handle_file(self, query, splitpath):
         if '..' not in splitpath:    # Protect against path exploits
             ## Pass it off to a plugin?
@@ -245,7 +379,22 @@ class TivoHTTPHandler(BaseHTTPServer.BaseHTTPRequestHandler):
                     base = os.path.normpath(container['path'])
                     path = os.path.join(base, *splitpath[1:])
                     plugin = GetPlugin(container['type'])
-                    plugin.send_file(self, path, query)
+                    start = time.time()
+                    def finished(count=0):
+                        self.server.stream_finished()
+                        metrics.observe('pytivo_send_seconds',
+                                        time.time() - start,
+                                        type=container['type'])
+                    self.server.stream_started()
+                    stages = profiler.Stages('send')
+                    try:
+                        plugin.send_file(self, path, query)
+                    finally:
+                        stages.end()
+                        if self.deferred:
+                            self.deferred[1].append(finished)
+                        else:
+                            finished()
                     return
 
             ## Serve it from a "content" directory?
@@ -280,10 +429,7 @@ class TivoHTTPHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         squeeze = (len(page) > 256 and mime.startswith('text') and
             'gzip' in self.headers.getheader('Accept-Encoding', ''))
         if squeeze:
-            out = StringIO()
-            gzip.GzipFile(mode='wb', fileobj=out).write(page)
-            page = out.getvalue()
-            out.close()
+            page = respcache.squeeze(page)
         self.send_response(code)
         self.send_header('Content-Type', mime)
         self.send_header('Content-Length', len(page))
@@ -299,6 +445,34 @@ class TivoHTTPHandler(BaseHTTPServer.BaseHTTPRequestHandler):
     def send_xml(self, page):
         self.send_fixed(page, 'text/xml')
 
+    def send_saved(self, response):
+        """ Send a respcache.Response -- or if the client already has
+            it, just say so.
+        """
+        etag = self.headers.getheader('If-None-Match', '')
+        if response.etag in [e.strip() for e in etag.split(',')]:
+            self.send_response(304)
+            self.send_header('ETag', response.etag)
+            self.end_headers()
+            self.wfile.flush()
+            return
+        page = response.page
+        squeeze = (response.squeezed and
+            'gzip' in self.headers.getheader('Accept-Encoding', ''))
+        if squeeze:
+            page = response.squeezed
+        self.send_response(200)
+        self.send_header('Content-Type', response.mime)
+        self.send_header('Content-Length', len(page))
+        if squeeze:
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('ETag', response.etag)
+        self.send_header('Last-Modified', formatdate(response.mdate))
+        self.send_header('Expires', '0')
+        self.end_headers()
+        self.wfile.write(page)
+        self.wfile.flush()
+
     def send_html(self, page, code=200, refresh=''):
         self.send_fixed(page, 'text/html; charset=utf-8', code, refresh)
 
@@ -315,9 +489,7 @@ class TivoHTTPHandler(BaseHTTPServer.BaseHTTPRequestHandler):
                     tsncontainers.append((section, settings))
             except Exception, msg:
                 self.server.logger.error(section + ' - ' + str(msg))
-        t = Template(file=os.path.join(SCRIPTDIR, 'templates',
-                                       'root_container.tmpl'),
-                     filter=EncodeUnicode)
+        t = ROOT_CONTAINER_TEMPLATE(filter=EncodeUnicode)
         if self.server.beacon.bd:
             t.renamed = self.server.beacon.bd.renamed
         else:
@@ -329,9 +501,7 @@ class TivoHTTPHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         self.send_xml(str(t))
 
     def infopage(self):
-        t = Template(file=os.path.join(SCRIPTDIR, 'templates',
-                                       'info_page.tmpl'),
-                     filter=EncodeUnicode)
+        t = INFO_PAGE_TEMPLATE(filter=EncodeUnicode)
         t.admin = ''
 
         if config.get_server('tivo_mak') and config.get_server('togo_path'):
@@ -345,6 +515,24 @@ class TivoHTTPHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         else:
             t.shares = ''
 
+        if self.server.indexer:
+            t.indexer = '<br>%s<br>' % self.server.indexer.status_text()
+        else:
+            t.indexer = ''
+
+        if self.server.pretranscoder:
+            t.pretranscode = ('<br>%s<br>' %
+                              self.server.pretranscoder.status_text())
+        else:
+            t.pretranscode = ''
+
+        if self.server.dispatcher:
+            t.pools = '<br>%s<br>' % self.server.dispatcher.status_text()
+            if self.server.streamloop:
+                t.pools += '%s<br>' % self.server.streamloop.status_text()
+        else:
+            t.pools = ''
+
         for section, settings in config.getShares():
             plugin_type = settings.get('type')
             if plugin_type == 'settings':
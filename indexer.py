@@ -0,0 +1,166 @@
+""" Background library indexer
+
+    Walks each share, breadth first, and hands its files to a small
+    pool of worker threads that probe them ahead of demand (via the
+    share plugin's index_file()), so that the first browse of a folder
+    finds its details already cached. Helper processes are run at
+    reduced priority, and the workers wait while anything is streaming.
+
+"""
+
+import logging
+import os
+import Queue
+import threading
+import time
+from collections import deque
+
+import config
+import walker
+from plugin import GetPlugin, Plugin
+
+logger = logging.getLogger('pyTivo.indexer')
+
+QUEUE_SIZE = 1000
+STREAM_WAIT = 5       # seconds between checks while streams are active
+STATUS_INTERVAL = 60  # seconds between progress reports in the log
+
+class Indexer(object):
+    def __init__(self, server, workers=1, nice=10):
+        self.server = server
+        self.workers = workers
+        self.nice = nice
+        self.queue = Queue.Queue(QUEUE_SIZE)
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+        self.running = 0
+        self.indexed = 0
+        self.started = 0
+        self.finished = 0
+        self.paused = False
+        self.last_report = 0
+
+    def start(self):
+        self.started = self.last_report = time.time()
+        self.running = self.workers
+        threads = [threading.Thread(target=self.walk)]
+        for i in xrange(self.workers):
+            threads.append(threading.Thread(target=self.work))
+        for t in threads:
+            t.setDaemon(True)
+            t.start()
+        logger.info('Indexing shares with %d worker(s)' % self.workers)
+
+    def stop(self):
+        self.stopped.set()
+
+    def list_share(self, base):
+        """ Generate the paths of the files under base, shallowest
+            first -- those are the folders that get browsed first.
+        """
+        dirs = deque([base])
+        while dirs and not self.stopped.isSet():
+            path = dirs.popleft()
+            entries = walker.scan(path, need_stat=False)
+            entries.sort(key=lambda e: e.name)
+            for e in entries:
+                if e.isdir:
+                    dirs.append(e.name)
+                else:
+                    yield e.name
+
+    def walk(self):
+        for name, settings in config.getShares():
+            if self.stopped.isSet():
+                break
+            plugin = GetPlugin(settings.get('type', ''))
+            base = settings.get('path')
+            if not isinstance(plugin, Plugin) or not base:
+                continue
+            base = os.path.normpath(base)
+            limit = plugin.index_limit()
+            count = 0
+            for path in self.list_share(base):
+                if self.stopped.isSet():
+                    break
+                try:
+                    wanted = plugin.index_filter(path)
+                except Exception, msg:
+                    logger.debug('%s: %s' % (unicode(path, 'utf-8'), msg))
+                    continue
+                if wanted:
+                    self.queue.put((plugin, path, base))
+                    count += 1
+                    if limit and count >= limit:
+                        break
+
+        # One for each worker, to tell it that the walk is over
+        for i in xrange(self.workers):
+            self.queue.put(None)
+
+    def wait_for_streams(self):
+        while self.server.streams and not self.stopped.isSet():
+            if not self.paused:
+                self.paused = True
+                logger.info('Indexing paused while streaming')
+            self.stopped.wait(STREAM_WAIT)
+        if self.paused:
+            self.paused = False
+            logger.info('Indexing resumed')
+
+    def work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            self.wait_for_streams()
+            if self.stopped.isSet():
+                continue    # drain the queue, so the walker can finish
+            plugin, path, base = item
+            try:
+                plugin.index_file(path, base, self.nice)
+            except Exception, msg:
+                logger.debug('%s: %s' % (unicode(path, 'utf-8'), msg))
+
+            self.lock.acquire()
+            self.indexed += 1
+            report = time.time() - self.last_report >= STATUS_INTERVAL
+            if report:
+                self.last_report = time.time()
+            self.lock.release()
+            if report:
+                logger.info(self.status_text())
+
+        self.lock.acquire()
+        self.running -= 1
+        last = not self.running
+        if last:
+            self.finished = time.time()
+        self.lock.release()
+        if last and not self.stopped.isSet():
+            logger.info(self.status_text())
+
+    def status(self):
+        """ Progress so far: files indexed, the average rate, the
+            number of files waiting in the queue, and whether the
+            indexer is paused or finished.
+        """
+        elapsed = (self.finished or time.time()) - self.started
+        if elapsed > 0:
+            rate = self.indexed / elapsed
+        else:
+            rate = 0.0
+        return {'indexed': self.indexed, 'rate': rate,
+                'queued': self.queue.qsize(), 'paused': self.paused,
+                'finished': bool(self.finished)}
+
+    def status_text(self):
+        status = self.status()
+        text = 'Indexed %(indexed)d files, %(rate).1f files/sec' % status
+        if status['finished']:
+            text += ', finished'
+        else:
+            text += ', %(queued)d queued' % status
+            if status['paused']:
+                text += ', paused'
+        return text
@@ -0,0 +1,206 @@
+""" Compact folder listings
+
+    A Listing keeps the files from walker.scan() column-wise: each
+    folder name is stored once, the file names are packed into a single
+    string, and the flags, sizes and dates go into arrays -- a fraction
+    of the memory of one object per file. Each sort order is kept as a
+    permutation of indexes, computed once, and a View of a listing makes
+    entry objects only for the items that are actually requested.
+
+    Finding an item by name (for AnchorItem) takes two lookups: a
+    table from the hash of each name to its index in the listing, and
+    the inverse of the View's permutation, from index to position. Both
+    are built on first use, and kept with the listing.
+
+"""
+
+import itertools
+import os
+import random
+import threading
+from array import array
+
+from walker import Entry
+
+MAX_ORDERS = 8   # sort orders kept per listing (random ones add up)
+MISSING = 0xffffffff    # position of an item that's not in a View
+COLLISION = -1
+
+stamps = itertools.count(1)
+
+class Listing(object):
+    def __init__(self, entries, make_entry=Entry):
+        self.make_entry = make_entry
+        self.stamp = stamps.next()    # tells one listing from the next
+        self.folders = []
+        self.folder = array('I')     # index into folders, per file
+        self.offsets = array('I', [0])
+        self.isdir = array('B')
+        self.size = array('d')
+        self.mdate = array('d')
+        self.cdate = array('d')
+        self.has_stat = True
+        self.orders = {}
+        self.lock = threading.RLock()
+        self.hashes = None
+
+        folder_index = {}
+        names = []
+        length = 0
+        for e in entries:
+            folder, name = os.path.split(e.name)
+            i = folder_index.get(folder)
+            if i is None:
+                i = folder_index[folder] = len(self.folders)
+                self.folders.append(folder)
+            self.folder.append(i)
+            names.append(name)
+            length += len(name)
+            self.offsets.append(length)
+            self.isdir.append(e.isdir)
+            if e.mdate is None:
+                self.has_stat = False
+            else:
+                self.size.append(e.size)
+                self.mdate.append(e.mdate)
+                self.cdate.append(e.cdate)
+        self.names = ''.join(names)
+
+    def __len__(self):
+        return len(self.isdir)
+
+    def name(self, i):
+        return os.path.join(self.folders[self.folder[i]],
+                            self.names[self.offsets[i]:self.offsets[i + 1]])
+
+    def entry(self, i):
+        if self.has_stat:
+            return self.make_entry(self.name(i), bool(self.isdir[i]),
+                                   long(self.size[i]), self.mdate[i],
+                                   self.cdate[i])
+        return self.make_entry(self.name(i), bool(self.isdir[i]))
+
+    def find(self, name):
+        """ Index of the entry with this name, or None. """
+        self.lock.acquire()
+        try:
+            if self.hashes is None:
+                hashes = {}
+                for i in xrange(len(self)):
+                    h = hash(self.name(i))
+                    if h in hashes:
+                        hashes[h] = COLLISION
+                    else:
+                        hashes[h] = i
+                self.hashes = hashes
+        finally:
+            self.lock.release()
+
+        i = self.hashes.get(hash(name))
+        if i == COLLISION:
+            for i in xrange(len(self)):
+                if self.name(i) == name:
+                    return i
+        elif i is not None and self.name(i) == name:
+            return i
+        return None
+
+    def _order(self, sortby, build):
+        self.lock.acquire()
+        try:
+            view = self.orders.get(sortby)
+            if view is None:
+                view = View(self, build())
+                if len(self.orders) >= MAX_ORDERS:
+                    self.orders.clear()
+                self.orders[sortby] = view
+            return view
+        finally:
+            self.lock.release()
+
+    def sort(self, sortby, key, reverse=False):
+        """ Return a View sorted by key, a function of an entry, cached
+            under the name sortby.
+        """
+        def build():
+            keys = [key(self.entry(i)) for i in xrange(len(self))]
+            order = range(len(self))
+            order.sort(key=keys.__getitem__, reverse=reverse)
+            return array('I', order)
+        return self._order(sortby, build)
+
+    def shuffle(self, sortby, seed='', start='', lock=None):
+        """ Return a View in random order (repeatable, given a seed),
+            starting with the file named start, if it's there.
+        """
+        def build():
+            order = array('I', xrange(len(self)))
+            if lock:
+                lock.acquire()
+            try:
+                if seed:
+                    random.seed(seed)
+                random.shuffle(order)
+            finally:
+                if lock:
+                    lock.release()
+            if start:
+                i = self.find(start)
+                if i is not None:
+                    order.insert(0, order.pop(order.index(i)))
+            return order
+        return self._order(sortby, build)
+
+class View(object):
+    """ A listing in some order, and maybe filtered, that can be
+        indexed and sliced like a list of entries.
+    """
+    def __init__(self, listing, order):
+        self.listing = listing
+        self.order = order
+        self.positions = None
+        self.selections = {}
+
+    def __len__(self):
+        return len(self.order)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.listing.entry(i) for i in self.order[index]]
+        return self.listing.entry(self.order[index])
+
+    def __iter__(self):
+        for i in self.order:
+            yield self.listing.entry(i)
+
+    def index(self, name):
+        """ Position of the entry with this name, as in list.index(). """
+        listing = self.listing
+        i = listing.find(name)
+        if i is not None:
+            listing.lock.acquire()
+            try:
+                if self.positions is None:
+                    positions = array('I', [MISSING]) * len(listing)
+                    for pos, j in enumerate(self.order):
+                        positions[j] = pos
+                    self.positions = positions
+            finally:
+                listing.lock.release()
+            if self.positions[i] != MISSING:
+                return self.positions[i]
+        raise ValueError(name)
+
+    def select(self, isdir):
+        """ A View of just the folders, or just the files. """
+        listing = self.listing
+        listing.lock.acquire()
+        try:
+            view = self.selections.get(isdir)
+            if view is None:
+                view = View(listing, array('I', [i for i in self.order
+                                                 if listing.isdir[i] == isdir]))
+                self.selections[isdir] = view
+            return view
+        finally:
+            listing.lock.release()
@@ -39,16 +39,19 @@ discarded. [1]_
 """
 
 from __future__ import generators
+import threading
 import time
-from heapq import heappush, heappop, heapify
 
-__version__ = "0.2"
-__all__ = ['CacheKeyError', 'LRUCache', 'DEFAULT_SIZE']
+__version__ = "0.3"
+__all__ = ['CacheKeyError', 'LRUCache', 'DEFAULT_SIZE', 'caches']
 __docformat__ = 'reStructuredText en'
 
 DEFAULT_SIZE = 16
 """Default size of a new LRUCache object, if no 'size' argument is given."""
 
+caches = []
+"""Every LRUCache made with a name, for reporting their statistics."""
+
 class CacheKeyError(KeyError):
     """Error raised when cache requests fail
 
@@ -65,6 +68,15 @@ class LRUCache(object):
     a Python dictionary, with the exception that objects you put into the
     cache may be discarded before you take them out.
 
+    Records are kept in a dictionary and threaded on a doubly linked
+    list in access order, so lookups, insertions and deletions are all
+    constant-time. Every operation holds the cache's lock, and callers
+    may also acquire() and release() it around compound operations.
+
+    Each cache counts its hits (successful lookups), misses (records
+    added for a new key -- the usual sequel to a failed lookup) and
+    evictions. A cache given a name is listed in lrucache.caches.
+
     Some example usage::
 
     cache = LRUCache(32) # new cache
@@ -100,105 +112,179 @@ class LRUCache(object):
     class __Node(object):
         """Record of a cached value. Not for public consumption."""
 
+        __slots__ = ('prev', 'next', 'key', 'obj', 'atime', 'mtime')
+
         def __init__(self, key, obj, timestamp):
-            object.__init__(self)
+            self.prev = self.next = self
             self.key = key
             self.obj = obj
             self.atime = timestamp
             self.mtime = self.atime
 
-        def __cmp__(self, other):
-            return cmp(self.atime, other.atime)
-
         def __repr__(self):
             return "<%s %s => %s (%s)>" % \
                    (self.__class__, self.key, self.obj, \
                     time.asctime(time.localtime(self.atime)))
 
-    def __init__(self, size=DEFAULT_SIZE):
+    def __init__(self, size=DEFAULT_SIZE, name=None):
         # Check arguments
         if size <= 0:
             raise ValueError, size
         elif type(size) is not type(0):
             raise TypeError, size
         object.__init__(self)
-        self.__heap = []
+        self.__lock = threading.RLock()
+        # Sentinel of the circular list: root.next is the least, and
+        # root.prev the most recently used record.
+        self.__root = self.__Node(None, None, 0)
         self.__dict = {}
+        self.name = name
+        self.hits = self.misses = self.evictions = 0
         self.size = size
         """Maximum size of the cache.
         If more than 'size' elements are added to the cache,
         the least-recently-used ones will be discarded."""
+        if name:
+            caches.append(self)
+
+    def acquire(self, blocking=1):
+        return self.__lock.acquire(blocking)
+
+    def release(self):
+        self.__lock.release()
+
+    def __unlink(self, node):
+        node.prev.next = node.next
+        node.next.prev = node.prev
+
+    def __append(self, node):
+        root = self.__root
+        last = root.prev
+        last.next = root.prev = node
+        node.prev = last
+        node.next = root
+
+    def __shrink(self, size):
+        root = self.__root
+        while len(self.__dict) > size:
+            lru = root.next
+            self.__unlink(lru)
+            del self.__dict[lru.key]
+            self.evictions += 1
 
     def __len__(self):
-        return len(self.__heap)
+        return len(self.__dict)
 
     def __contains__(self, key):
-        return self.__dict.has_key(key)
+        return key in self.__dict
 
     def __setitem__(self, key, obj):
-        if self.__dict.has_key(key):
-            node = self.__dict[key]
-            node.obj = obj
-            node.atime = time.time()
-            node.mtime = node.atime
-            heapify(self.__heap)
-        else:
-            # size may have been reset, so we loop
-            overage = len(self.__heap) - self.size + 1
-            for i in xrange(overage):
-                lru = heappop(self.__heap)
-                del self.__dict[lru.key]
-            node = self.__Node(key, obj, time.time())
-            self.__dict[key] = node
-            heappush(self.__heap, node)
+        self.__lock.acquire()
+        try:
+            node = self.__dict.get(key)
+            if node is not None:
+                node.obj = obj
+                node.atime = time.time()
+                node.mtime = node.atime
+                self.__unlink(node)
+            else:
+                # size may have been reset, so we loop
+                self.__shrink(self.size - 1)
+                self.misses += 1
+                node = self.__Node(key, obj, time.time())
+                self.__dict[key] = node
+            self.__append(node)
+        finally:
+            self.__lock.release()
 
     def __getitem__(self, key):
-        if not self.__dict.has_key(key):
-            raise CacheKeyError(key)
-        else:
-            node = self.__dict[key]
+        self.__lock.acquire()
+        try:
+            node = self.__dict.get(key)
+            if node is None:
+                raise CacheKeyError(key)
+            self.hits += 1
             node.atime = time.time()
-            heapify(self.__heap)
+            self.__unlink(node)
+            self.__append(node)
             return node.obj
+        finally:
+            self.__lock.release()
 
     def __delitem__(self, key):
-        if not self.__dict.has_key(key):
-            raise CacheKeyError(key)
-        else:
-            node = self.__dict[key]
-            del self.__dict[key]
-            self.__heap.remove(node)
-            heapify(self.__heap)
+        self.__lock.acquire()
+        try:
+            node = self.__dict.pop(key, None)
+            if node is None:
+                raise CacheKeyError(key)
+            self.__unlink(node)
             return node.obj
+        finally:
+            self.__lock.release()
 
     def __iter__(self):
-        copy = self.__heap[:]
-        while len(copy) > 0:
-            node = heappop(copy)
-            yield node.key
-        raise StopIteration
+        self.__lock.acquire()
+        try:
+            keys = []
+            root = self.__root
+            node = root.next
+            while node is not root:
+                keys.append(node.key)
+                node = node.next
+        finally:
+            self.__lock.release()
+        return iter(keys)
 
     def __setattr__(self, name, value):
         object.__setattr__(self, name, value)
-        # automagically shrink heap on resize
+        # automagically shrink on resize
         if name == 'size':
-            overage = len(self.__heap) - value
-            for i in xrange(overage):
-                lru = heappop(self.__heap)
-                del self.__dict[lru.key]
+            self.__lock.acquire()
+            try:
+                self.__shrink(value)
+            finally:
+                self.__lock.release()
 
     def __repr__(self):
-        return "<%s (%d elements)>" % (str(self.__class__), len(self.__heap))
+        return "<%s (%d elements)>" % (str(self.__class__), len(self.__dict))
 
     def mtime(self, key):
         """Return the last modification time for the cache record with key.
         May be useful for cache instances where the stored values can get
         'stale', such as caching file or network resource contents."""
-        if not self.__dict.has_key(key):
+        node = self.__dict.get(key)
+        if node is None:
             raise CacheKeyError(key)
-        else:
-            node = self.__dict[key]
-            return node.mtime
+        return node.mtime
+
+def benchmark(sizes=(100, 1000, 10000, 100000), ops=100000):
+    """Time hits, misses (with eviction) and deletes at several cache
+    sizes. The per-operation cost should stay flat as size grows."""
+    for size in sizes:
+        cache = LRUCache(size)
+        for i in xrange(size):
+            cache[i] = i
+        keys = [(i * 7919) % size for i in xrange(ops)]
+
+        start = time.time()
+        for k in keys:
+            cache[k]
+        hit = (time.time() - start) / ops
+
+        start = time.time()
+        for i in xrange(size, size + ops):
+            cache[i] = i
+        miss = (time.time() - start) / ops
+
+        count = min(ops, size)
+        dkeys = list(cache)[:count]
+        start = time.time()
+        for k in dkeys:
+            del cache[k]
+        delete = (time.time() - start) / count
+
+        print '%7d entries: hit %.2f us, miss %.2f us, delete %.2f us' % \
+              (size, hit * 1e6, miss * 1e6, delete * 1e6)
 
 if __name__ == "__main__":
     cache = LRUCache(25)
@@ -220,3 +306,4 @@ if __name__ == "__main__":
     print cache.mtime(46)
     for c in cache:
         print c
+    benchmark()
@@ -18,7 +18,10 @@ import mutagen
 from lrucache import LRUCache
 
 import config
+import diskcache
+import metrics
 import plugins.video.transcode
+import sidecar
 import turing
 
 # Something to strip
@@ -56,10 +59,15 @@ GB = 1024 ** 3
 MB = 1024 ** 2
 KB = 1024
 
-tivo_cache = LRUCache(50)
-mp4_cache = LRUCache(50)
-dvrms_cache = LRUCache(50)
-nfo_cache = LRUCache(50)
+# The merged metadata of each file, from basic() or from_tivo(), saved
+# with a stamp of the mtimes of the file and its sidecars; also kept on
+# disk, with a cache_dir
+metadata_cache = LRUCache(1000, 'metadata_cache')
+tvshow_cache = LRUCache(50, 'tvshow_cache')
+
+metrics.counter('pytivo_metadata_lookups_total', 'Requests for the '
+                'metadata of a file, by where it came from: memory, disk '
+                'or the file itself.')
 
 mswindows = (sys.platform == "win32")
 
@@ -125,10 +133,46 @@ def _tag_value(element, tag):
         value = item[0].attributes['value'].value
         return int(value[0])
 
-def from_moov(full_path):
-    if full_path in mp4_cache:
-        return mp4_cache[full_path]
+def _copy(metadata):
+    return dict((key, type(value) == list and list(value) or value)
+                for key, value in metadata.items())
+
+def cached(kind, full_path, stamp, build):
+    """ The metadata of kind for full_path, as build(full_path) would
+        return it. It's taken from the metadata cache, if it's there
+        with the same stamp, and saved there if not. The result is the
+        caller's to modify.
+    """
+    size = config.getMetadataCacheSize()
+    if not size:
+        return build(full_path)
+    if metadata_cache.size != size:
+        metadata_cache.size = size
+
+    key = (kind, full_path)
+    try:
+        saved_stamp, metadata = metadata_cache[key]
+        if saved_stamp == stamp:
+            metrics.add('pytivo_metadata_lookups_total', source='memory')
+            return _copy(metadata)
+    except KeyError:
+        pass
+
+    db = diskcache.get_cache('metadata')
+    metadata = None
+    if db:
+        metadata = db.get('%s:%s' % (kind, full_path), stamp)
+    if metadata is None:
+        metrics.add('pytivo_metadata_lookups_total', source='file')
+        metadata = build(full_path)
+        if db:
+            db.put('%s:%s' % (kind, full_path), stamp, metadata)
+    else:
+        metrics.add('pytivo_metadata_lookups_total', source='disk')
+    metadata_cache[key] = (stamp, metadata)
+    return _copy(metadata)
 
+def from_moov(full_path):
     metadata = {}
     len_desc = 0
 
@@ -136,7 +180,6 @@ def from_moov(full_path):
         mp4meta = mutagen.File(unicode(full_path, 'utf-8'))
         assert(mp4meta)
     except:
-        mp4_cache[full_path] = {}
         return {}
 
     # The following 1-to-1 correspondence of atoms to pyTivo
@@ -240,7 +283,6 @@ def from_moov(full_path):
                 for item in data:
                     metadata[item] = data[item]
 
-    mp4_cache[full_path] = metadata
     return metadata
 
 def from_mscore(rawmeta):
@@ -288,19 +330,13 @@ def from_mscore(rawmeta):
     return metadata
 
 def from_dvrms(full_path):
-    if full_path in dvrms_cache:
-        return dvrms_cache[full_path]
-
     try:
         rawmeta = mutagen.File(unicode(full_path, 'utf-8'))
         assert(rawmeta)
     except:
-        dvrms_cache[full_path] = {}
         return {}
 
-    metadata = from_mscore(rawmeta)
-    dvrms_cache[full_path] = metadata
-    return metadata
+    return from_mscore(rawmeta)
 
 def from_eyetv(full_path):
     keys = {'TITLE': 'title', 'SUBTITLE': 'episodeTitle',
@@ -340,46 +376,7 @@ def from_eyetv(full_path):
     return metadata
 
 def from_text(full_path):
-    metadata = {}
-    full_path = unicode(full_path, 'utf-8')
-    path, name = os.path.split(full_path)
-    title, ext = os.path.splitext(name)
-
-    search_paths = []
-    ptmp = full_path
-    while ptmp:
-        parent = os.path.dirname(ptmp)
-        if ptmp != parent:
-            ptmp = parent
-        else:
-            break
-        search_paths.append(os.path.join(ptmp, 'default.txt'))
-
-    search_paths.append(os.path.join(path, title) + '.properties')
-    search_paths.reverse()
-
-    search_paths += [full_path + '.txt',
-                     os.path.join(path, '.meta', 'default.txt'),
-                     os.path.join(path, '.meta', name) + '.txt']
-
-    for metafile in search_paths:
-        if os.path.exists(metafile):
-            sep = ':='[metafile.endswith('.properties')]
-            for line in file(metafile, 'U'):
-                if line.startswith(BOM):
-                    line = line[3:]
-                if line.strip().startswith('#') or not sep in line:
-                    continue
-                key, value = [x.strip() for x in line.split(sep, 1)]
-                if not key or not value:
-                    continue
-                if key.startswith('v'):
-                    if key in metadata:
-                        metadata[key].append(value)
-                    else:
-                        metadata[key] = [value]
-                else:
-                    metadata[key] = value
+    metadata = sidecar.lookup(unicode(full_path, 'utf-8'))
 
     for rating, ratings in [('tvRating', TV_RATINGS),
                             ('mpaaRating', MPAA_RATINGS),
@@ -397,10 +394,15 @@ def from_text(full_path):
     return metadata
 
 def basic(full_path, mtime=None):
+    fname = unicode(full_path, 'utf-8')
+    if not mtime:
+        mtime = os.path.getmtime(fname)
+    return cached('basic', full_path, (mtime, sidecar.stamp(fname)),
+                  lambda full_path: _basic(full_path, mtime))
+
+def _basic(full_path, mtime):
     base_path, name = os.path.split(full_path)
     title, ext = os.path.splitext(name)
-    if not mtime:
-        mtime = os.path.getmtime(unicode(full_path, 'utf-8'))
     try:
         originalAirDate = datetime.utcfromtimestamp(mtime)
     except:
@@ -548,8 +550,16 @@ def _parse_nfo(nfo_path, nfo_data=None):
     return xmldoc
 
 def _from_tvshow_nfo(tvshow_nfo_path):
-    if tvshow_nfo_path in nfo_cache:
-        return nfo_cache[tvshow_nfo_path]
+    try:
+        mtime = os.path.getmtime(tvshow_nfo_path)
+    except OSError:
+        mtime = None
+    try:
+        saved_mtime, metadata = tvshow_cache[tvshow_nfo_path]
+        if saved_mtime == mtime:
+            return metadata
+    except KeyError:
+        pass
 
     items = {'description': 'plot',
              'title': 'title',
@@ -557,7 +567,8 @@ def _from_tvshow_nfo(tvshow_nfo_path):
              'starRating': 'rating',
              'tvRating': 'mpaa'}
 
-    nfo_cache[tvshow_nfo_path] = metadata = {}
+    tvshow_cache[tvshow_nfo_path] = (mtime, {})
+    metadata = {}
 
     xmldoc = _parse_nfo(tvshow_nfo_path)
     if not xmldoc:
@@ -576,7 +587,7 @@ def _from_tvshow_nfo(tvshow_nfo_path):
 
     metadata = _nfo_vitems(tvshow, metadata)
 
-    nfo_cache[tvshow_nfo_path] = metadata
+    tvshow_cache[tvshow_nfo_path] = (mtime, metadata)
     return metadata
 
 def _from_episode_nfo(nfo_path, xmldoc):
@@ -660,10 +671,7 @@ def _from_movie_nfo(xmldoc):
     return metadata
 
 def from_nfo(full_path):
-    if full_path in nfo_cache:
-        return nfo_cache[full_path]
-
-    metadata = nfo_cache[full_path] = {}
+    metadata = {}
 
     nfo_path = "%s.nfo" % os.path.splitext(full_path)[0]
     if not os.path.exists(nfo_path):
@@ -695,7 +703,6 @@ def from_nfo(full_path):
             else:
                 del metadata[key]
 
-    nfo_cache[full_path] = metadata
     return metadata
 
 def _tdcat_bin(tdcat_path, full_path, tivo_mak):
@@ -740,9 +747,16 @@ def _tdcat_py(full_path, tivo_mak):
     return details
 
 def from_tivo(full_path):
-    if full_path in tivo_cache:
-        return tivo_cache[full_path]
+    try:
+        mtime = os.path.getmtime(unicode(full_path, 'utf-8'))
+    except OSError:
+        return {}
+    # A new MAK may decrypt what the old one couldn't
+    tivo_mak = config.get_server('tivo_mak') or ''
+    stamp = (mtime, hashlib.md5(tivo_mak).hexdigest()[:8])
+    return cached('tivo', full_path, stamp, _from_tivo)
 
+def _from_tivo(full_path):
     tdcat_path = config.get_bin('tdcat')
     tivo_mak = config.get_server('tivo_mak')
     try:
@@ -752,7 +766,6 @@ def from_tivo(full_path):
         else:
             details = _tdcat_py(full_path, tivo_mak)
         metadata = from_details(details)
-        tivo_cache[full_path] = metadata
     except:
         metadata = {}
 
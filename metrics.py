@@ -0,0 +1,165 @@
+""" Counters and timings, for the /metrics page
+
+    Everything here is kept in memory since startup, and rendered in
+    the Prometheus text format: latency histograms for the TiVo's
+    commands, file sends and the stages of each request (see
+    profiler); totals such as bytes sent; gauges (read when the page is
+    asked for) for things like active streams; and the hit, miss and
+    eviction counts of every named LRUCache.
+
+"""
+
+import threading
+
+import lrucache
+
+# Upper bounds of the histogram buckets, in seconds
+QUICK = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SLOW = (1, 10, 60, 300, 900, 1800, 3600, 7200, 14400)
+
+lock = threading.Lock()
+histograms = {}     # name -> Histogram
+counters = {}       # (name, labels) -> value
+gauges = {}         # name -> (help, function returning [(labels, value)])
+helps = {}          # name -> help text, for histograms and counters
+
+def format_labels(labels):
+    """ labels, a tuple of (name, value) pairs, in Prometheus form. """
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(['%s="%s"' % (k, str(v).replace('\\', '\\\\')
+                                           .replace('"', '\\"'))
+                              for k, v in labels])
+
+def format_value(value):
+    return repr(float(value))
+
+class Histogram(object):
+    """ Counts of observations by bucket, for each set of labels. """
+    def __init__(self, name, help, buckets):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.series = {}    # labels -> [bucket counts, sum, count]
+
+    def observe(self, value, labels):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [[0] * len(self.buckets), 0.0, 0]
+        counts = series[0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+                break
+        series[1] += value
+        series[2] += 1
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help),
+                 '# TYPE %s histogram' % self.name]
+        for labels in sorted(self.series):
+            counts, total, count = self.series[labels]
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                lines.append('%s_bucket%s %d' % (self.name,
+                    format_labels(labels + (('le', format_value(bound)),)),
+                    cumulative))
+            lines.append('%s_bucket%s %d' % (self.name,
+                format_labels(labels + (('le', '+Inf'),)), count))
+            lines.append('%s_sum%s %s' % (self.name, format_labels(labels),
+                                          format_value(total)))
+            lines.append('%s_count%s %d' % (self.name, format_labels(labels),
+                                            count))
+        return lines
+
+def histogram(name, help, buckets=QUICK):
+    """ Declare a histogram; observe() then adds to it. """
+    lock.acquire()
+    try:
+        if name not in histograms:
+            histograms[name] = Histogram(name, help, tuple(buckets))
+    finally:
+        lock.release()
+
+def observe(name, value, **labels):
+    """ Add value (usually seconds) to the histogram name. """
+    lock.acquire()
+    try:
+        histograms[name].observe(value, tuple(sorted(labels.items())))
+    finally:
+        lock.release()
+
+def counter(name, help):
+    """ Declare a counter; add() then adds to it. """
+    helps[name] = help
+
+def add(name, amount=1, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    lock.acquire()
+    try:
+        counters[key] = counters.get(key, 0) + amount
+    finally:
+        lock.release()
+
+def gauge(name, help, function):
+    """ Declare a gauge, read by calling function(), which returns a
+        number, or a list of (labels dict, number) pairs.
+    """
+    gauges[name] = (help, function)
+
+CACHE_METRICS = (
+    ('pytivo_cache_hits_total', 'counter', 'Lookups that found their record.',
+     lambda cache: cache.hits),
+    ('pytivo_cache_misses_total', 'counter',
+     'Records added after a lookup failed.', lambda cache: cache.misses),
+    ('pytivo_cache_evictions_total', 'counter',
+     'Records dropped to make room.', lambda cache: cache.evictions),
+    ('pytivo_cache_entries', 'gauge', 'Records in the cache.', len),
+    ('pytivo_cache_capacity', 'gauge', 'Most records the cache will hold.',
+     lambda cache: cache.size))
+
+def cache_lines():
+    caches = sorted(lrucache.caches, key=lambda cache: cache.name)
+    lines = []
+    for name, kind, help, function in CACHE_METRICS:
+        lines += ['# HELP %s %s' % (name, help), '# TYPE %s %s' % (name, kind)]
+        for cache in caches:
+            lines.append('%s%s %d' % (name,
+                format_labels((('cache', cache.name),)), function(cache)))
+    return lines
+
+def render():
+    """ Everything, as the text of a Prometheus scrape. """
+    lines = []
+    lock.acquire()
+    try:
+        for name in sorted(histograms):
+            lines += histograms[name].render()
+        names = sorted(set([name for name, labels in counters]))
+        for name in names:
+            lines += ['# HELP %s %s' % (name, helps.get(name, name)),
+                      '# TYPE %s counter' % name]
+            for (n, labels), value in sorted(counters.items()):
+                if n == name:
+                    lines.append('%s%s %s' % (name, format_labels(labels),
+                                              format_value(value)))
+    finally:
+        lock.release()
+
+    for name in sorted(gauges):
+        help, function = gauges[name]
+        try:
+            values = function()
+        except Exception:
+            continue
+        lines += ['# HELP %s %s' % (name, help), '# TYPE %s gauge' % name]
+        if not isinstance(values, list):
+            values = [({}, values)]
+        for labels, value in values:
+            lines.append('%s%s %s' % (name,
+                format_labels(tuple(sorted(labels.items()))),
+                format_value(value)))
+
+    lines += cache_lines()
+    return '\n'.join(lines) + '\n'
@@ -4,12 +4,16 @@ import shutil
 import sys
 import threading
 import time
-import unicodedata
 import urllib
 
 from Cheetah.Filters import Filter
+from listing import Listing, View
 from lrucache import LRUCache
 
+import respcache
+import walker
+import watcher
+
 if os.path.sep == '/':
     quote = urllib.quote
     unquote = urllib.unquote_plus
@@ -55,8 +59,9 @@ class Plugin(object):
 
     CONTENT_TYPE = ''
 
-    recurse_cache = LRUCache(5)
-    dir_cache = LRUCache(10)
+    recurse_cache = LRUCache(5, 'recurse_cache')
+    dir_cache = LRUCache(10, 'dir_cache')
+    RECURSE_TTL = 300   # seconds a recursive listing is trusted, unwatched
 
     def __new__(cls, *args, **kwds):
         it = cls.__dict__.get('__it__')
@@ -69,6 +74,26 @@ class Plugin(object):
     def init(self):
         pass
 
+    def index_filter(self, path):
+        """Return True if the background indexer should pass this file
+           to index_file(). By default, nothing is indexed.
+        """
+        return False
+
+    def index_file(self, path, local_base_path, nice=0):
+        """Probe path ahead of demand, filling this plugin's caches.
+           Called from the indexer's worker threads; nice is the
+           priority adjustment for any helper processes.
+        """
+        pass
+
+    def index_limit(self):
+        """The most files per share worth indexing, or None for no
+           limit -- there's no point in probing more files than the
+           caches can hold.
+        """
+        return None
+
     def send_file(self, handler, path, query):
         handler.send_content_file(unicode(path, 'utf-8'))
 
@@ -86,10 +111,11 @@ class Plugin(object):
             path = os.path.join(path, folder)
         return path
 
-    def item_count(self, handler, query, cname, files, last_start=0):
+    def item_count(self, handler, query, cname, files):
         """Return only the desired portion of the list, as specified by 
            ItemCount, AnchorItem and AnchorOffset. 'files' is either a 
-           list of strings, OR a list of objects with a 'name' attribute.
+           list of strings, OR a list of objects with a 'name' attribute,
+           OR a listing.View (where finding the anchor is a lookup).
         """
         def no_anchor(handler, anchor):
             handler.server.logger.warning('Anchor not found: ' + anchor)
@@ -112,20 +138,14 @@ class Plugin(object):
                 if not '://' in anchor:
                     anchor = os.path.normpath(anchor)
 
-                if type(files[0]) == str:
+                if isinstance(files, View) or type(files[0]) == str:
                     filenames = files
                 else:
                     filenames = [x.name for x in files]
                 try:
-                    index = filenames.index(anchor, last_start)
+                    index = filenames.index(anchor)
                 except ValueError:
-                    if last_start:
-                        try:
-                            index = filenames.index(anchor, 0, last_start)
-                        except ValueError:
-                            no_anchor(handler, anchor)
-                    else:
-                        no_anchor(handler, anchor) # just use index = 0
+                    no_anchor(handler, anchor) # just use index = 0
 
                 if count > 0:
                     index += 1
@@ -140,44 +160,73 @@ class Plugin(object):
 
         return files, totalFiles, index
 
+    def response_key(self, handler, query, recurse, *extra):
+        """Key for saving the response to this query, or None if the
+           listing it's made from isn't cached. The key includes that
+           listing, so it changes when the listing is rebuilt. It also
+           changes every respcache.TTL seconds, even in watched shares,
+           since an edit to a sidecar file doesn't always reach the
+           watcher. Anything else the response depends on goes in extra.
+        """
+        path = self.get_local_path(handler, query)
+        if not path:
+            return None
+        filelist = self.get_cached_list(path, recurse)
+        if filelist is None:
+            return None
+        age = int(time.time() / respcache.TTL)
+        items = tuple(sorted((k, tuple(v)) for k, v in query.items()))
+        return ((handler.cname, items, handler.headers.getheader('tsn', ''),
+                 filelist.stamp, age) + extra)
+
+    def get_cached_list(self, path, recurse):
+        """Return the cached listing of path, or None. Under a watched
+           share, listings are good until the watcher says otherwise;
+           elsewhere, they're checked against the folder's mtime, and
+           recursive listings expire after RECURSE_TTL seconds.
+        """
+        rc = self.recurse_cache
+        dc = self.dir_cache
+        try:
+            if watcher.covers(path):
+                if recurse:
+                    return rc[path]
+                return dc[path]
+            if recurse:
+                if path in rc and (not self.RECURSE_TTL or
+                    rc.mtime(path) + self.RECURSE_TTL >= time.time()):
+                    return rc[path]
+            else:
+                updated = os.path.getmtime(unicode(path, 'utf-8'))
+                for p in rc:
+                    if path.startswith(p) and rc.mtime(p) < updated:
+                        del rc[p]
+                if path in dc and dc.mtime(path) >= updated:
+                    return dc[path]
+        except KeyError:    # not cached, or removed by another thread
+            pass
+        return None
+
+    def cache_list(self, path, recurse, filelist, generation):
+        """Cache a listing of path, unless the watcher has seen changes
+           since generation, when the listing was started.
+        """
+        if recurse:
+            cache = self.recurse_cache
+        else:
+            cache = self.dir_cache
+        cache[path] = filelist
+        if watcher.generation() != generation:
+            try:
+                del cache[path]
+            except KeyError:
+                pass
+
     def get_files(self, handler, query, filterFunction=None,
                   force_alpha=False, allow_recurse=True):
 
-        class FileData:
-            def __init__(self, name, isdir):
-                self.name = name
-                self.isdir = isdir
-                st = os.stat(unicode(name, 'utf-8'))
-                self.mdate = st.st_mtime
-                self.size = st.st_size
-
-        class SortList:
-            def __init__(self, files):
-                self.files = files
-                self.unsorted = True
-                self.sortby = None
-                self.last_start = 0
-
-        def build_recursive_list(path, recurse=True):
-            files = []
-            path = unicode(path, 'utf-8')
-            try:
-                for f in os.listdir(path):
-                    if f.startswith('.'):
-                        continue
-                    f = os.path.join(path, f)
-                    isdir = os.path.isdir(f)
-                    if sys.platform == 'darwin':
-                        f = unicodedata.normalize('NFC', f)
-                    f = f.encode('utf-8')
-                    if recurse and isdir:
-                        files.extend(build_recursive_list(f))
-                    else:
-                       if not filterFunction or filterFunction(f, file_type):
-                           files.append(FileData(f, isdir))
-            except:
-                pass
-            return files
+        def file_filter(f):
+            return filterFunction(f, file_type)
 
         subcname = query['Container'][0]
         path = self.get_local_path(handler, query)
@@ -186,57 +235,22 @@ class Plugin(object):
 
         recurse = allow_recurse and query.get('Recurse', ['No'])[0] == 'Yes'
 
-        filelist = []
-        rc = self.recurse_cache
-        dc = self.dir_cache
-        if recurse:
-            if path in rc and rc.mtime(path) + 300 >= time.time():
-                filelist = rc[path]
-        else:
-            updated = os.path.getmtime(unicode(path, 'utf-8'))
-            if path in dc and dc.mtime(path) >= updated:
-                filelist = dc[path]
-            for p in rc:
-                if path.startswith(p) and rc.mtime(p) < updated:
-                    del rc[p]
-
-        if not filelist:
-            filelist = SortList(build_recursive_list(path, recurse))
-
-            if recurse:
-                rc[path] = filelist
-            else:
-                dc[path] = filelist
-
-        def dir_sort(x, y):
-            if x.isdir == y.isdir:
-                return name_sort(x, y)
-            else:
-                return y.isdir - x.isdir
-
-        def name_sort(x, y):
-            return cmp(x.name, y.name)
-
-        def date_sort(x, y):
-            return cmp(y.mdate, x.mdate)
+        filelist = self.get_cached_list(path, recurse)
+        if filelist is None:
+            generation = watcher.generation()
+            filelist = Listing(walker.scan(path, recurse,
+                                           filterFunction and file_filter))
+            self.cache_list(path, recurse, filelist, generation)
 
         sortby = query.get('SortOrder', ['Normal'])[0]
-        if filelist.unsorted or filelist.sortby != sortby:
-            if force_alpha:
-                filelist.files.sort(dir_sort)
-            elif sortby == '!CaptureDate':
-                filelist.files.sort(date_sort)
-            else:
-                filelist.files.sort(name_sort)
-
-            filelist.sortby = sortby
-            filelist.unsorted = False
-
-        files = filelist.files[:]
+        if force_alpha:
+            files = filelist.sort('Type', lambda x: (not x.isdir, x.name))
+        elif sortby == '!CaptureDate':
+            files = filelist.sort(sortby, lambda x: x.mdate, reverse=True)
+        else:
+            files = filelist.sort('Normal', lambda x: x.name)
 
         # Trim the list
-        files, total, start = self.item_count(handler, query, handler.cname,
-                                              files, filelist.last_start)
-        if len(files) > 1:
-            filelist.last_start = start
-        return files, total, start
+        return self.item_count(handler, query, handler.cname, files)
+
+watcher.register(Plugin.dir_cache, Plugin.recurse_cache)
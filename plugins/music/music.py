@@ -1,22 +1,24 @@
 import os
 import random
 import re
-import shutil
 import subprocess
 import sys
-import time
-import unicodedata
 import urllib
 from xml.sax.saxutils import escape
 
 import mutagen
 from mutagen.easyid3 import EasyID3
 from mutagen.mp3 import MP3
-from Cheetah.Template import Template
+from listing import Listing
 from lrucache import LRUCache
 import config
+import profiler
+import runner
+import streamloop
+import tmplcache
+import walker
+import watcher
 from plugin import EncodeUnicode, Plugin, quote, unquote
-from plugins.video.transcode import kill
 
 SCRIPTDIR = os.path.dirname(__file__)
 
@@ -51,9 +53,9 @@ durre = re.compile(r'.*Duration: ([0-9]+):([0-9]+):([0-9]+)\.([0-9]+),').search
 tfname = os.path.join(SCRIPTDIR, 'templates', 'container.tmpl')
 tpname = os.path.join(SCRIPTDIR, 'templates', 'm3u.tmpl')
 iname = os.path.join(SCRIPTDIR, 'templates', 'item.tmpl')
-FOLDER_TEMPLATE = file(tfname, 'rb').read()
-PLAYLIST_TEMPLATE = file(tpname, 'rb').read()
-ITEM_TEMPLATE = file(iname, 'rb').read()
+FOLDER_TEMPLATE = tmplcache.load(tfname)
+PLAYLIST_TEMPLATE = tmplcache.load(tpname)
+ITEM_TEMPLATE = tmplcache.load(iname)
 
 # XXX BIG HACK
 # subprocess is broken for me on windows so super hack
@@ -86,9 +88,10 @@ class Music(Plugin):
     DIRECTORY = 'dir'
     PLAYLIST = 'play'
 
-    media_data_cache = LRUCache(300)
-    recurse_cache = LRUCache(5)
-    dir_cache = LRUCache(10)
+    media_data_cache = LRUCache(300, 'music.media_data_cache')
+    recurse_cache = LRUCache(5, 'music.recurse_cache')
+    dir_cache = LRUCache(10, 'music.dir_cache')
+    RECURSE_TTL = None
 
     def send_file(self, handler, path, query):
         seek = int(query.get('Seek', [0])[0])
@@ -127,158 +130,142 @@ class Music(Plugin):
 
             ffmpeg = subprocess.Popen(cmd, bufsize=BLOCKSIZE,
                                       stdout=subprocess.PIPE)
-            while True:
-                try:
-                    block = ffmpeg.stdout.read(BLOCKSIZE)
-                    handler.wfile.write('%x\r\n' % len(block))
-                    handler.wfile.write(block)
-                    handler.wfile.write('\r\n')
-                except Exception, msg:
-                    handler.server.logger.info(msg)
-                    kill(ffmpeg)
-                    break
-
-                if not block:
-                    break
+            stream = streamloop.PipeSource(ffmpeg)
         else:
-            f = open(fname, 'rb')
-            try:
-                shutil.copyfileobj(f, handler.wfile)
-            except:
-                pass
-            f.close()
+            stream = streamloop.FileSource(open(fname, 'rb'))
+
+        handler.stream(stream, lambda count: None)
+
+    def is_audio(self, f):
+        ext = os.path.splitext(f)[1].lower()
+        return ext in ('.mp3', '.mp2') or (ext in TRANSCODE and
+                                           bool(config.get_bin('ffmpeg')))
+
+    def index_filter(self, path):
+        return self.is_audio(path)
+
+    def index_file(self, path, local_base_path, nice=0):
+        if path not in self.media_data_cache:
+            self.media_data(FileData(path, False), local_base_path, nice)
+
+    def index_limit(self):
+        return self.media_data_cache.size
+
+    def media_data(self, f, local_base_path, nice=0):
+        if f.name in self.media_data_cache:
+            return self.media_data_cache[f.name]
+
+        item = {}
+        item['path'] = f.name
+        item['part_path'] = f.name.replace(local_base_path, '', 1)
+        item['name'] = os.path.basename(f.name)
+        item['is_dir'] = f.isdir
+        item['is_playlist'] = f.isplay
+        item['params'] = 'No'
+
+        if f.title:
+            item['Title'] = f.title
+
+        if f.duration > 0:
+            item['Duration'] = f.duration
+
+        if f.isdir or f.isplay or '://' in f.name:
+            self.media_data_cache[f.name] = item
+            return item
+
+        # If the format is: (track #) Song name...
+        #artist, album, track = f.name.split(os.path.sep)[-3:]
+        #track = os.path.splitext(track)[0]
+        #if track[0].isdigit:
+        #    track = ' '.join(track.split(' ')[1:])
+
+        #item['SongTitle'] = track
+        #item['AlbumTitle'] = album
+        #item['ArtistName'] = artist
+
+        ext = os.path.splitext(f.name)[1].lower()
+        fname = unicode(f.name, 'utf-8')
 
         try:
-            handler.wfile.flush()
+            # If the file is an mp3, let's load the EasyID3 interface
+            if ext == '.mp3':
+                audioFile = MP3(fname, ID3=EasyID3)
+            else:
+                # Otherwise, let mutagen figure it out
+                audioFile = mutagen.File(fname)
+
+            if audioFile:
+                # Pull the length from the FileType, if present
+                if audioFile.info.length > 0:
+                    item['Duration'] = int(audioFile.info.length * 1000)
+
+                # Grab our other tags, if present
+                def get_tag(tagname, d):
+                    for tag in ([tagname] + TAGNAMES[tagname]):
+                        try:
+                            if tag in d:
+                                value = d[tag][0]
+                                if type(value) not in [str, unicode]:
+                                    value = str(value)
+                                return value
+                        except:
+                            pass
+                    return ''
+
+                artist = get_tag('artist', audioFile)
+                title = get_tag('title', audioFile)
+                if artist == 'Various Artists' and '/' in title:
+                    artist, title = [x.strip() for x in title.split('/')]
+                item['ArtistName'] = artist
+                item['SongTitle'] = title
+                item['AlbumTitle'] = get_tag('album', audioFile)
+                item['AlbumYear'] = get_tag('date', audioFile)[:4]
+                item['MusicGenre'] = get_tag('genre', audioFile)
         except Exception, msg:
-            handler.server.logger.info(msg)
+            print msg
+
+        ffmpeg_path = config.get_bin('ffmpeg')
+        if 'Duration' not in item and ffmpeg_path:
+            if mswindows:
+                fname = fname.encode('cp1252')
+            cmd = [ffmpeg_path, '-i', fname]
+
+            # wait ffmpeg_wait (or 10) sec if ffmpeg is not back give up
+            result = runner.run(cmd, config.getFFmpegWait() or 10, nice)
+            if result is not None:
+                d = durre(result[1])
+                if d:
+                    millisecs = ((int(d.group(1)) * 3600 +
+                                  int(d.group(2)) * 60 +
+                                  int(d.group(3))) * 1000 +
+                                 int(d.group(4)) *
+                                 (10 ** (3 - len(d.group(4)))))
+                else:
+                    millisecs = 0
+                item['Duration'] = millisecs
+
+        if 'Duration' in item and ffmpeg_path:
+            item['params'] = 'Yes'
+
+        self.media_data_cache[f.name] = item
+        return item
 
     def QueryContainer(self, handler, query):
 
         def AudioFileFilter(f, filter_type=None):
-            ext = os.path.splitext(f)[1].lower()
-
-            if ext in ('.mp3', '.mp2') or (ext in TRANSCODE and
-                                           config.get_bin('ffmpeg')):
+            if self.is_audio(f):
                 return self.AUDIO
             else:
                 file_type = False
 
                 if not filter_type or filter_type.split('/')[0] != self.AUDIO:
-                    if ext in PLAYLISTS:
+                    if os.path.splitext(f)[1].lower() in PLAYLISTS:
                         file_type = self.PLAYLIST
                     elif os.path.isdir(f):
                         file_type = self.DIRECTORY
 
                 return file_type
 
-        def media_data(f):
-            if f.name in self.media_data_cache:
-                return self.media_data_cache[f.name]
-
-            item = {}
-            item['path'] = f.name
-            item['part_path'] = f.name.replace(local_base_path, '', 1)
-            item['name'] = os.path.basename(f.name)
-            item['is_dir'] = f.isdir
-            item['is_playlist'] = f.isplay
-            item['params'] = 'No'
-
-            if f.title:
-                item['Title'] = f.title
-
-            if f.duration > 0:
-                item['Duration'] = f.duration
-
-            if f.isdir or f.isplay or '://' in f.name:
-                self.media_data_cache[f.name] = item
-                return item
-
-            # If the format is: (track #) Song name...
-            #artist, album, track = f.name.split(os.path.sep)[-3:]
-            #track = os.path.splitext(track)[0]
-            #if track[0].isdigit:
-            #    track = ' '.join(track.split(' ')[1:])
-
-            #item['SongTitle'] = track
-            #item['AlbumTitle'] = album
-            #item['ArtistName'] = artist
-
-            ext = os.path.splitext(f.name)[1].lower()
-            fname = unicode(f.name, 'utf-8')
-
-            try:
-                # If the file is an mp3, let's load the EasyID3 interface
-                if ext == '.mp3':
-                    audioFile = MP3(fname, ID3=EasyID3)
-                else:
-                    # Otherwise, let mutagen figure it out
-                    audioFile = mutagen.File(fname)
-
-                if audioFile:
-                    # Pull the length from the FileType, if present
-                    if audioFile.info.length > 0:
-                        item['Duration'] = int(audioFile.info.length * 1000)
-
-                    # Grab our other tags, if present
-                    def get_tag(tagname, d):
-                        for tag in ([tagname] + TAGNAMES[tagname]):
-                            try:
-                                if tag in d:
-                                    value = d[tag][0]
-                                    if type(value) not in [str, unicode]:
-                                        value = str(value)
-                                    return value
-                            except:
-                                pass
-                        return ''
-
-                    artist = get_tag('artist', audioFile)
-                    title = get_tag('title', audioFile)
-                    if artist == 'Various Artists' and '/' in title:
-                        artist, title = [x.strip() for x in title.split('/')]
-                    item['ArtistName'] = artist
-                    item['SongTitle'] = title
-                    item['AlbumTitle'] = get_tag('album', audioFile)
-                    item['AlbumYear'] = get_tag('date', audioFile)[:4]
-                    item['MusicGenre'] = get_tag('genre', audioFile)
-            except Exception, msg:
-                print msg
-
-            ffmpeg_path = config.get_bin('ffmpeg')
-            if 'Duration' not in item and ffmpeg_path:
-                if mswindows:
-                    fname = fname.encode('cp1252')
-                cmd = [ffmpeg_path, '-i', fname]
-                ffmpeg = subprocess.Popen(cmd, stderr=subprocess.PIPE,
-                                               stdout=subprocess.PIPE, 
-                                               stdin=subprocess.PIPE)
-
-                # wait 10 sec if ffmpeg is not back give up
-                for i in xrange(200):
-                    time.sleep(.05)
-                    if not ffmpeg.poll() == None:
-                        break
-
-                if ffmpeg.poll() != None:
-                    output = ffmpeg.stderr.read()
-                    d = durre(output)
-                    if d:
-                        millisecs = ((int(d.group(1)) * 3600 +
-                                      int(d.group(2)) * 60 +
-                                      int(d.group(3))) * 1000 +
-                                     int(d.group(4)) *
-                                     (10 ** (3 - len(d.group(4)))))
-                    else:
-                        millisecs = 0
-                    item['Duration'] = millisecs
-
-            if 'Duration' in item and ffmpeg_path:
-                item['params'] = 'Yes'
-
-            self.media_data_cache[f.name] = item
-            return item
-
         subcname = query['Container'][0]
         local_base_path = self.get_local_base_path(handler, query)
 
@@ -286,20 +273,26 @@ class Music(Plugin):
             handler.send_error(404)
             return
 
+        stages = profiler.Stages('listing')
         if os.path.splitext(subcname)[1].lower() in PLAYLISTS:
-            t = Template(PLAYLIST_TEMPLATE, filter=EncodeUnicode)
+            t = PLAYLIST_TEMPLATE(filter=EncodeUnicode)
             t.files, t.total, t.start = self.get_playlist(handler, query)
         else:
-            t = Template(FOLDER_TEMPLATE, filter=EncodeUnicode)
+            t = FOLDER_TEMPLATE(filter=EncodeUnicode)
             t.files, t.total, t.start = self.get_files(handler, query,
                                                        AudioFileFilter)
-        t.files = map(media_data, t.files)
+        stages.next('metadata')
+        t.files = [self.media_data(f, local_base_path) for f in t.files]
         t.container = handler.cname
         t.name = subcname
         t.quote = quote
         t.escape = escape
 
-        handler.send_xml(str(t))
+        stages.next('render')
+        page = str(t)
+        stages.next('reply')
+        handler.send_xml(page)
+        stages.end()
 
     def QueryItem(self, handler, query):
         uq = urllib.unquote_plus
@@ -307,7 +300,7 @@ class Music(Plugin):
         path = os.path.join(handler.container['path'], *splitpath[1:])
 
         if path in self.media_data_cache:
-            t = Template(ITEM_TEMPLATE, filter=EncodeUnicode)
+            t = ITEM_TEMPLATE(filter=EncodeUnicode)
             t.file = self.media_data_cache[path]
             t.escape = escape
             handler.send_xml(str(t))
@@ -412,46 +405,14 @@ class Music(Plugin):
 
     def get_files(self, handler, query, filterFunction=None):
 
-        class SortList:
-            def __init__(self, files):
-                self.files = files
-                self.unsorted = True
-                self.sortby = None
-                self.last_start = 0
- 
         def build_recursive_list(path, recurse=True):
-            files = []
-            path = unicode(path, 'utf-8')
-            try:
-                for f in os.listdir(path):
-                    if f.startswith('.'):
-                        continue
-                    f = os.path.join(path, f)
-                    isdir = os.path.isdir(f)
-                    if sys.platform == 'darwin':
-                        f = unicodedata.normalize('NFC', f)
-                    f = f.encode('utf-8')
-                    if recurse and isdir:
-                        files.extend(build_recursive_list(f))
-                    else:
-                        fd = FileData(f, isdir)
-                        if isdir or filterFunction(f, file_type):
-                            files.append(fd)
-            except:
-                pass
-            return files
-
-        def dir_sort(x, y):
-            if x.isdir == y.isdir:
-                if x.isplay == y.isplay:
-                    return name_sort(x, y)
-                else:
-                    return y.isplay - x.isplay
-            else:
-                return y.isdir - x.isdir
+            # Music doesn't use sizes or dates, so skip the stat()s
+            return Listing(walker.scan(path, recurse,
+                                       lambda f: filterFunction(f, file_type),
+                                       need_stat=False), FileData)
 
-        def name_sort(x, y):
-            return cmp(x.name, y.name)
+        def dir_sort(x):
+            return (not x.isdir, not x.isplay, x.name)
 
         path = self.get_local_path(handler, query)
 
@@ -459,27 +420,11 @@ class Music(Plugin):
 
         recurse = query.get('Recurse', ['No'])[0] == 'Yes'
 
-        filelist = []
-        rc = self.recurse_cache
-        dc = self.dir_cache
-        if recurse:
-            if path in rc:
-                filelist = rc[path]
-        else:
-            updated = os.path.getmtime(unicode(path, 'utf-8'))
-            if path in dc and dc.mtime(path) >= updated:
-                filelist = dc[path]
-            for p in rc:
-                if path.startswith(p) and rc.mtime(p) < updated:
-                    del rc[p]
-
-        if not filelist:
-            filelist = SortList(build_recursive_list(path, recurse))
-
-            if recurse:
-                rc[path] = filelist
-            else:
-                dc[path] = filelist
+        filelist = self.get_cached_list(path, recurse)
+        if filelist is None:
+            generation = watcher.generation()
+            filelist = build_recursive_list(path, recurse)
+            self.cache_list(path, recurse, filelist, generation)
 
         # Sort it
         seed = ''
@@ -493,39 +438,20 @@ class Music(Plugin):
                 start = query['RandomStart'][0]
                 sortby += start
 
-        if filelist.unsorted or filelist.sortby != sortby:
-            if 'Random' in sortby:
-                self.random_lock.acquire()
-                if seed:
-                    random.seed(seed)
-                random.shuffle(filelist.files)
-                self.random_lock.release()
-                if start:
-                    local_base_path = self.get_local_base_path(handler, query)
-                    start = unquote(start)
-                    start = start.replace(os.path.sep + handler.cname,
-                                          local_base_path, 1)
-                    filenames = [x.name for x in filelist.files]
-                    try:
-                        index = filenames.index(start)
-                        i = filelist.files.pop(index)
-                        filelist.files.insert(0, i)
-                    except ValueError:
-                        handler.server.logger.warning('Start not found: ' +
-                                                      start)
-            else:
-                filelist.files.sort(dir_sort)
-
-            filelist.sortby = sortby
-            filelist.unsorted = False
-
-        files = filelist.files[:]
+        if 'Random' in sortby:
+            if start:
+                local_base_path = self.get_local_base_path(handler, query)
+                start = unquote(start)
+                start = start.replace(os.path.sep + handler.cname,
+                                      local_base_path, 1)
+            files = filelist.shuffle(sortby, seed, start, self.random_lock)
+            if start and files and files[0].name != start:
+                handler.server.logger.warning('Start not found: ' + start)
+        else:
+            files = filelist.sort('Type', dir_sort)
 
         # Trim the list
-        files, total, start = self.item_count(handler, query, handler.cname,
-                                              files, filelist.last_start)
-        filelist.last_start = start
-        return files, total, start
+        return self.item_count(handler, query, handler.cname, files)
 
     def get_playlist(self, handler, query):
         subcname = query['Container'][0]
@@ -564,3 +490,5 @@ class Music(Plugin):
 
         # Trim the list
         return self.item_count(handler, query, handler.cname, playlist)
+
+watcher.register(Music.dir_cache, Music.recurse_cache)
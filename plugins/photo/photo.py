@@ -26,13 +26,8 @@
 
 import os
 import re
-import random
-import subprocess
 import sys
-import tempfile
-import threading
 import time
-import unicodedata
 import urllib
 from cStringIO import StringIO
 from xml.sax.saxutils import escape
@@ -48,10 +43,15 @@ except ImportError:
         print 'Python Imaging Library not found; using FFmpeg'
 
 import config
-from Cheetah.Template import Template
+import profiler
+import respcache
+import runner
+import tmplcache
+import walker
+import watcher
+from listing import Listing
 from lrucache import LRUCache
 from plugin import EncodeUnicode, Plugin, quote, unquote
-from plugins.video.transcode import kill
 
 SCRIPTDIR = os.path.dirname(__file__)
 
@@ -72,45 +72,32 @@ ffmpeg_size = re.compile(r'.*Video: .+, (\d+)x(\d+)[, ].*')
 # Preload the template
 tname = os.path.join(SCRIPTDIR, 'templates', 'container.tmpl')
 iname = os.path.join(SCRIPTDIR, 'templates', 'item.tmpl')
-PHOTO_TEMPLATE = file(tname, 'rb').read()
-ITEM_TEMPLATE = file(iname, 'rb').read()
+PHOTO_TEMPLATE = tmplcache.load(tname)
+ITEM_TEMPLATE = tmplcache.load(iname)
 
 JFIF_TAG = '\xff\xe0\x00\x10JFIF\x00\x01\x02\x00\x00\x01\x00\x01\x00\x00'
 
+IMAGE_EXTS = ('.jpg', '.gif', '.png', '.bmp', '.tif', '.xbm', '.xpm',
+              '.pgm', '.pbm', '.ppm', '.pcx', '.tga', '.fpx', '.ico',
+              '.pcd', '.jpeg', '.tiff', '.nef')
+
+class FileData:
+    def __init__(self, name, isdir):
+        self.name = name
+        self.isdir = isdir
+        st = os.stat(unicode(name, 'utf-8'))
+        self.cdate = st.st_ctime
+        self.mdate = st.st_mtime
+
 class Photo(Plugin):
     
     CONTENT_TYPE = 'x-container/tivo-photos'
 
-    class LockedLRUCache(LRUCache):
-        def __init__(self, num):
-            LRUCache.__init__(self, num)
-            self.lock = threading.RLock()
-
-        def acquire(self, blocking=1):
-            return self.lock.acquire(blocking)
-
-        def release(self):
-            self.lock.release()
-
-        def __setitem__(self, key, obj):
-            self.acquire()
-            try:
-                LRUCache.__setitem__(self, key, obj)
-            finally:
-                self.release()
-
-        def __getitem__(self, key):
-            item = None
-            self.acquire()
-            try:
-                item = LRUCache.__getitem__(self, key)
-            finally:
-                self.release()
-            return item
-
-    media_data_cache = LockedLRUCache(300)  # info and thumbnails
-    recurse_cache = LockedLRUCache(5)       # recursive directory lists
-    dir_cache = LockedLRUCache(10)          # non-recursive lists
+    # info and thumbnails; recursive, and non-recursive directory lists
+    media_data_cache = LRUCache(300, 'photo.media_data_cache')
+    recurse_cache = LRUCache(5, 'photo.recurse_cache')
+    dir_cache = LRUCache(10, 'photo.dir_cache')
+    RECURSE_TTL = None
 
     def new_size(self, oldw, oldh, width, height, pshape):
         pixw, pixh = [int(x) for x in pshape.split(':')]
@@ -220,34 +207,15 @@ class Photo(Plugin):
 
         return True, encoded
 
-    def get_size_ffmpeg(self, ffmpeg_path, fname):
+    def get_size_ffmpeg(self, ffmpeg_path, fname, nice=0):
         cmd = [ffmpeg_path, '-i', fname]
-        # Windows and other OS buffer 4096 and ffmpeg can output more
-        # than that.
-        err_tmp = tempfile.TemporaryFile()
-        ffmpeg = subprocess.Popen(cmd, stderr=err_tmp,
-                                  stdout=subprocess.PIPE,
-                                  stdin=subprocess.PIPE)
 
         # wait configured # of seconds: if ffmpeg is not back give up
-        limit = config.getFFmpegWait()
-        if limit:
-            for i in xrange(limit * 20):
-                time.sleep(.05)
-                if not ffmpeg.poll() == None:
-                    break
-
-            if ffmpeg.poll() == None:
-                kill(ffmpeg)
-                return False, 'FFmpeg timed out'
-        else:
-            ffmpeg.wait()
+        result = runner.run(cmd, config.getFFmpegWait(), nice)
+        if result is None:
+            return False, 'FFmpeg timed out'
 
-        err_tmp.seek(0)
-        output = err_tmp.read()
-        err_tmp.close()
-
-        x = ffmpeg_size.search(output)
+        x = ffmpeg_size.search(result[1])
         if x:
             width = int(x.group(1))
             height = int(x.group(2))
@@ -301,27 +269,12 @@ class Photo(Plugin):
         filters += 'scale=%d:%d' % (width, height)
 
         cmd = [ffmpeg_path, '-i', fname, '-vf', filters, '-f', 'mjpeg', '-']
-        jpeg_tmp = tempfile.TemporaryFile()
-        ffmpeg = subprocess.Popen(cmd, stdout=jpeg_tmp,
-                                  stdin=subprocess.PIPE)
 
         # wait configured # of seconds: if ffmpeg is not back give up
-        limit = config.getFFmpegWait()
-        if limit:
-            for i in xrange(limit * 20):
-                time.sleep(.05)
-                if not ffmpeg.poll() == None:
-                    break
-
-            if ffmpeg.poll() == None:
-                kill(ffmpeg)
-                return False, 'FFmpeg timed out'
-        else:
-            ffmpeg.wait()
-
-        jpeg_tmp.seek(0)
-        output = jpeg_tmp.read()
-        jpeg_tmp.close()
+        result = runner.run(cmd, config.getFFmpegWait())
+        if result is None:
+            return False, 'FFmpeg timed out'
+        output = result[0]
 
         if 'JFIF' not in output[:10]:
             output = output[:2] + JFIF_TAG + output[2:]
@@ -386,6 +339,47 @@ class Photo(Plugin):
             handler.server.logger.error(result)
             handler.send_error(404)
 
+    def is_image(self, f):
+        return os.path.splitext(f)[1].lower() in IMAGE_EXTS
+
+    def media_data(self, f, local_base_path):
+        if f.name in self.media_data_cache:
+            return self.media_data_cache[f.name]
+
+        item = {}
+        item['path'] = f.name
+        item['part_path'] = f.name.replace(local_base_path, '', 1)
+        item['name'] = os.path.basename(f.name)
+        item['is_dir'] = f.isdir
+        item['rotation'] = 0
+        item['cdate'] = '%#x' % int(f.cdate)
+        item['mdate'] = '%#x' % int(f.mdate)
+
+        self.media_data_cache[f.name] = item
+        return item
+
+    def index_filter(self, path):
+        return self.is_image(path)
+
+    def index_file(self, path, local_base_path, nice=0):
+        if path in self.media_data_cache:
+            return
+        attrs = self.media_data(FileData(path, False), local_base_path)
+
+        # With PIL, the image size comes free with each load; with
+        # FFmpeg, it costs an extra run, so fetch it now.
+        ffmpeg_path = config.get_bin('ffmpeg')
+        if not use_pil and ffmpeg_path:
+            fname = unicode(path, 'utf-8')
+            if sys.platform == 'win32':
+                fname = fname.encode('cp1252')
+            status, result = self.get_size_ffmpeg(ffmpeg_path, fname, nice)
+            if status:
+                attrs['size'] = result
+
+    def index_limit(self):
+        return self.media_data_cache.size
+
     def QueryContainer(self, handler, query):
 
         # Reject a malformed request -- these attributes should only
@@ -401,38 +395,30 @@ class Photo(Plugin):
             handler.send_error(404)
             return
 
-        def ImageFileFilter(f):
-            goodexts = ('.jpg', '.gif', '.png', '.bmp', '.tif', '.xbm',
-                        '.xpm', '.pgm', '.pbm', '.ppm', '.pcx', '.tga',
-                        '.fpx', '.ico', '.pcd', '.jpeg', '.tiff', '.nef')
-            return os.path.splitext(f)[1].lower() in goodexts
-
-        def media_data(f):
-            if f.name in self.media_data_cache:
-                return self.media_data_cache[f.name]
-
-            item = {}
-            item['path'] = f.name
-            item['part_path'] = f.name.replace(local_base_path, '', 1)
-            item['name'] = os.path.basename(f.name)
-            item['is_dir'] = f.isdir
-            item['rotation'] = 0
-            item['cdate'] = '%#x' % int(f.cdate)
-            item['mdate'] = '%#x' % int(f.mdate)
-
-            self.media_data_cache[f.name] = item
-            return item
-
-        t = Template(PHOTO_TEMPLATE, filter=EncodeUnicode)
+        recurse = query.get('Recurse', ['No'])[0] == 'Yes'
+        response = respcache.lookup(self.response_key(handler, query,
+                                                       recurse))
+        if response:
+            handler.send_saved(response)
+            return
+
+        t = PHOTO_TEMPLATE(filter=EncodeUnicode)
         t.name = query['Container'][0]
         t.container = handler.cname
+        stages = profiler.Stages('listing')
         t.files, t.total, t.start = self.get_files(handler, query,
-            ImageFileFilter)
-        t.files = map(media_data, t.files)
+            self.is_image)
+        key = self.response_key(handler, query, recurse)
+        stages.next('metadata')
+        t.files = [self.media_data(f, local_base_path) for f in t.files]
         t.quote = quote
         t.escape = escape
 
-        handler.send_xml(str(t))
+        stages.next('render')
+        response = respcache.save(key, str(t), 'text/xml')
+        stages.next('reply')
+        handler.send_saved(response)
+        stages.end()
 
     def QueryItem(self, handler, query):
         uq = urllib.unquote_plus
@@ -440,7 +426,7 @@ class Photo(Plugin):
         path = os.path.join(handler.container['path'], *splitpath[1:])
 
         if path in self.media_data_cache:
-            t = Template(ITEM_TEMPLATE, filter=EncodeUnicode)
+            t = ITEM_TEMPLATE(filter=EncodeUnicode)
             t.file = self.media_data_cache[path]
             t.escape = escape
             handler.send_xml(str(t))
@@ -449,93 +435,28 @@ class Photo(Plugin):
 
     def get_files(self, handler, query, filterFunction):
 
-        class FileData:
-            def __init__(self, name, isdir):
-                self.name = name
-                self.isdir = isdir
-                st = os.stat(unicode(name, 'utf-8'))
-                self.cdate = st.st_ctime
-                self.mdate = st.st_mtime
-
-        class SortList:
-            def __init__(self, files):
-                self.files = files
-                self.unsorted = True
-                self.sortby = None
-                self.last_start = 0
-                self.lock = threading.RLock()
-
-            def acquire(self, blocking=1):
-                return self.lock.acquire(blocking)
-
-            def release(self):
-                self.lock.release()
-
-        def build_recursive_list(path, recurse=True):
-            files = []
-            path = unicode(path, 'utf-8')
-            try:
-                for f in os.listdir(path):
-                    if f.startswith('.'):
-                        continue
-                    f = os.path.join(path, f)
-                    isdir = os.path.isdir(f)
-                    if sys.platform == 'darwin':
-                        f = unicodedata.normalize('NFC', f)
-                    f = f.encode('utf-8')
-                    if recurse and isdir:
-                        files.extend(build_recursive_list(f))
-                    else:
-                       if isdir or filterFunction(f):
-                           files.append(FileData(f, isdir))
-            except:
-                pass
-
-            return files
-
-        def name_sort(x, y):
-            return cmp(x.name, y.name)
-
-        def cdate_sort(x, y):
-            return cmp(x.cdate, y.cdate)
-
-        def mdate_sort(x, y):
-            return cmp(x.mdate, y.mdate)
-
-        def dir_sort(x, y):
-            if x.isdir == y.isdir:
-                return sortfunc(x, y)
-            else:
-                return y.isdir - x.isdir
+        def name_key(x):
+            return x.name
+
+        def cdate_key(x):
+            return x.cdate
+
+        def mdate_key(x):
+            return x.mdate
+
+        def dir_key(x):
+            return (not x.isdir, sortkey(x))
 
         path = self.get_local_path(handler, query)
 
         # Build the list
         recurse = query.get('Recurse', ['No'])[0] == 'Yes'
 
-        filelist = []
-        rc = self.recurse_cache
-        dc = self.dir_cache
-        if recurse:
-            if path in rc:
-                filelist = rc[path]
-        else:
-            updated = os.path.getmtime(unicode(path, 'utf-8'))
-            if path in dc and dc.mtime(path) >= updated:
-                filelist = dc[path]
-            for p in rc:
-                if path.startswith(p) and rc.mtime(p) < updated:
-                    del rc[p]
-
-        if not filelist:
-            filelist = SortList(build_recursive_list(path, recurse))
-
-            if recurse:
-                rc[path] = filelist
-            else:
-                dc[path] = filelist
-
-        filelist.acquire()
+        filelist = self.get_cached_list(path, recurse)
+        if filelist is None:
+            generation = watcher.generation()
+            filelist = Listing(walker.scan(path, recurse, filterFunction))
+            self.cache_list(path, recurse, filelist, generation)
 
         # Sort it
         seed = ''
@@ -549,55 +470,37 @@ class Photo(Plugin):
                 start = query['RandomStart'][0]
                 sortby += start
 
-        if filelist.unsorted or filelist.sortby != sortby:
-            if 'Random' in sortby:
-                self.random_lock.acquire()
-                if seed:
-                    random.seed(seed)
-                random.shuffle(filelist.files)
-                self.random_lock.release()
-                if start:
-                    local_base_path = self.get_local_base_path(handler, query)
-                    start = unquote(start)
-                    start = start.replace(os.path.sep + handler.cname,
-                                          local_base_path, 1)
-                    filenames = [x.name for x in filelist.files]
-                    try:
-                        index = filenames.index(start)
-                        i = filelist.files.pop(index)
-                        filelist.files.insert(0, i)
-                    except ValueError:
-                        handler.server.logger.warning('Start not found: ' +
-                                                      start)
+        if 'Random' in sortby:
+            if start:
+                local_base_path = self.get_local_base_path(handler, query)
+                start = unquote(start)
+                start = start.replace(os.path.sep + handler.cname,
+                                      local_base_path, 1)
+            files = filelist.shuffle(sortby, seed, start, self.random_lock)
+            if start and files and files[0].name != start:
+                handler.server.logger.warning('Start not found: ' + start)
+        else:
+            if 'CaptureDate' in sortby:
+                sortkey = cdate_key
+            elif 'LastChangeDate' in sortby:
+                sortkey = mdate_key
             else:
-                if 'CaptureDate' in sortby:
-                    sortfunc = cdate_sort
-                elif 'LastChangeDate' in sortby:
-                    sortfunc = mdate_sort
-                else:
-                    sortfunc = name_sort
+                sortkey = name_key
 
-                if 'Type' in sortby:
-                    filelist.files.sort(dir_sort)
-                else:
-                    filelist.files.sort(sortfunc)
-
-            filelist.sortby = sortby
-            filelist.unsorted = False
-
-        files = filelist.files[:]
+            if 'Type' in sortby:
+                files = filelist.sort(sortby, dir_key)
+            else:
+                files = filelist.sort(sortby, sortkey)
 
         # Filter it -- this section needs work
         if 'Filter' in query:
             usedir = 'folder' in query['Filter'][0]
             useimg = 'image' in query['Filter'][0]
             if not usedir:
-                files = [x for x in files if not x.isdir]
+                files = files.select(False)
             elif usedir and not useimg:
-                files = [x for x in files if x.isdir]
+                files = files.select(True)
+
+        return self.item_count(handler, query, handler.cname, files)
 
-        files, total, start = self.item_count(handler, query, handler.cname,
-                                              files, filelist.last_start)
-        filelist.last_start = start
-        filelist.release()
-        return files, total, start
+watcher.register(Photo.dir_cache, Photo.recurse_cache)
@@ -44,6 +44,17 @@ function deleteSection(id)
     }
 }
 
+function preTranscode(share)
+{
+    var answer = confirm('Transcode the videos in ' + share +
+                         ' ahead of time?')
+    if (answer) {
+        window.location = '/TiVoConnect?Command=PreTranscode' +
+                          '&Container=Settings&Share=' +
+                          encodeURIComponent(share)
+    }
+}
+
 function redir(target)
 {
     var answer = confirm('Are you sure you wish to ' + target +
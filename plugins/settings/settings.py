@@ -1,12 +1,15 @@
 import logging
 import os
 from urllib import quote
+from xml.sax.saxutils import escape
 
 from Cheetah.Template import Template
 
 import buildhelp
 import config
+import pretranscode
 from plugin import EncodeUnicode, Plugin
+from plugins.video import transcache
 
 SCRIPTDIR = os.path.dirname(__file__)
 
@@ -25,6 +28,20 @@ SETTINGS_MSG = """<h3>Settings Saved</h3> <p>Your settings have been
 saved to the pyTivo.conf file. However you may need to do a <b>Soft 
 Reset</b> or <b>Restart</b> before these changes will take effect.</p>"""
 
+PRETRANSCODE_MSG = """<h3>Pre-transcoding</h3> <p>pyTivo is now 
+transcoding the videos in %s that your TiVos can't play as they are. 
+Progress is shown on the main pyTivo page.</p>"""
+
+PRETRANSCODE_BUSY_MSG = """<h3>Pre-transcoding</h3> <p>Pre-transcoding 
+is already in progress. %s.</p>"""
+
+PRETRANSCODE_ERR_MSG = """<h3>Pre-transcoding</h3> <p>%s is not a 
+video share.</p>"""
+
+PRETRANSCODE_NOCACHE_MSG = """<h3>Pre-transcoding</h3> <p>Pre-transcoded 
+videos are kept in the transcode cache. Set <b>transcode_cache</b> first, 
+then try again.</p>"""
+
 # Preload the templates
 tsname = os.path.join(SCRIPTDIR, 'templates', 'settings.tmpl')
 SETTINGS_TEMPLATE = file(tsname, 'rb').read()
@@ -61,6 +78,31 @@ class Settings(Plugin):
         handler.redir(RESET_MSG, 3)
         logging.getLogger('pyTivo.settings').info('pyTivo has been soft reset.')
 
+    def PreTranscode(self, handler, query):
+        share = query.get('Share', [''])[0]
+        current = handler.server.pretranscoder
+        if current and not current.is_finished():
+            handler.redir(PRETRANSCODE_BUSY_MSG %
+                          escape(current.status_text()), 5)
+            return
+
+        path = pretranscode.share_path(share)
+        if path == share:
+            handler.redir(PRETRANSCODE_ERR_MSG % escape(share), 5)
+            return
+
+        if not transcache.cache_dir():
+            handler.redir(PRETRANSCODE_NOCACHE_MSG, 5)
+            return
+
+        p = pretranscode.PreTranscoder([path], config.getPreTranscodeTsn(),
+            config.getPreTranscodeWorkers(), config.getPreTranscodeNice(),
+            pretranscode.parse_window(config.getPreTranscodeWindow()),
+            handler.server)
+        p.start()
+        handler.server.pretranscoder = p
+        handler.redir(PRETRANSCODE_MSG % escape(share), 5)
+
     def Settings(self, handler, query):
         # Read config file new each time in case there was any outside edits
         config.reset()
@@ -89,6 +131,8 @@ class Settings(Plugin):
         t.sd_tivos_data = dict(config.config.items('_tivo_SD', raw=True))
         t.sd_tivos_known = buildhelp.getknown('sd_tivos')
         t.shares_data = shares_data
+        t.video_shares = [name for name, data in shares_data
+                          if data.get('type') in ('video', 'webvideo')]
         t.shares_known = buildhelp.getknown('shares')
         t.tivos_data = [(section, dict(config.config.items(section, raw=True)))
                         for section in config.config.sections()
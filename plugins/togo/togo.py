@@ -15,6 +15,7 @@ from Cheetah.Template import Template
 
 import config
 import metadata
+import tivodecoder
 from plugin import EncodeUnicode, Plugin
 
 logger = logging.getLogger('pyTivo.togo')
@@ -113,7 +114,6 @@ class ToGo(Plugin):
         shows_per_page = 50 # Change this to alter the number of shows returned
         folder = ''
         FirstAnchor = ''
-        has_tivodecode = bool(config.get_bin('tivodecode'))
 
         if 'TiVo' in query:
             tivoIP = query['TiVo'][0]
@@ -225,7 +225,6 @@ class ToGo(Plugin):
         t.status = status
         if tivoIP in queue:
             t.queue = queue[tivoIP]
-        t.has_tivodecode = has_tivodecode
         t.togo_mpegts = config.is_ts_capable(tsn)
         t.tname = tivo_name
         t.tivoIP = tivoIP
@@ -253,6 +252,10 @@ class ToGo(Plugin):
         except:
             pass
         ts = status[url]['ts_format']
+        if status[url]['decode'] and not tivodecoder.can_decode(ts):
+            logger.warning('Saving "%s" undecrypted: transport streams '
+                           'need tivodecode' % url)
+            status[url]['decode'] = False
         if status[url]['decode']:
             if ts:
                 name[-1] = 'ts'
@@ -301,8 +304,7 @@ class ToGo(Plugin):
             fname = outfile
             if mswindows:
                 fname = fname.encode('cp1252')
-            tivodecode_path = config.get_bin('tivodecode')
-            tcmd = [tivodecode_path, '-m', mak, '-o', fname, '-']
+            tcmd = tivodecoder.command(mak) + ['-o', fname, '-']
             tivodecode = subprocess.Popen(tcmd, stdin=subprocess.PIPE,
                                           bufsize=(512 * 1024))
             f = tivodecode.stdin
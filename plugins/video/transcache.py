@@ -0,0 +1,150 @@
+""" On-disk cache of completed transcodes
+
+    When transcode_cache is set, the output of each transcode that runs
+    to completion is kept there, named for a hash of the source path,
+    its mtime and the FFmpeg settings it was made with. Later requests
+    for the same output are served from the cache as a plain file --
+    with a Content-Length, and seekable -- instead of starting FFmpeg
+    again. Once the cache grows past transcode_cache_size, the least
+    recently used outputs are removed.
+
+"""
+
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import time
+
+import config
+
+logger = logging.getLogger('pyTivo.video.transcache')
+
+SUFFIX = '.mpg'
+PARTIAL = '.part'
+
+evict_lock = threading.Lock()
+
+def cache_dir():
+    return config.get_server('transcode_cache')
+
+def entry_name(inFile, settings):
+    """ The cache file for inFile, as transcoded with settings (the
+        list from transcode(True, ...)), or None if it can't be cached.
+    """
+    path = cache_dir()
+    if not path:
+        return None
+    try:
+        mtime = os.path.getmtime(unicode(inFile, 'utf-8'))
+    except OSError:
+        return None
+    key = repr((inFile, mtime, tuple(settings)))
+    return os.path.join(path, hashlib.sha1(key).hexdigest() + SUFFIX)
+
+def lookup(inFile, settings):
+    """ Return the path of the cached output for inFile and settings,
+        or None. A hit counts as a use, for eviction.
+    """
+    name = entry_name(inFile, settings)
+    if not name or not os.path.isfile(name):
+        return None
+    try:
+        os.utime(name, None)
+    except OSError:
+        return None
+    return name
+
+class Writer(object):
+    """ Collects one transcode's output in a temporary file, which is
+        moved into the cache by commit(), or discarded by abort().
+    """
+    def __init__(self, name):
+        self.name = name
+        fd, self.tmpname = tempfile.mkstemp(PARTIAL, '',
+                                            os.path.dirname(name))
+        self.file = os.fdopen(fd, 'wb')
+
+    def write(self, data):
+        if not self.file:
+            return
+        try:
+            self.file.write(data)
+        except (IOError, OSError), msg:
+            logger.info('Not caching %s: %s' % (self.name, msg))
+            self.abort()
+
+    def commit(self):
+        if not self.file:
+            return
+        try:
+            self.file.close()
+            self.file = None
+            if os.path.exists(self.name):
+                os.remove(self.name)
+            os.rename(self.tmpname, self.name)
+        except (IOError, OSError), msg:
+            logger.info('Not caching %s: %s' % (self.name, msg))
+            self.abort()
+            return
+        logger.debug('Cached transcode %s' % self.name)
+        evict()
+
+    def abort(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+        try:
+            os.remove(self.tmpname)
+        except OSError:
+            pass
+
+def new_entry(inFile, settings):
+    """ Return a Writer for the output of transcoding inFile with
+        settings, or None if the cache is disabled.
+    """
+    name = entry_name(inFile, settings)
+    if not name:
+        return None
+    try:
+        return Writer(name)
+    except (IOError, OSError), msg:
+        logger.info('Not caching %s: %s' % (name, msg))
+        return None
+
+def evict():
+    """ Remove the least recently used outputs until the cache fits in
+        transcode_cache_size.
+    """
+    path = cache_dir()
+    limit = config.getTranscodeCacheSize()
+    evict_lock.acquire()
+    try:
+        entries = []
+        total = 0
+        for name in os.listdir(path):
+            if not name.endswith(SUFFIX):
+                continue
+            name = os.path.join(path, name)
+            try:
+                st = os.stat(name)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, name))
+            total += st.st_size
+        entries.sort()
+        for mtime, size, name in entries:
+            if total <= limit:
+                break
+            try:
+                os.remove(name)
+            except OSError:
+                continue
+            total -= size
+            logger.debug('Evicted %s, unused since %s' %
+                         (name, time.ctime(mtime)))
+    except OSError, msg:
+        logger.info(msg)
+    finally:
+        evict_lock.release()
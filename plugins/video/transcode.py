@@ -1,3 +1,4 @@
+import json
 import logging
 import math
 import os
@@ -9,23 +10,31 @@ import sys
 import tempfile
 import threading
 import time
+from collections import deque
 
 import lrucache
 
 import config
+import diskcache
 import metadata
+import metrics
+import profiler
+import runner
+import streamloop
+import tivodecoder
+import transcache
 
 logger = logging.getLogger('pyTivo.video.transcode')
 
-info_cache = lrucache.LRUCache(1000)
-ffmpeg_procs = {}
-reapers = {}
+info_cache = lrucache.LRUCache(1000, 'info_cache')
+info_changes = 0    # count of video_info() calls that missed info_cache
+ffmpeg_procs = {}   # TranscodeSessions, by session_key()
+procs_lock = threading.RLock()
 
 GOOD_MPEG_FPS = ['23.98', '24.00', '25.00', '29.97',
                  '30.00', '50.00', '59.94', '60.00']
 
 BLOCKSIZE = 512 * 1024
-MAXBLOCKS = 2
 TIMEOUT = 600
 
 # XXX BIG HACK
@@ -79,18 +88,45 @@ def transcode(isQuery, inFile, outFile, tsn='', mime='', thead=''):
     if isQuery:
         return settings
 
+    return start_session(inFile, tsn, mime, thead, settings).send(outFile, 0)
+
+def start_session(inFile, tsn='', mime='', thead='', settings=None):
+    """ Return a TranscodeSession for inFile from the start: a running
+        transcode of the same file, with the same settings, if it still
+        has the start of the stream, or else a new one.
+    """
+    if settings is None:
+        settings = transcode(True, inFile, '', tsn, mime)
+    key = session_key(inFile, tsn, mime, thead)
+    procs_lock.acquire()
+    try:
+        session = ffmpeg_procs.get(key)
+        if session and session.covers(0):
+            debug('joining transcode session for %s' % inFile)
+        else:
+            session = TranscodeSession(key, start_process(inFile, settings,
+                                                          tsn), thead,
+                                       transcache.new_entry(inFile, key[1]))
+            ffmpeg_procs[key] = session
+            reap_process(session)
+    finally:
+        procs_lock.release()
+    return session
+
+def start_process(inFile, settings, tsn='', nice=0):
     ffmpeg_path = config.get_bin('ffmpeg')
+    preexec = runner.lower_priority(nice)
 
     fname = unicode(inFile, 'utf-8')
     if mswindows:
         fname = fname.encode('cp1252')
 
     if inFile[-5:].lower() == '.tivo':
-        tivodecode_path = config.get_bin('tivodecode')
         tivo_mak = config.get_server('tivo_mak')
-        tcmd = [tivodecode_path, '-m', tivo_mak, fname]
+        tcmd = tivodecoder.command(tivo_mak) + [fname]
         tivodecode = subprocess.Popen(tcmd, stdout=subprocess.PIPE,
-                                      bufsize=(512 * 1024))
+                                      bufsize=(512 * 1024),
+                                      preexec_fn=preexec)
         if tivo_compatible(inFile, tsn)[0]:
             cmd = ''
             ffmpeg = tivodecode
@@ -98,116 +134,389 @@ def transcode(isQuery, inFile, outFile, tsn='', mime='', thead=''):
             cmd = [ffmpeg_path, '-i', '-'] + settings
             ffmpeg = subprocess.Popen(cmd, stdin=tivodecode.stdout,
                                       stdout=subprocess.PIPE,
-                                      bufsize=(512 * 1024))
+                                      bufsize=(512 * 1024),
+                                      preexec_fn=preexec)
     else:
         cmd = [ffmpeg_path, '-i', fname] + settings
         ffmpeg = subprocess.Popen(cmd, bufsize=(512 * 1024),
-                                  stdout=subprocess.PIPE)
+                                  stdout=subprocess.PIPE,
+                                  preexec_fn=preexec)
 
     if cmd:
         debug('transcoding to tivo model ' + tsn[:3] + ' using ffmpeg command:')
         debug(' '.join(cmd))
 
-    ffmpeg_procs[inFile] = {'process': ffmpeg, 'start': 0, 'end': 0,
-                            'last_read': time.time(), 'blocks': []}
-    if thead:
-        ffmpeg_procs[inFile]['blocks'].append(thead)
-    reap_process(inFile)
-    return resume_transfer(inFile, outFile, 0)
-
-def is_resumable(inFile, offset):
-    if inFile in ffmpeg_procs:
-        proc = ffmpeg_procs[inFile]
-        if proc['start'] <= offset < proc['end']:
-            return True
-        else:
-            cleanup(inFile)
-            kill(proc['process'])
-    return False
+    return ffmpeg
 
-def resume_transfer(inFile, outFile, offset):
-    proc = ffmpeg_procs[inFile]
-    offset -= proc['start']
-    count = 0
+def session_key(inFile, tsn='', mime='', thead=''):
+    """ Sessions are shared by requests that would get the same output:
+        the same file, FFmpeg settings and TiVo header.
+    """
+    return (inFile, tuple(transcode(True, inFile, '', tsn, mime)), thead)
 
+def get_session(inFile, offset, tsn='', mime='', thead=''):
+    """ Return the running session that can serve inFile from offset,
+        or None.
+    """
+    key = session_key(inFile, tsn, mime, thead)
+    procs_lock.acquire()
     try:
-        for block in proc['blocks']:
-            length = len(block)
-            if offset < length:
-                if offset > 0:
-                    block = block[offset:]
-                outFile.write('%x\r\n' % len(block))
-                outFile.write(block)
-                outFile.write('\r\n')
-                count += len(block)
-            offset -= length
-        outFile.flush()
-    except Exception, msg:
-        logger.info(msg)
-        return count
-
-    proc['start'] = proc['end']
-    proc['blocks'] = []
-
-    return count + transfer_blocks(inFile, outFile)
+        session = ffmpeg_procs.get(key)
+    finally:
+        procs_lock.release()
+    if session and session.covers(offset):
+        return session
+    return None
+
+def running_sessions():
+    """ The number of transcodes with FFmpeg still running. """
+    procs_lock.acquire()
+    try:
+        return len([session for session in ffmpeg_procs.values()
+                    if not session.done])
+    finally:
+        procs_lock.release()
+
+metrics.histogram('pytivo_probe_seconds', 'Time to probe a video file.')
+metrics.gauge('pytivo_ffmpeg_processes', 'Transcodes with FFmpeg running.',
+              running_sessions)
+
+def is_resumable(inFile, offset, tsn='', mime='', thead=''):
+    return get_session(inFile, offset, tsn, mime, thead) is not None
+
+def resume_transfer(inFile, outFile, offset, tsn='', mime='', thead=''):
+    session = get_session(inFile, offset, tsn, mime, thead)
+    if not session:
+        return 0
+    return session.send(outFile, offset)
+
+class MemoryBuffer(object):
+    """ The last (at least) capacity bytes of a stream, kept as a list
+        of blocks. Offsets are from the start of the stream.
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.blocks = deque()
+        self.start = 0
+        self.end = 0
+
+    def append(self, data):
+        self.blocks.append(data)
+        self.end += len(data)
+        while self.end - self.start - len(self.blocks[0]) >= self.capacity:
+            self.start += len(self.blocks.popleft())
+
+    def read(self, offset, length):
+        pos = self.start
+        for block in self.blocks:
+            if offset < pos + len(block):
+                return block[offset - pos:offset - pos + length]
+            pos += len(block)
+        return ''
+
+    def close(self):
+        self.blocks.clear()
+
+class DiskBuffer(object):
+    """ As MemoryBuffer, but kept in a circular temporary file. """
+    def __init__(self, capacity, dirname):
+        self.capacity = capacity
+        self.file = tempfile.TemporaryFile(dir=dirname)
+        self.start = 0
+        self.end = 0
+
+    def append(self, data):
+        while data:
+            pos = self.end % self.capacity
+            part = data[:self.capacity - pos]
+            self.file.seek(pos)
+            self.file.write(part)
+            self.end += len(part)
+            data = data[len(part):]
+        self.start = max(0, self.end - self.capacity)
+
+    def read(self, offset, length):
+        pos = offset % self.capacity
+        length = min(length, self.end - offset, self.capacity - pos)
+        self.file.seek(pos)
+        return self.file.read(length)
+
+    def close(self):
+        self.file.close()
+
+class TranscodeSession(object):
+    """ One running transcode, shared by any number of readers.
+
+        A pump thread copies FFmpeg's output into a ring buffer; each
+        reader sends from its own offset within the buffer. The pump
+        waits when there are no readers, or when the slowest one is a
+        full buffer behind, so no reader ever loses data it hasn't
+        sent yet -- and a reader that reconnects (with a Range offset)
+        anywhere in the buffer can resume without restarting FFmpeg.
+        If there's a cache writer, the output is also saved for reuse,
+        once FFmpeg finishes successfully. Once FFmpeg is done and the
+        last reader has gone, the session is closed and its buffer freed.
+    """
+    def __init__(self, key, process, thead='', writer=None):
+        self.key = key
+        self.process = process
+        self.writer = writer
+        self.cond = threading.Condition()
+        self.readers = {}
+        self.waiters = []
+        self.done = False
+        self.closed = False
+        self.last_read = time.time()
+
+        capacity = max(config.getTranscodeBuffer(), 2 * BLOCKSIZE)
+        buffer_dir = config.get_server('transcode_buffer_dir')
+        if buffer_dir:
+            self.buffer = DiskBuffer(capacity, buffer_dir)
+        else:
+            self.buffer = MemoryBuffer(capacity)
+        if thead:
+            self.buffer.append(thead)
 
-def transfer_blocks(inFile, outFile):
-    proc = ffmpeg_procs[inFile]
-    blocks = proc['blocks']
-    count = 0
+        pump = threading.Thread(target=self.pump)
+        pump.setDaemon(True)
+        pump.start()
 
-    while True:
+    def covers(self, offset):
+        self.cond.acquire()
         try:
-            block = proc['process'].stdout.read(BLOCKSIZE)
-            proc['last_read'] = time.time()
-        except Exception, msg:
-            logger.info(msg)
-            cleanup(inFile)
-            kill(proc['process'])
-            break
+            limit = self.buffer.end
+            if not self.done:
+                limit += BLOCKSIZE    # not here yet, but soon
+            return not self.closed and self.buffer.start <= offset <= limit
+        finally:
+            self.cond.release()
+
+    def blocked(self):
+        if not self.readers:
+            return True
+        slowest = min(self.readers.values())
+        return self.buffer.end - slowest > self.buffer.capacity - BLOCKSIZE
+
+    def pump(self):
+        while True:
+            self.cond.acquire()
+            try:
+                while not self.closed and self.blocked():
+                    self.cond.wait()
+                if self.closed:
+                    break
+            finally:
+                self.cond.release()
 
-        if not block:
             try:
-                outFile.flush()
+                block = self.process.stdout.read(BLOCKSIZE)
             except Exception, msg:
                 logger.info(msg)
-            else:
-                cleanup(inFile)
-            break
+                block = ''
+
+            if self.writer:
+                if block:
+                    self.writer.write(block)
+                elif self.process.wait() == 0:
+                    self.writer.commit()
+                    self.writer = None
+
+            self.cond.acquire()
+            try:
+                if self.closed:
+                    break
+                if block:
+                    self.buffer.append(block)
+                else:
+                    self.done = True
+                self.cond.notifyAll()
+            finally:
+                self.cond.release()
+            self.wake_waiters()
+            if not block:
+                break
+
+        if self.writer:
+            self.writer.abort()
+        self.release()
+
+    def send(self, outFile, offset):
+        """ Send the stream from offset to outFile, in chunked encoding.
+            Returns the number of bytes sent.
+        """
+        reader = object()
+        count = 0
+        self.cond.acquire()
+        try:
+            if self.closed or offset < self.buffer.start:
+                return 0
+            self.readers[reader] = offset
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
 
-        blocks.append(block)
-        proc['end'] += len(block)
-        if len(blocks) > MAXBLOCKS:
-            proc['start'] += len(blocks[0])
-            blocks.pop(0)
+        try:
+            while True:
+                self.cond.acquire()
+                try:
+                    while (offset >= self.buffer.end and not self.done and
+                           not self.closed):
+                        self.cond.wait()
+                    if self.closed or offset < self.buffer.start:
+                        logger.info('Transcode buffer overrun')
+                        break
+                    if offset >= self.buffer.end:
+                        break
+                    block = self.buffer.read(offset, BLOCKSIZE)
+                    self.last_read = time.time()
+                finally:
+                    self.cond.release()
+
+                try:
+                    outFile.write('%x\r\n' % len(block))
+                    outFile.write(block)
+                    outFile.write('\r\n')
+                except Exception, msg:
+                    logger.info(msg)
+                    break
+                offset += len(block)
+                count += len(block)
+
+                self.cond.acquire()
+                self.readers[reader] = offset
+                self.cond.notifyAll()
+                self.cond.release()
+        finally:
+            self.cond.acquire()
+            del self.readers[reader]
+            self.cond.notifyAll()
+            self.cond.release()
 
         try:
-            outFile.write('%x\r\n' % len(block))
-            outFile.write(block)
-            outFile.write('\r\n')
-            count += len(block)
+            outFile.flush()
         except Exception, msg:
             logger.info(msg)
-            break
-
-    return count
+        self.release()
+        return count
 
-def reap_process(inFile):
-    if ffmpeg_procs and inFile in ffmpeg_procs:
-        proc = ffmpeg_procs[inFile]
-        if proc['last_read'] + TIMEOUT < time.time():
-            del ffmpeg_procs[inFile]
-            del reapers[inFile]
-            kill(proc['process'])
-        else:
-            reaper = threading.Timer(TIMEOUT, reap_process, (inFile,))
-            reapers[inFile] = reaper
-            reaper.start()
+    def read(self, reader, offset, waiter):
+        """ For readers that can't block (SessionSource): the next
+            block from offset, '' at the end, or None if it's not here
+            yet -- then waiter() is called when it might be.
+        """
+        self.cond.acquire()
+        try:
+            if self.closed or offset < self.buffer.start:
+                if not self.closed:
+                    logger.info('Transcode buffer overrun')
+                return ''
+            self.readers[reader] = offset
+            self.cond.notifyAll()
+            if offset >= self.buffer.end:
+                if self.done:
+                    return ''
+                self.waiters.append(waiter)
+                return None
+            self.last_read = time.time()
+            return self.buffer.read(offset, BLOCKSIZE)
+        finally:
+            self.cond.release()
+
+    def remove_reader(self, reader):
+        self.cond.acquire()
+        self.readers.pop(reader, None)
+        self.cond.notifyAll()
+        self.cond.release()
+        self.release()
+
+    def release(self):
+        """ End the session if FFmpeg is done and no one is reading it,
+            rather than keeping its buffer until the reaper gets to it.
+        """
+        self.cond.acquire()
+        try:
+            unused = self.done and not self.readers
+        finally:
+            self.cond.release()
+        if unused:
+            end_session(self)
+
+    def wake_waiters(self):
+        self.cond.acquire()
+        waiters, self.waiters = self.waiters, []
+        self.cond.release()
+        for waiter in waiters:
+            waiter()
+
+    def idle(self):
+        self.cond.acquire()
+        try:
+            return (not self.readers and
+                    self.last_read + TIMEOUT < time.time())
+        finally:
+            self.cond.release()
 
-def cleanup(inFile):
-    del ffmpeg_procs[inFile]
-    reapers[inFile].cancel()
-    del reapers[inFile]
+    def close(self):
+        self.cond.acquire()
+        try:
+            if self.closed:
+                return
+            self.closed = True
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
+        self.wake_waiters()
+        if self.process.poll() is None:
+            kill(self.process)
+        self.buffer.close()
+
+class SessionSource(streamloop.Source):
+    """ A TranscodeSession from offset, in chunked encoding, for
+        handler.stream().
+    """
+    def __init__(self, session, offset=0):
+        streamloop.Source.__init__(self)
+        self.session = session
+        self.offset = offset
+        self.reader = object()
+        self.ended = False
+
+    def next_block(self, transfer):
+        if self.ended:
+            return ''
+        block = self.session.read(self.reader, self.offset, transfer.resume)
+        if block is None:
+            return None
+        if not block:
+            self.ended = True
+            return '0\r\n\r\n'
+        self.offset += len(block)
+        self.count += len(block)
+        return '%x\r\n%s\r\n' % (len(block), block)
+
+    def copy(self, handler):
+        self.count = self.session.send(handler.wfile, self.offset)
+        handler.wfile.write('0\r\n\r\n')
+        return self.count
+
+    def close(self):
+        self.session.remove_reader(self.reader)
+
+def end_session(session):
+    procs_lock.acquire()
+    try:
+        if ffmpeg_procs.get(session.key) is session:
+            del ffmpeg_procs[session.key]
+    finally:
+        procs_lock.release()
+    session.close()
+
+def reap_process(session):
+    if session.idle():
+        end_session(session)
+    elif not session.closed:
+        reaper = threading.Timer(TIMEOUT, reap_process, (session,))
+        reaper.start()
 
 def select_audiocodec(isQuery, inFile, tsn='', mime=''):
     if inFile[-5:].lower() == '.tivo':
@@ -738,19 +1047,54 @@ def tivo_compatible(inFile, tsn='', mime=''):
                                            message[1], inFile))
     return message
 
-def video_info(inFile, cache=True):
-    vInfo = dict()
+def ffmpeg_version(ffmpeg_path):
+    """ A cheap signature of the ffmpeg (or ffprobe) binary, so that
+        stored probe results are discarded when it's replaced.
+    """
+    try:
+        st = os.stat(ffmpeg_path)
+    except OSError:
+        return ffmpeg_path
+    return '%s:%d:%d' % (ffmpeg_path, st.st_size, st.st_mtime)
+
+def probe_stamp(st, ffmpeg_path):
+    return (st.st_size, st.st_mtime, ffmpeg_version(ffmpeg_path))
+
+def probe_bin():
+    """ The binary that video_info() probes files with: ffprobe if
+        it's available, or else ffmpeg.
+    """
+    return config.get_bin('ffprobe') or config.get_bin('ffmpeg')
+
+def info_cached(inFile):
+    """ True if video_info() can answer for inFile without running
+        ffmpeg, from memory or from the persistent probe database.
+    """
+    if inFile in info_cache:
+        return True
+    probe_db = diskcache.get_cache('video_info')
+    if not (config.get_bin('ffmpeg') and probe_db):
+        return False
+    try:
+        st = os.stat(unicode(inFile, 'utf-8'))
+    except OSError:
+        return False
+    return probe_db.has(inFile, probe_stamp(st, probe_bin()))
+
+def video_info(inFile, cache=True, nice=0):
+    global info_changes
     fname = unicode(inFile, 'utf-8')
-    mtime = os.path.getmtime(fname)
+    st = os.stat(fname)
+    mtime = st.st_mtime
     if cache:
         if inFile in info_cache and info_cache[inFile][0] == mtime:
             debug('CACHE HIT! %s' % inFile)
             return info_cache[inFile][1]
-
-    vInfo['Supported'] = True
+    info_changes += 1
 
     ffmpeg_path = config.get_bin('ffmpeg')
     if not ffmpeg_path:
+        vInfo = {'Supported': True}
         if os.path.splitext(inFile)[1].lower() not in ['.mpg', '.mpeg',
                                                        '.vob', '.tivo', '.ts']:
             vInfo['Supported'] = False
@@ -760,34 +1104,68 @@ def video_info(inFile, cache=True):
             info_cache[inFile] = (mtime, vInfo)
         return vInfo
 
+    vInfo = None
+    probe_db = None
+    if cache:
+        probe_db = diskcache.get_cache('video_info')
+    if probe_db:
+        stamp = probe_stamp(st, probe_bin())
+        vInfo = probe_db.get(inFile, stamp)
+        if vInfo is not None:
+            debug('PROBE DB HIT! %s' % inFile)
+
+    if vInfo is None:
+        ffprobe_path = config.get_bin('ffprobe')
+        stages = profiler.Stages('probe', 'pytivo_probe_seconds')
+        if ffprobe_path:
+            vInfo = ffprobe_info(fname, ffprobe_path, nice)
+        else:
+            vInfo = ffmpeg_info(fname, ffmpeg_path, nice)
+        stages.end()
+        if vInfo is None:
+            vInfo = {'Supported': False}
+            if cache:
+                info_cache[inFile] = (mtime, vInfo)
+            return vInfo
+        if probe_db:
+            probe_db.put(inFile, stamp, vInfo)
+
+    data = metadata.from_text(inFile)
+    for key in data:
+        if key.startswith('Override_'):
+            vInfo['Supported'] = True
+            if key.startswith('Override_mapAudio'):
+                audiomap = dict(vInfo['mapAudio'])
+                newmap = shlex.split(data[key])
+                audiomap.update(zip(newmap[::2], newmap[1::2]))
+                vInfo['mapAudio'] = sorted(audiomap.items(),
+                                           key=lambda (k,v): (k,v))
+            elif key.startswith('Override_millisecs'):
+                vInfo[key.replace('Override_', '')] = int(data[key])
+            else:
+                vInfo[key.replace('Override_', '')] = data[key]
+
+    if cache:
+        info_cache[inFile] = (mtime, vInfo)
+    debug("; ".join(["%s=%s" % (k, v) for k, v in vInfo.items()]))
+    return vInfo
+
+def ffmpeg_info(fname, ffmpeg_path, nice=0):
+    """ Run "ffmpeg -i" on fname (a unicode path) and parse its output
+        into a vInfo dict. Returns None if ffmpeg_wait is exceeded.
+        A positive nice value runs ffmpeg at reduced priority.
+    """
+    vInfo = {'Supported': True}
+
     if mswindows:
         fname = fname.encode('cp1252')
     cmd = [ffmpeg_path, '-i', fname]
-    # Windows and other OS buffer 4096 and ffmpeg can output more than that.
-    err_tmp = tempfile.TemporaryFile()
-    ffmpeg = subprocess.Popen(cmd, stderr=err_tmp, stdout=subprocess.PIPE,
-                              stdin=subprocess.PIPE)
 
     # wait configured # of seconds: if ffmpeg is not back give up
-    limit = config.getFFmpegWait()
-    if limit:
-        for i in xrange(limit * 20):
-            time.sleep(.05)
-            if not ffmpeg.poll() == None:
-                break
-
-        if ffmpeg.poll() == None:
-            kill(ffmpeg)
-            vInfo['Supported'] = False
-            if cache:
-                info_cache[inFile] = (mtime, vInfo)
-            return vInfo
-    else:
-        ffmpeg.wait()
-
-    err_tmp.seek(0)
-    output = err_tmp.read()
-    err_tmp.close()
+    result = runner.run(cmd, config.getFFmpegWait(), nice)
+    if result is None:
+        return None
+    output = result[1]
     debug('ffmpeg output=%s' % output)
 
     attrs = {'container': r'Input #0, ([^,]+),',
@@ -957,25 +1335,157 @@ def video_info(inFile, cache=True):
                         pass
 
     vInfo['rawmeta'] = rawmeta
+    return vInfo
 
-    data = metadata.from_text(inFile)
-    for key in data:
-        if key.startswith('Override_'):
-            vInfo['Supported'] = True
-            if key.startswith('Override_mapAudio'):
-                audiomap = dict(vInfo['mapAudio'])
-                newmap = shlex.split(data[key])
-                audiomap.update(zip(newmap[::2], newmap[1::2]))
-                vInfo['mapAudio'] = sorted(audiomap.items(),
-                                           key=lambda (k,v): (k,v))
-            elif key.startswith('Override_millisecs'):
-                vInfo[key.replace('Override_', '')] = int(data[key])
-            else:
-                vInfo[key.replace('Override_', '')] = data[key]
+def ffprobe_info(fname, ffprobe_path, nice=0):
+    """ Like ffmpeg_info(), but from the structured output of ffprobe,
+        which is mapped onto the same vInfo keys. Falls back to
+        ffmpeg_info() if ffprobe's output can't be read.
+    """
+    cmd_name = fname
+    if mswindows:
+        cmd_name = fname.encode('cp1252')
+    cmd = [ffprobe_path, '-hide_banner', '-print_format', 'json',
+           '-show_format', '-show_streams', cmd_name]
 
-    if cache:
-        info_cache[inFile] = (mtime, vInfo)
-    debug("; ".join(["%s=%s" % (k, v) for k, v in vInfo.items()]))
+    # wait configured # of seconds: if ffprobe is not back give up
+    result = runner.run(cmd, config.getFFmpegWait(), nice)
+    if result is None:
+        return None
+    output, errors = result
+    debug('ffprobe output=%s' % output)
+    try:
+        probe = json.loads(output.decode('utf-8', 'replace'))
+    except ValueError:
+        debug('unreadable ffprobe output, using ffmpeg')
+        return ffmpeg_info(fname, config.get_bin('ffmpeg'), nice)
+
+    fmt = probe.get('format', {})
+    streams = probe.get('streams', [])
+    video = [s for s in streams if s.get('codec_type') == 'video' and
+             not s.get('disposition', {}).get('attached_pic')]
+    audio = [s for s in streams if s.get('codec_type') == 'audio']
+
+    def kbps(stream):
+        try:
+            return str(int(stream['bit_rate']) / 1000)
+        except (KeyError, ValueError):
+            return None
+
+    def ratio(value):
+        if value and ':' in value and '0' not in value.split(':'):
+            return str(value)
+        return None
+
+    vInfo = {'Supported': True}
+
+    vInfo['container'] = str(fmt.get('format_name', '').split(',')[0])
+    if not vInfo['container']:
+        vInfo['Supported'] = False
+        debug('failed at container')
+
+    if video:
+        v = video[0]
+        vInfo['vCodec'] = str(v.get('codec_name', ''))
+        vInfo['mapVideo'] = '0:%d' % v['index']
+    else:
+        v = {}
+        vInfo['vCodec'] = ''
+        vInfo['mapVideo'] = None
+    if not vInfo['vCodec']:
+        vInfo['Supported'] = False
+        debug('failed at vCodec')
+
+    if audio:
+        a = audio[0]
+        vInfo['aCodec'] = str(a.get('codec_name', '')) or None
+        vInfo['aKbps'] = kbps(a)
+        vInfo['aFreq'] = a.get('sample_rate') and str(a['sample_rate'])
+        vInfo['aCh'] = a.get('channels') or None
+    else:
+        vInfo['aCodec'] = vInfo['aKbps'] = vInfo['aFreq'] = None
+        vInfo['aCh'] = None
+        debug('failed at aCodec')
+
+    if v.get('width') and v.get('height'):
+        vInfo['vWidth'] = int(v['width'])
+        vInfo['vHeight'] = int(v['height'])
+    else:
+        vInfo['vWidth'] = ''
+        vInfo['vHeight'] = ''
+        vInfo['Supported'] = False
+        debug('failed at vWidth/vHeight')
+
+    # ffmpeg reports r_frame_rate as "tbr", to two decimal places
+    try:
+        num, den = v['r_frame_rate'].split('/')
+        vInfo['vFps'] = '%.2f' % (float(num) / float(den))
+    except (KeyError, ValueError, ZeroDivisionError):
+        vInfo['vFps'] = ''
+        vInfo['Supported'] = False
+        debug('failed at vFps')
+
+    # Allow override only if it is mpeg2 and frame rate was doubled
+    # to 59.94 -- ffprobe logs the same notes that ffmpeg does
+    if (vInfo['vCodec'] == 'mpeg2video' and vInfo['vFps'] and
+        vInfo['vFps'] != '29.97'):
+        log = errors.lower()
+        if ('film source: 29.97' in log or
+            'frame rate differs from container frame rate: 29.97' in log):
+            debug('film source: 29.97 setting vFps to 29.97')
+            vInfo['vFps'] = '29.97'
+
+    try:
+        vInfo['millisecs'] = int(round(float(fmt['duration']) * 1000))
+    except (KeyError, ValueError):
+        vInfo['millisecs'] = 0
+
+    # get bitrate of source for tivo compatibility test.
+    vInfo['kbps'] = kbps(fmt) or kbps(v)
+    if not vInfo['kbps']:
+        debug('failed at kbps')
+
+    vInfo['par1'] = ratio(v.get('sample_aspect_ratio'))
+    if vInfo['par1']:
+        x, y = vInfo['par1'].split(':')
+        vInfo['par2'] = float(x) / float(y)
+    else:
+        vInfo['par2'] = None
+
+    vInfo['dar1'] = ratio(v.get('display_aspect_ratio'))
+
+    # Audio stream mapping, with details in the style of ffmpeg's
+    # stream lines, for audio_lang matching
+    amap = []
+    for a in audio:
+        details = ''
+        if 'id' in a:
+            details += '[%s]' % a['id']
+        lang = a.get('tags', {}).get('language')
+        if lang:
+            details += '(%s)' % lang
+        desc = [a.get('codec_name', '')]
+        if a.get('sample_rate'):
+            desc.append('%s Hz' % a['sample_rate'])
+        if a.get('channel_layout'):
+            desc.append(a['channel_layout'])
+        if a.get('sample_fmt'):
+            desc.append(a['sample_fmt'])
+        if kbps(a):
+            desc.append('%s kb/s' % kbps(a))
+        details += ' ' + ', '.join(desc)
+        amap.append(('0:%d' % a['index'], details.encode('utf-8')))
+    if not amap:
+        amap.append(('', ''))
+        debug('failed at mapAudio')
+    vInfo['mapAudio'] = amap
+
+    vInfo['par'] = None
+
+    rawmeta = {}
+    for key, value in fmt.get('tags', {}).items():
+        rawmeta[key.encode('utf-8')] = [value]
+    vInfo['rawmeta'] = rawmeta
     return vInfo
 
 def audio_check(inFile, tsn):
@@ -11,13 +11,21 @@ from UserDict import DictMixin
 from datetime import datetime, timedelta
 from xml.sax.saxutils import escape
 
-from Cheetah.Template import Template
 from lrucache import LRUCache
 
 import config
+import diskcache
 import metadata
+import metrics
 import mind
+import profiler
 import qtfaststart
+import respcache
+import sidecar
+import streamloop
+import tivodecoder
+import tmplcache
+import transcache
 import transcode
 from plugin import EncodeUnicode, Plugin, quote
 
@@ -31,7 +39,7 @@ PUSHED = '<h3>Queued for Push to %s</h3> <p>%s</p>'
 
 # Preload the templates
 def tmpl(name):
-    return file(os.path.join(SCRIPTDIR, 'templates', name), 'rb').read()
+    return tmplcache.load(os.path.join(SCRIPTDIR, 'templates', name))
 
 HTML_CONTAINER_TEMPLATE = tmpl('container_html.tmpl')
 XML_CONTAINER_TEMPLATE = tmpl('container_xml.tmpl')
@@ -182,15 +190,31 @@ class BaseVideo(Plugin):
 
     CONTENT_TYPE = 'x-container/tivo-videos'
 
-    tvbus_cache = LRUCache(1)
+    # Rendered TVBus details and TiVo headers, by file and kind of TiVo
+    tvbus_cache = LRUCache(1000, 'tvbus_cache')
 
     def video_file_filter(self, full_path, type=None):
+        # Check the extension first, to skip a stat() for most files
+        if (use_extensions and
+            os.path.splitext(full_path)[1].lower() in EXTENSIONS):
+            return True
         if os.path.isdir(unicode(full_path, 'utf-8')):
             return True
         if use_extensions:
-            return os.path.splitext(full_path)[1].lower() in EXTENSIONS
-        else:
-            return transcode.supported_format(full_path)
+            return False
+        return transcode.supported_format(full_path)
+
+    def index_filter(self, path):
+        return self.video_file_filter(path)
+
+    def index_file(self, path, local_base_path, nice=0):
+        if not transcode.info_cached(path):
+            transcode.video_info(path, nice=nice)
+
+    def index_limit(self):
+        if diskcache.get_cache('video_info'):
+            return None
+        return transcode.info_cache.size
 
     def send_file(self, handler, path, query):
         mime = 'video/x-tivo-mpeg'
@@ -216,15 +240,11 @@ class BaseVideo(Plugin):
             offset = 0
 
         if needs_tivodecode:
-            valid = bool(config.get_bin('tivodecode') and
-                         config.get_server('tivo_mak'))
+            valid = bool(config.get_server('tivo_mak') and
+                         tivodecoder.can_decode(tivodecoder.is_ts(path)))
         else:
             valid = True
 
-        if valid and offset:
-            valid = ((compatible and offset < os.path.getsize(path)) or
-                     (not compatible and transcode.is_resumable(path, offset)))
-
         #faking = (mime in ['video/x-tivo-mpeg-ts', 'video/x-tivo-mpeg'] and
         faking = (mime == 'video/x-tivo-mpeg' and
                   not (is_tivo_file and compatible))
@@ -232,8 +252,25 @@ class BaseVideo(Plugin):
         thead = ''
         if faking:
             thead = self.tivo_header(tsn, path, mime)
+
+        # A finished transcode from the cache can be sent as if it
+        # were the original, compatible file
+        source = fname
+        cached = None
+        if valid and not compatible:
+            cached = transcache.lookup(path, transcode.transcode(True, path,
+                                                                 '', tsn,
+                                                                 mime))
+            if cached:
+                source = cached
+                compatible = True
+
+        if valid and offset:
+            valid = ((compatible and offset < os.path.getsize(source)) or
+                     (not compatible and
+                      transcode.is_resumable(path, offset, tsn, mime, thead)))
         if compatible:
-            size = os.path.getsize(fname) + len(thead)
+            size = os.path.getsize(source) + len(thead)
             handler.send_response(200)
             handler.send_header('Content-Length', size - offset)
             handler.send_header('Content-Range', 'bytes %d-%d/%d' % 
@@ -247,55 +284,66 @@ class BaseVideo(Plugin):
         logger.info('[%s] Start sending "%s" to %s' %
                     (time.strftime('%d/%b/%Y %H:%M:%S'), fname, tivo_name))
         start = time.time()
+
+        def finished(count):
+            mega_elapsed = (time.time() - start) * 1024 * 1024
+            if mega_elapsed < 1:
+                mega_elapsed = 1
+            rate = count * 8.0 / mega_elapsed
+            logger.info('[%s] Done sending "%s" to %s, %d bytes, %.2f Mb/s' %
+                        (time.strftime('%d/%b/%Y %H:%M:%S'), fname, 
+                         tivo_name, count, rate))
+
+            if fname.endswith('.pyTivo-temp'):
+                os.remove(fname)
+
+        # The rest of the response, for handler.stream() -- or if it's
+        # been sent here already, the count
+        stream = None
         count = 0
 
         if valid:
             if compatible:
                 if faking and not offset:
                     handler.wfile.write(thead)
-                logger.debug('"%s" is tivo compatible' % fname)
-                f = open(fname, 'rb')
-                try:
-                    if mime == 'video/mp4':
+                if cached:
+                    logger.debug('"%s" is cached as "%s"' % (fname, cached))
+                else:
+                    logger.debug('"%s" is tivo compatible' % fname)
+                f = open(source, 'rb')
+                if mime == 'video/mp4' and not cached:
+                    try:
                         count = qtfaststart.process(f, handler.wfile, offset)
-                    else:
-                        if offset:
-                            offset -= len(thead)
-                            f.seek(offset)
-                        while True:
-                            block = f.read(512 * 1024)
-                            if not block:
-                                break
-                            handler.wfile.write(block)
-                            count += len(block)
-                except Exception, msg:
-                    logger.info(msg)
-                f.close()
+                    except Exception, msg:
+                        logger.info(msg)
+                    f.close()
+                else:
+                    if offset:
+                        offset -= len(thead)
+                    stream = streamloop.FileSource(f, offset)
             else:
                 logger.debug('"%s" is not tivo compatible' % fname)
                 if offset:
-                    count = transcode.resume_transfer(path, handler.wfile, 
-                                                      offset)
+                    session = transcode.get_session(path, offset, tsn, mime,
+                                                    thead)
                 else:
-                    count = transcode.transcode(False, path, handler.wfile,
-                                                tsn, mime, thead)
+                    session = transcode.start_session(path, tsn, mime, thead)
+                if session:
+                    stream = transcode.SessionSource(session, offset)
+
+        if stream:
+            handler.stream(stream, finished)
+            return
+
         try:
             if not compatible:
                  handler.wfile.write('0\r\n\r\n')
             handler.wfile.flush()
         except Exception, msg:
             logger.info(msg)
-
-        mega_elapsed = (time.time() - start) * 1024 * 1024
-        if mega_elapsed < 1:
-            mega_elapsed = 1
-        rate = count * 8.0 / mega_elapsed
-        logger.info('[%s] Done sending "%s" to %s, %d bytes, %.2f Mb/s' %
-                    (time.strftime('%d/%b/%Y %H:%M:%S'), fname, 
-                     tivo_name, count, rate))
-
-        if fname.endswith('.pyTivo-temp'):
-            os.remove(fname)
+        metrics.add('pytivo_bytes_sent_total', count,
+                    type=handler.container['type'])
+        finished(count)
 
     def __duration(self, full_path):
         return transcode.video_info(full_path)['millisecs']
@@ -314,7 +362,7 @@ class BaseVideo(Plugin):
                 elif use_extensions:
                     if os.path.splitext(f2)[1].lower() in EXTENSIONS:
                         count += 1
-                elif f2 in transcode.info_cache:
+                elif transcode.info_cached(f2):
                     if transcode.supported_format(f2):
                         count += 1
         except:
@@ -427,9 +475,21 @@ class BaseVideo(Plugin):
             allow_recurse = ar in ('1', 'yes', 'true', 'on')
         use_html = query.get('Format', [''])[0].lower() == 'text/html'
 
+        # The details shown depend on which files have been probed
+        recurse = allow_recurse and query.get('Recurse', ['No'])[0] == 'Yes'
+        response = respcache.lookup(self.response_key(handler, query,
+            recurse, transcode.info_changes))
+        if response:
+            handler.send_saved(response)
+            return
+
+        stages = profiler.Stages('listing')
         files, total, start = self.get_files(handler, query,
                                              self.video_file_filter,
                                              force_alpha, allow_recurse)
+        key = self.response_key(handler, query, recurse,
+                                transcode.info_changes)
+        stages.next('metadata')
 
         videos = []
         local_base_path = self.get_local_base_path(handler, query)
@@ -455,7 +515,7 @@ class BaseVideo(Plugin):
                 video['small_path'] = subcname + '/' + video['name']
                 video['total_items'] = self.__total_items(f.name)
             else:
-                if len(files) == 1 or f.name in transcode.info_cache:
+                if len(files) == 1 or transcode.info_cached(f.name):
                     video['valid'] = transcode.supported_format(f.name)
                     if video['valid']:
                         video.update(self.metadata_full(f.name, tsn,
@@ -475,10 +535,11 @@ class BaseVideo(Plugin):
 
             videos.append(video)
 
+        stages.next('render')
         if use_html:
-            t = Template(HTML_CONTAINER_TEMPLATE, filter=EncodeUnicode)
+            t = HTML_CONTAINER_TEMPLATE(filter=EncodeUnicode)
         else:
-            t = Template(XML_CONTAINER_TEMPLATE, filter=EncodeUnicode)
+            t = XML_CONTAINER_TEMPLATE(filter=EncodeUnicode)
         t.container = handler.cname
         t.name = subcname
         t.total = total
@@ -490,9 +551,13 @@ class BaseVideo(Plugin):
         t.guid = config.getGUID()
         t.tivos = config.tivos
         if use_html:
-            handler.send_html(str(t))
+            mime = 'text/html; charset=utf-8'
         else:
-            handler.send_xml(str(t))
+            mime = 'text/xml'
+        response = respcache.save(key, str(t), mime)
+        stages.next('reply')
+        handler.send_saved(response)
+        stages.end()
 
     def use_ts(self, tsn, file_path):
         if config.is_ts_capable(tsn):
@@ -512,27 +577,63 @@ class BaseVideo(Plugin):
 
         return False
 
+    def cached_details(self, key, file_path, build):
+        """ The result of build(), saved in tvbus_cache under key, and
+            kept until file_path or its sidecars change, or the settings
+            are reloaded.
+        """
+        size = config.getMetadataCacheSize()
+        try:
+            fname = unicode(file_path, 'utf-8')
+            stamp = (os.path.getmtime(fname), sidecar.stamp(fname),
+                     config.generation)
+        except OSError:
+            size = 0
+        if not size:
+            return build()
+        if self.tvbus_cache.size != size:
+            self.tvbus_cache.size = size
+        try:
+            saved_stamp, value = self.tvbus_cache[key]
+            if saved_stamp == stamp:
+                return value
+        except KeyError:
+            pass
+        value = build()
+        self.tvbus_cache[key] = (stamp, value)
+        return value
+
     def get_details_xml(self, tsn, file_path):
-        if (tsn, file_path) in self.tvbus_cache:
-            details = self.tvbus_cache[(tsn, file_path)]
-        else:
-            file_info = VideoDetails()
-            file_info['valid'] = transcode.supported_format(file_path)
-            if file_info['valid']:
-                file_info.update(self.metadata_full(file_path, tsn))
-
-            t = Template(TVBUS_TEMPLATE, filter=EncodeUnicode)
-            t.video = file_info
-            t.escape = escape
-            t.get_tv = metadata.get_tv
-            t.get_mpaa = metadata.get_mpaa
-            t.get_stars = metadata.get_stars
-            t.get_color = metadata.get_color
-            details = str(t)
-            self.tvbus_cache[(tsn, file_path)] = details
+        return self.cached_details(('details', config.get_tsn_class(tsn),
+                                    file_path), file_path,
+                                   lambda: self.render_details(tsn,
+                                                               file_path))
+
+    def render_details(self, tsn, file_path):
+        stages = profiler.Stages('metadata')
+        file_info = VideoDetails()
+        file_info['valid'] = transcode.supported_format(file_path)
+        if file_info['valid']:
+            file_info.update(self.metadata_full(file_path, tsn))
+        stages.next('render')
+
+        t = TVBUS_TEMPLATE(filter=EncodeUnicode)
+        t.video = file_info
+        t.escape = escape
+        t.get_tv = metadata.get_tv
+        t.get_mpaa = metadata.get_mpaa
+        t.get_stars = metadata.get_stars
+        t.get_color = metadata.get_color
+        details = str(t)
+        stages.end()
         return details
 
     def tivo_header(self, tsn, path, mime):
+        return self.cached_details(('header', config.get_tsn_class(tsn),
+                                    path, mime), path,
+                                   lambda: self.build_header(tsn, path, mime))
+
+    def build_header(self, tsn, path, mime):
         def pad(length, align):
             extra = length % align
             if extra:
@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+
+""" Transcode videos ahead of time
+
+    Finds the files in a video share (or any folder) that a TiVo can't
+    play as they are, and transcodes them in advance, a few at a time,
+    so they can later be sent without waiting on FFmpeg. The output
+    goes into the transcode cache, so transcode_cache must be set.
+    FFmpeg runs at reduced priority, only within pretranscode_window
+    (if set), and no new transcode starts while pyTivo is streaming.
+
+    Run from the Settings page, or from the command line:
+
+        pretranscode.py [-c pyTivo.conf] [-t tsn] [-w workers] [-n nice]
+                        [-W HH:MM-HH:MM] share-or-folder ...
+
+"""
+
+import getopt
+import logging
+import multiprocessing
+import os
+import Queue
+import sys
+import threading
+import time
+
+import config
+import walker
+from plugin import GetPlugin
+from plugins.video import transcache, transcode
+
+logger = logging.getLogger('pyTivo.pretranscode')
+
+BLOCKSIZE = 512 * 1024
+WAIT = 60    # seconds between checks while outside the window or streaming
+
+def parse_window(text):
+    """ Parse "HH:MM-HH:MM" into a (start, end) pair of minutes past
+        midnight, or return None (meaning any time) if it's not valid.
+    """
+    try:
+        start, end = [t.split(':') for t in text.split('-')]
+        return (int(start[0]) * 60 + int(start[1]),
+                int(end[0]) * 60 + int(end[1]))
+    except (AttributeError, IndexError, ValueError):
+        return None
+
+def in_window(window):
+    if not window:
+        return True
+    now = time.localtime()
+    now = now.tm_hour * 60 + now.tm_min
+    start, end = window
+    if start <= end:
+        return start <= now < end
+    return now >= start or now < end    # past midnight
+
+def share_path(name):
+    """ The folder for a share name, or the name itself if it's not one
+        of the configured video shares.
+    """
+    for section, settings in config.getShares():
+        if section == name and settings.get('type') in ('video', 'webvideo'):
+            return os.path.normpath(settings['path'])
+    return name
+
+class PreTranscoder(object):
+    def __init__(self, paths, tsn='', workers=0, nice=10, window=None,
+                 server=None):
+        self.paths = paths
+        self.tsn = tsn
+        self.workers = workers or multiprocessing.cpu_count()
+        self.nice = nice
+        self.window = window
+        self.server = server
+        self.queue = Queue.Queue()
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+        self.threads = []
+        self.found = 0
+        self.done = 0
+        self.failed = 0
+        self.running = 0
+        self.selecting = True
+
+    def start(self):
+        self.threads = [threading.Thread(target=self.select)]
+        for i in xrange(self.workers):
+            self.threads.append(threading.Thread(target=self.work))
+        for t in self.threads:
+            t.setDaemon(True)
+            t.start()
+        logger.info('Pre-transcoding %s with %d worker(s)' %
+                    (', '.join(self.paths), self.workers))
+
+    def join(self):
+        # Wait in short steps, so that ^C still works
+        for t in self.threads:
+            while t.isAlive():
+                t.join(1)
+
+    def stop(self):
+        self.stopped.set()
+
+    def is_finished(self):
+        return not [t for t in self.threads if t.isAlive()]
+
+    def list_files(self, path):
+        video = GetPlugin('video')
+        entries = walker.scan(path, True, video.video_file_filter, False)
+        for f in sorted(e.name for e in entries):
+            if self.stopped.isSet():
+                return
+            yield f, video.use_ts(self.tsn, f)
+
+    def select(self):
+        """ Queue up the files that need transcoding, and aren't done
+            already.
+        """
+        for path in self.paths:
+            for f, use_ts in self.list_files(path):
+                if use_ts:
+                    mime = 'video/x-tivo-mpeg-ts'
+                else:
+                    mime = 'video/x-tivo-mpeg'
+                try:
+                    if transcode.tivo_compatible(f, self.tsn, mime)[0]:
+                        continue
+                    settings = transcode.transcode(True, f, '', self.tsn,
+                                                   mime)
+                except Exception, msg:
+                    logger.info('%s: %s' % (f, msg))
+                    continue
+                name = transcache.entry_name(f, settings)
+                if name and not os.path.exists(name):
+                    self.found += 1
+                    self.queue.put((f, settings, name))
+        self.selecting = False
+        for i in xrange(self.workers):
+            self.queue.put(None)
+
+    def ready(self):
+        return (in_window(self.window) and
+                not (self.server and self.server.streams))
+
+    def wait_until_ready(self):
+        while not self.stopped.isSet() and not self.ready():
+            self.stopped.wait(WAIT)
+        return not self.stopped.isSet()
+
+    def work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            result = None
+            while result is None and self.wait_until_ready():
+                self.lock.acquire()
+                self.running += 1
+                self.lock.release()
+                try:
+                    result = self.transcode(*item)
+                except Exception, msg:
+                    logger.error('%s: %s' % (item[0], msg))
+                    result = False
+                self.lock.acquire()
+                self.running -= 1
+                self.lock.release()
+            if result is None:
+                break    # stopped
+            self.lock.acquire()
+            if result:
+                self.done += 1
+            else:
+                self.failed += 1
+            self.lock.release()
+
+    def transcode(self, path, settings, name):
+        """ Transcode path to name. Returns True if it's done, False if
+            it failed, or None if it was interrupted.
+        """
+        logger.info('Transcoding %s' % path)
+        writer = transcache.Writer(name)
+        process = transcode.start_process(path, settings, self.tsn,
+                                          self.nice)
+        while True:
+            if self.stopped.isSet() or not in_window(self.window):
+                transcode.kill(process)
+                writer.abort()
+                return None
+            block = process.stdout.read(BLOCKSIZE)
+            if not block:
+                break
+            writer.write(block)
+        if process.wait():
+            logger.info('Transcoding %s failed' % path)
+            writer.abort()
+            return False
+        writer.commit()
+        return True
+
+    def status_text(self):
+        text = 'Pre-transcoded %d of %d files' % (self.done, self.found)
+        if self.failed:
+            text += ', %d failed' % self.failed
+        if self.is_finished():
+            text += ', finished'
+        else:
+            if self.selecting:
+                text += ', still searching'
+            if self.running:
+                text += ', %d running' % self.running
+            elif not self.ready():
+                text += ', waiting'
+        return text
+
+def usage():
+    print __doc__
+    sys.exit(2)
+
+def main(argv):
+    try:
+        opts, args = getopt.getopt(argv, 'c:e:t:w:n:W:',
+                                   ['config=', 'extraconf=', 'tsn=',
+                                    'workers=', 'nice=', 'window='])
+    except getopt.GetoptError, msg:
+        print msg
+        usage()
+    if not args:
+        usage()
+
+    config_args = []
+    tsn = None
+    workers = None
+    nice = None
+    window = None
+    for opt, value in opts:
+        if opt in ('-c', '--config', '-e', '--extraconf'):
+            config_args += [opt, value]
+        elif opt in ('-t', '--tsn'):
+            tsn = value
+        elif opt in ('-w', '--workers'):
+            workers = int(value)
+        elif opt in ('-n', '--nice'):
+            nice = int(value)
+        elif opt in ('-W', '--window'):
+            window = value
+
+    config.init(config_args)
+    config.init_logging()
+
+    if not transcache.cache_dir():
+        logger.error('Pre-transcoding needs transcode_cache to be set')
+        sys.exit(1)
+
+    if tsn is None:
+        tsn = config.getPreTranscodeTsn()
+    if workers is None:
+        workers = config.getPreTranscodeWorkers()
+    if nice is None:
+        nice = config.getPreTranscodeNice()
+    if window is None:
+        window = config.getPreTranscodeWindow()
+
+    p = PreTranscoder([share_path(a) for a in args], tsn, workers, nice,
+                      parse_window(window))
+    p.start()
+    try:
+        p.join()
+    except KeyboardInterrupt:
+        p.stop()
+        p.join()
+    logger.info(p.status_text())
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
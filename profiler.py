@@ -0,0 +1,168 @@
+""" Timing and profiling of requests
+
+    The main stages of a request -- listing a folder, reading metadata,
+    probing, rendering the template, sending the reply -- are always
+    timed, with a Stages object: two clock readings per stage, added to
+    the pytivo_stage_seconds histogram on /metrics (or, for a stage with
+    a histogram of its own, like probes, to that one).
+
+    For a closer look, a request can be run under cProfile: every
+    request when profile is on, or just those with Profile=1 in the
+    query, from the clients in profile_clients. Each one leaves a
+    .pstats file in profile_dir, along with a .txt file describing the
+    request, its stages, and the functions that took the most time.
+    Only the newest KEEP of them are kept.
+
+"""
+
+import cProfile
+import itertools
+import logging
+import os
+import pstats
+import re
+import threading
+import time
+from cStringIO import StringIO
+
+import config
+import metrics
+
+logger = logging.getLogger('pyTivo.profiler')
+
+TOP = 40    # functions listed in each report
+KEEP = 100  # reports kept in profile_dir; older ones are removed
+REPORT = re.compile(r'\d{8}-\d{6}-\d{4}-[\w.-]*\.(pstats|txt)$')
+
+metrics.histogram('pytivo_stage_seconds', 'Time spent in each stage of '
+                  'a request.')
+
+local = threading.local()
+serials = itertools.count(1)
+
+class Stages(object):
+    """ Times the stages of a task, one after another:
+
+        stages = Stages('listing')
+        ...
+        stages.next('render')
+        ...
+        stages.end()
+
+        With metric, the times go to that histogram, unlabelled,
+        instead of pytivo_stage_seconds.
+    """
+    def __init__(self, name, metric=None):
+        self.name = name
+        self.metric = metric
+        self.start = time.time()
+
+    def next(self, name):
+        """ End the current stage, and start the next. """
+        now = time.time()
+        self.record(now)
+        self.name = name
+        self.start = now
+
+    def end(self):
+        self.record(time.time())
+        self.name = None
+
+    def record(self, now):
+        if self.name is None:
+            return
+        elapsed = now - self.start
+        if self.metric:
+            metrics.observe(self.metric, elapsed)
+        else:
+            metrics.observe('pytivo_stage_seconds', elapsed, stage=self.name)
+        spans = getattr(local, 'spans', None)
+        if spans is not None:
+            spans.append((self.name, elapsed))
+
+def wanted(handler):
+    """ True if this request should be profiled. """
+    if not config.getProfileDir():
+        return False
+    if config.getProfile():
+        return True
+    if not re.search(r'[?&]Profile=(1|Yes|True)\b', handler.path, re.I):
+        return False
+    client_ip = handler.client_address[0]
+    for allowedip in config.getProfileClients():
+        if client_ip.startswith(allowedip):
+            return True
+    return False
+
+def run(handler, func, *args):
+    """ Call func(*args), under cProfile if handler's request is to
+        be profiled.
+    """
+    if not wanted(handler):
+        func(*args)
+        return
+
+    local.spans = []
+    profile = cProfile.Profile()
+    start = time.time()
+    try:
+        profile.runcall(func, *args)
+    finally:
+        elapsed = time.time() - start
+        spans = local.spans
+        local.spans = None
+        try:
+            save(handler, profile, elapsed, spans)
+        except Exception, msg:
+            logger.error('Unable to save profile: %s' % msg)
+
+def save(handler, profile, elapsed, spans):
+    directory = config.getProfileDir()
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    path = handler.path.split('?', 1)
+    label = re.search(r'Command=(\w+)', handler.path)
+    if label:
+        label = label.group(1)
+    else:
+        label = os.path.basename(path[0]) or 'root'
+    label = re.sub(r'[^\w.-]+', '_', label)[:40]
+    base = os.path.join(directory, '%s-%04d-%s' %
+                        (time.strftime('%Y%m%d-%H%M%S'), serials.next() % 10000,
+                         label))
+    profile.dump_stats(base + '.pstats')
+
+    report = StringIO()
+    report.write('Request: %s %s\n' % (handler.command, handler.path))
+    report.write('Client: %s\n' % handler.client_address[0])
+    tsn = handler.headers.getheader('TiVo_TCD_ID',
+                                    handler.headers.getheader('tsn', ''))
+    if tsn:
+        report.write('TiVo: %s\n' % tsn)
+    report.write('Thread: %s\n' % threading.currentThread().getName())
+    report.write('Elapsed: %.3f s\n\n' % elapsed)
+    if spans:
+        report.write('Stages:\n')
+        for name, seconds in spans:
+            report.write('  %-12s %.3f s\n' % (name, seconds))
+        report.write('\n')
+    stats = pstats.Stats(profile, stream=report)
+    stats.sort_stats('cumulative').print_stats(TOP)
+
+    f = open(base + '.txt', 'w')
+    f.write(report.getvalue())
+    f.close()
+    logger.info('Profile of %s saved as %s' % (handler.path, base))
+    prune(directory)
+
+def prune(directory):
+    """ Remove all but the newest KEEP reports from directory. """
+    bases = sorted(set(os.path.splitext(name)[0]
+                       for name in os.listdir(directory)
+                       if REPORT.match(name)))
+    for base in bases[:-KEEP]:
+        for ext in ('.pstats', '.txt'):
+            try:
+                os.remove(os.path.join(directory, base + ext))
+            except OSError:
+                pass
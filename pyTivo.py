@@ -19,6 +19,8 @@ except:
 import beacon
 import config
 import httpserver
+import indexer
+import watcher
 
 def exceptionLogger(*args):
     sys.excepthook = sys.__excepthook__
@@ -65,6 +67,22 @@ def setup(in_service=False):
     httpd.set_beacon(b)
     httpd.set_service_status(in_service)
 
+    threads = config.getHTTPThreads()
+    if threads:
+        httpd.start_pools(threads, config.getStreamThreads(),
+                          config.getHTTPQueue())
+        if config.getStreamLoop():
+            httpd.start_stream_loop()
+
+    if config.getWatchShares():
+        watcher.start(config.getWatchInterval())
+
+    workers = config.getIndexWorkers()
+    if workers:
+        idx = indexer.Indexer(httpd, workers, config.getIndexNice())
+        idx.start()
+        httpd.set_indexer(idx)
+
     logger.info('pyTivo is ready.')
     return httpd
 
@@ -77,7 +95,13 @@ def serve(httpd):
 def mainloop():
     httpd = setup()
     serve(httpd)
+    httpd.stop_pools()
     httpd.beacon.stop()
+    if httpd.indexer:
+        httpd.indexer.stop()
+    if httpd.pretranscoder:
+        httpd.pretranscoder.stop()
+    watcher.stop()
     return httpd.restart 
 
 if __name__ == '__main__':
@@ -7,6 +7,7 @@ import win32service
 import win32serviceutil 
 
 import pyTivo
+import watcher
 
 class PyTivoService(win32serviceutil.ServiceFramework):
     _svc_name_ = 'pyTivo'
@@ -28,7 +29,13 @@ class PyTivoService(win32serviceutil.ServiceFramework):
             if rc == win32event.WAIT_OBJECT_0 or httpd.stop:
                 break
 
+        httpd.stop_pools()
         httpd.beacon.stop()
+        if httpd.indexer:
+            httpd.indexer.stop()
+        if httpd.pretranscoder:
+            httpd.pretranscoder.stop()
+        watcher.stop()
         return httpd.restart
 
     def SvcDoRun(self): 
@@ -0,0 +1,72 @@
+""" Saved QueryContainer responses
+
+    TiVos ask for the same folder page over and over -- on returning to
+    a folder, after each playback, and so on. The plugins save each
+    rendered page here, along with its gzipped form, keyed on the share,
+    the full query, the TiVo, and the listing it was made from. The key
+    changes when the listing does, so a saved page is never older than
+    the listing cache would be. Pages go out with an ETag, and a TiVo
+    (or browser) that already has the page gets a 304.
+
+"""
+
+import gzip
+import hashlib
+import time
+from cStringIO import StringIO
+
+import config
+from lrucache import LRUCache
+
+TTL = 60    # seconds a page is trusted, watched share or not
+
+cache = LRUCache(200, 'response_cache')
+
+def squeeze(page):
+    """ Return page gzipped. """
+    out = StringIO()
+    gzip.GzipFile(mode='wb', fileobj=out).write(page)
+    page = out.getvalue()
+    out.close()
+    return page
+
+class Response(object):
+    __slots__ = ('page', 'squeezed', 'mime', 'etag', 'mdate')
+
+    def __init__(self, page, mime):
+        self.page = page
+        self.mime = mime
+        if len(page) > 256 and mime.startswith('text'):
+            self.squeezed = squeeze(page)
+        else:
+            self.squeezed = None
+        self.etag = '"%s"' % hashlib.sha1(page).hexdigest()
+        self.mdate = time.time()
+
+def lookup(key):
+    """ The saved Response for key, or None. """
+    if key is None or not config.getResponseCacheSize():
+        return None
+    try:
+        return cache[key]
+    except KeyError:
+        return None
+
+def save(key, page, mime):
+    """ Save page under key (unless key is None, or caching is off), and
+        return it as a Response.
+    """
+    response = Response(page, mime)
+    size = config.getResponseCacheSize()
+    if key is not None and size:
+        if cache.size != size:
+            cache.size = size
+        cache[key] = response
+    return response
+
+def clear():
+    for key in cache:
+        try:
+            del cache[key]
+        except KeyError:
+            pass
@@ -0,0 +1,131 @@
+""" Run short-lived helper processes (e.g. "ffmpeg -i") to completion
+
+    The caller blocks until the process has exited or the timeout has
+    passed, whichever comes first -- no polling. Output is collected
+    from the pipes as it arrives, instead of via temporary files.
+
+"""
+
+import errno
+import logging
+import os
+import select
+import subprocess
+import sys
+import threading
+import time
+
+logger = logging.getLogger('pyTivo.runner')
+
+mswindows = (sys.platform == 'win32')
+
+BLOCKSIZE = 64 * 1024
+
+def lower_priority(nice):
+    """ Return a Popen preexec_fn that renices the child by nice, or
+        None if there's nothing to do (or no way to do it).
+    """
+    if nice <= 0 or mswindows:
+        return None
+    return lambda: os.nice(nice)
+
+def run(cmd, timeout=None, nice=0):
+    """ Run cmd and return its (stdout, stderr) output. If it's still
+        running after timeout seconds, it's killed, and the result is
+        None. A positive nice value runs it at reduced priority.
+    """
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            preexec_fn=lower_priority(nice))
+    proc.stdin.close()
+
+    if mswindows:
+        output = _collect_threaded(proc, timeout)
+    else:
+        output = _collect(proc, timeout)
+        proc.stdout.close()
+        proc.stderr.close()
+
+    if output is None:
+        logger.debug('pid %d timed out: %s' % (proc.pid, cmd[0]))
+        _terminate(proc)
+        return None
+    proc.wait()
+    return output
+
+def _collect(proc, timeout):
+    """ Read stdout and stderr until both are closed, sleeping in
+        poll() (or select()) between reads.
+    """
+    if timeout:
+        deadline = time.time() + timeout
+    chunks = {proc.stdout.fileno(): [], proc.stderr.fileno(): []}
+    open_fds = chunks.keys()
+
+    if hasattr(select, 'poll'):
+        poller = select.poll()
+        for fd in open_fds:
+            poller.register(fd, select.POLLIN | select.POLLPRI)
+
+    while open_fds:
+        if timeout:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return None
+        else:
+            remaining = None
+        try:
+            if hasattr(select, 'poll'):
+                if remaining is not None:
+                    remaining = int(remaining * 1000) + 1
+                ready = [fd for fd, event in poller.poll(remaining)]
+            else:
+                ready = select.select(open_fds, [], [], remaining)[0]
+        except select.error, e:
+            if e.args[0] == errno.EINTR:
+                continue
+            raise
+        for fd in ready:
+            data = os.read(fd, BLOCKSIZE)
+            if data:
+                chunks[fd].append(data)
+            else:
+                open_fds.remove(fd)
+                if hasattr(select, 'poll'):
+                    poller.unregister(fd)
+
+    return (''.join(chunks[proc.stdout.fileno()]),
+            ''.join(chunks[proc.stderr.fileno()]))
+
+def _collect_threaded(proc, timeout):
+    """ Windows can't select() on pipes, so read them from a waiter
+        thread instead.
+    """
+    output = []
+    done = threading.Event()
+
+    def waiter():
+        output.append(proc.communicate())
+        done.set()
+
+    t = threading.Thread(target=waiter)
+    t.setDaemon(True)
+    t.start()
+    done.wait(timeout)
+    if not output:
+        return None
+    return output[0]
+
+def _terminate(proc):
+    try:
+        if mswindows:
+            import ctypes
+            handle = ctypes.windll.kernel32.OpenProcess(1, False, proc.pid)
+            ctypes.windll.kernel32.TerminateProcess(handle, -1)
+            ctypes.windll.kernel32.CloseHandle(handle)
+        else:
+            import signal
+            os.kill(proc.pid, signal.SIGKILL)
+    except OSError:
+        pass
+    proc.wait()
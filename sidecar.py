@@ -0,0 +1,238 @@
+""" Sidecar metadata files, indexed by folder
+
+    The metadata for a video can come from text files beside it: the
+    default.txt in its folder and in every folder above it, then its
+    own .properties and .txt files, and those in .meta. Rather than
+    look for each of them whenever a video is listed, this keeps, for
+    each folder, the names of the sidecar files in it (from a single
+    listdir), the parsed contents of each one, and the default.txt
+    files of the folder and its parents, already merged. It also knows
+    the .nfo files, so stamp() can tell when any of a video's sidecars
+    has changed.
+
+    Each folder's record is checked against the folder's mtime, which
+    changes when files come or go, and each parsed file against its own
+    mtime -- but only once every CHECK_INTERVAL seconds, so listing a
+    folder of hundreds of episodes costs a few stat() calls, not
+    thousands.
+
+"""
+
+import os
+import sys
+import time
+import unicodedata
+
+from lrucache import LRUCache
+
+BOM = '\xef\xbb\xbf'
+
+CHECK_INTERVAL = 5   # seconds a record is trusted without a stat()
+
+folders = LRUCache(1000, 'sidecar_folders')
+files = LRUCache(2000, 'sidecar_files')
+chains = LRUCache(1000, 'sidecar_chains')
+
+def _fold(name):
+    """ The form names are compared in -- without case on the file
+        systems that ignore it.
+    """
+    if sys.platform == 'darwin':
+        return unicodedata.normalize('NFC', name).lower()
+    if sys.platform == 'win32':
+        return name.lower()
+    return name
+
+def _wanted(name):
+    return (name == '.meta' or name.endswith('.txt') or
+            name.endswith('.properties') or name.endswith('.nfo'))
+
+class Record(object):
+    """ What was found at a path, as of its mtime, last checked at
+        checked. For a folder, value is the set of its sidecar names;
+        for a file, its parsed contents.
+    """
+    __slots__ = ('mtime', 'value', 'checked')
+
+    def __init__(self, mtime, value, checked):
+        self.mtime = mtime
+        self.value = value
+        self.checked = checked
+
+def _get(cache, path, load):
+    """ The Record cached for path, reloaded by load(path) if the path's
+        mtime has changed since. A missing path has the value None.
+    """
+    now = time.time()
+    try:
+        record = cache[path]
+    except KeyError:
+        record = None
+    if record and now - record.checked < CHECK_INTERVAL:
+        return record
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        mtime = None
+    if record and record.mtime == mtime:
+        record.checked = now
+        return record
+    if mtime is None:
+        value = None
+    else:
+        try:
+            value = load(path)
+        except (IOError, OSError):
+            value = None
+    record = Record(mtime, value, now)
+    cache[path] = record
+    return record
+
+def _list(path):
+    return frozenset(_fold(name) for name in os.listdir(path)
+                     if _wanted(name.lower()))
+
+def _skip(path):
+    return None
+
+def _parse(path):
+    """ The key/value pairs in a sidecar file, merged as from_text()
+        would merge them.
+    """
+    metadata = {}
+    sep = ':='[path.endswith('.properties')]
+    for line in file(path, 'U'):
+        if line.startswith(BOM):
+            line = line[3:]
+        if line.strip().startswith('#') or not sep in line:
+            continue
+        key, value = [x.strip() for x in line.split(sep, 1)]
+        if not key or not value:
+            continue
+        if key.startswith('v'):
+            if key in metadata:
+                metadata[key].append(value)
+            else:
+                metadata[key] = [value]
+        else:
+            metadata[key] = value
+    return metadata
+
+def merge(metadata, more):
+    """ Add more to metadata: the lists of the v keys are extended, and
+        other keys replaced. The lists in more are not shared.
+    """
+    for key, value in more.items():
+        if key.startswith('v'):
+            if key in metadata:
+                metadata[key].extend(value)
+            else:
+                metadata[key] = list(value)
+        else:
+            metadata[key] = value
+
+def has(folder, name):
+    """ True if the folder has a sidecar file (or .meta) called name. """
+    names = _get(folders, folder, _list).value
+    return bool(names) and _fold(name) in names
+
+def _read(folder, name):
+    if not has(folder, name):
+        return None
+    return _get(files, os.path.join(folder, name), _parse)
+
+def read(folder, name):
+    """ The parsed contents of the sidecar file name in folder, or None
+        if there isn't one.
+    """
+    record = _read(folder, name)
+    return record and record.value
+
+def mtime(folder, name):
+    """ The mtime of the sidecar file name in folder, or None if there
+        isn't one.
+    """
+    if not has(folder, name):
+        return None
+    if name.endswith('.nfo'):
+        load = _skip
+    else:
+        load = _parse
+    return _get(files, os.path.join(folder, name), load).mtime
+
+def inherited(folder):
+    """ The default.txt files of folder and every folder above it,
+        merged, from the top down. Don't modify the result.
+    """
+    found = []
+    path = folder
+    while True:
+        if has(path, 'default.txt'):
+            found.append(path)
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+
+    parts = [(p, _read(p, 'default.txt')) for p in reversed(found)]
+    stamp = tuple((p, record and record.mtime) for p, record in parts)
+    try:
+        saved_stamp, metadata = chains[folder]
+        if saved_stamp == stamp:
+            return metadata
+    except KeyError:
+        pass
+    metadata = {}
+    for p, record in parts:
+        if record and record.value:
+            merge(metadata, record.value)
+    chains[folder] = (stamp, metadata)
+    return metadata
+
+def lookup(full_path):
+    """ The metadata from all the sidecar files for full_path, a unicode
+        file name, merged in order: its .properties file, the inherited
+        default.txt files, its .txt file, then .meta/default.txt and
+        its .txt file in .meta. The result is the caller's to keep.
+    """
+    path, name = os.path.split(full_path)
+    title, ext = os.path.splitext(name)
+    meta = os.path.join(path, '.meta')
+
+    metadata = {}
+    parts = [read(path, title + '.properties'), inherited(path),
+             read(path, name + '.txt')]
+    if has(path, '.meta'):
+        parts += [read(meta, 'default.txt'), read(meta, name + '.txt')]
+    for part in parts:
+        if part:
+            merge(metadata, part)
+    return metadata
+
+def stamp(full_path):
+    """ The mtimes of all the sidecar files that could add to the
+        metadata of full_path, a unicode file name -- those lookup()
+        reads, its .nfo file, and the nearest tvshow.nfo above it -- as
+        a tuple that changes when any of them is added, removed or
+        modified.
+    """
+    path, name = os.path.split(full_path)
+    title, ext = os.path.splitext(name)
+    meta = os.path.join(path, '.meta')
+
+    found = [(path, title + '.properties'), (path, name + '.txt'),
+             (path, title + '.nfo')]
+    if has(path, '.meta'):
+        found += [(meta, 'default.txt'), (meta, name + '.txt')]
+    show = not has(path, title + '.nfo')
+    folder = path
+    while True:
+        found.append((folder, 'default.txt'))
+        if not show and has(folder, 'tvshow.nfo'):
+            found.append((folder, 'tvshow.nfo'))
+            show = True
+        parent = os.path.dirname(folder)
+        if parent == folder:
+            break
+        folder = parent
+    return tuple(mtime(folder, name) for folder, name in found)
@@ -0,0 +1,393 @@
+""" Event loop for sending streams
+
+    With stream_loop on (and the thread pools from httppool), the body
+    of a file transfer isn't sent by the thread that handled the
+    request: the plugin hands the handler a Source, and once the
+    request is done, one loop thread sends it -- along with every other
+    stream -- through non-blocking sockets, using epoll (or poll, or
+    select) to find the ones ready for more. Each Source is only asked
+    for more data when its socket has room, so a slow client holds
+    nothing but its own socket buffer, and the thread is free for the
+    next request.
+
+    Sources that can't work this way (or any, without the loop) are
+    sent by the handler's thread, with Source.copy(), as before.
+
+"""
+
+import errno
+import logging
+import os
+import select
+import socket
+import threading
+from collections import deque
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+import zerocopy
+from httppool import socket_pair
+
+logger = logging.getLogger('pyTivo.streamloop')
+
+BLOCKSIZE = 512 * 1024
+READ = 1
+WRITE = 4
+
+# What Source.send() returns, besides True when it's finished
+WAIT_WRITE = 'write'    # call again when the socket has room
+WAIT_SOURCE = 'source'  # the source will call transfer.resume() later
+
+class Poller(object):
+    """ epoll, poll or select, whichever is best here, behind the
+        interface of select.poll().
+    """
+    def __init__(self):
+        if hasattr(select, 'epoll'):
+            self.poller = select.epoll()
+            self.masks = {READ: select.EPOLLIN, WRITE: select.EPOLLOUT}
+            self.kind = 'epoll'
+        elif hasattr(select, 'poll'):
+            self.poller = select.poll()
+            self.masks = {READ: select.POLLIN, WRITE: select.POLLOUT}
+            self.kind = 'poll'
+        else:
+            self.poller = None
+            self.kind = 'select'
+        self.fds = {}
+
+    def register(self, fd, events):
+        if self.poller:
+            if fd in self.fds:
+                self.poller.modify(fd, self.masks[events])
+            else:
+                self.poller.register(fd, self.masks[events])
+        self.fds[fd] = events
+
+    def unregister(self, fd):
+        if self.fds.pop(fd, None) is not None and self.poller:
+            self.poller.unregister(fd)
+
+    def poll(self, timeout):
+        """ Return the fds that are ready, waiting up to timeout seconds
+            (or forever, if it's None).
+        """
+        if self.kind == 'epoll':
+            return [fd for fd, event in self.poller.poll(timeout or -1)]
+        if self.kind == 'poll':
+            if timeout is not None:
+                timeout *= 1000
+            return [fd for fd, event in self.poller.poll(timeout)]
+        r = [fd for fd, events in self.fds.items() if events == READ]
+        w = [fd for fd, events in self.fds.items() if events == WRITE]
+        r, w, x = select.select(r, w, r + w, timeout)
+        return r + w + x
+
+class Source(object):
+    """ The body of a response, or the rest of it. Subclasses provide
+        next_block(); send() pushes the blocks out to the socket.
+    """
+    pollable = True     # can be sent from the loop
+    count = 0           # bytes of content sent (not counting framing)
+
+    def __init__(self):
+        self.pending = ''
+
+    def next_block(self, transfer):
+        """ Return the next piece of data to send, '' at the end, or None
+            if there's none yet -- in which case transfer.resume() will be
+            called when there is.
+        """
+        raise NotImplementedError
+
+    def send(self, sock, transfer):
+        while True:
+            if self.pending:
+                try:
+                    sent = sock.send(self.pending)
+                except socket.error, e:
+                    if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK,
+                                     errno.EINTR):
+                        return WAIT_WRITE
+                    raise
+                self.pending = self.pending[sent:]
+                if self.pending:
+                    return WAIT_WRITE
+            block = self.next_block(transfer)
+            if block is None:
+                return WAIT_SOURCE
+            if not block:
+                return True
+            self.pending = block
+
+    def copy(self, handler):
+        """ Send it all to handler.wfile, from the calling thread;
+            return the number of bytes of content sent.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+class FileSource(Source):
+    """ An open file, from offset to the end -- with sendfile() where
+        possible.
+    """
+    def __init__(self, handle, offset=0):
+        Source.__init__(self)
+        self.handle = handle
+        self.offset = offset
+        self.zerocopy = bool(zerocopy.sendfile)
+        self.size = os.fstat(handle.fileno()).st_size
+        self.handle.seek(offset)
+
+    def send(self, sock, transfer):
+        while self.zerocopy and self.offset < self.size:
+            try:
+                sent = zerocopy.sendfile(sock.fileno(), self.handle.fileno(),
+                    self.offset, min(self.size - self.offset,
+                                     zerocopy.CHUNK))
+            except (OSError, IOError), e:
+                if e.errno in (errno.EAGAIN, errno.EINTR):
+                    return WAIT_WRITE
+                if self.count or e.errno not in (errno.EINVAL, errno.ENOSYS,
+                                                 errno.EOPNOTSUPP):
+                    raise socket.error(e.errno, e.strerror)
+                self.zerocopy = False
+                break
+            if not sent:
+                return True
+            self.offset += sent
+            self.count += sent
+        if self.zerocopy:
+            return True
+        return Source.send(self, sock, transfer)
+
+    def next_block(self, transfer):
+        block = self.handle.read(BLOCKSIZE)
+        self.count += len(block)
+        return block
+
+    def copy(self, handler):
+        self.count = handler.send_file_data(self.handle, self.offset)
+        return self.count
+
+    def close(self):
+        self.handle.close()
+
+class PipeSource(Source):
+    """ A helper process's output, in chunked encoding. The process is
+        killed if the transfer ends early.
+    """
+    pollable = fcntl is not None    # polling pipes is POSIX-only
+
+    def __init__(self, process):
+        Source.__init__(self)
+        self.process = process
+        self.fd = process.stdout.fileno()
+        self.nonblocking = False
+        self.done = False
+
+    def next_block(self, transfer):
+        if self.done:
+            return ''
+        try:
+            block = os.read(self.fd, BLOCKSIZE)
+        except OSError, e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                transfer.watch(self.fd, READ, transfer.resume)
+                return None
+            raise socket.error(e.errno, e.strerror)
+        if not block:
+            self.done = True
+            return '0\r\n\r\n'
+        self.count += len(block)
+        return '%x\r\n%s\r\n' % (len(block), block)
+
+    def send(self, sock, transfer):
+        if not self.nonblocking:
+            flags = fcntl.fcntl(self.fd, fcntl.F_GETFL)
+            fcntl.fcntl(self.fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+            self.nonblocking = True
+        transfer.unwatch(self.fd)
+        return Source.send(self, sock, transfer)
+
+    def copy(self, handler):
+        while True:
+            block = self.process.stdout.read(BLOCKSIZE)
+            handler.wfile.write('%x\r\n' % len(block))
+            handler.wfile.write(block)
+            handler.wfile.write('\r\n')
+            self.count += len(block)
+            if not block:
+                break
+        return self.count
+
+    def close(self):
+        if self.process.poll() is None:
+            try:
+                self.process.kill()
+            except OSError:
+                pass
+        self.process.stdout.close()
+        self.process.wait()
+
+class Transfer(object):
+    """ One Source being sent to one socket. """
+    def __init__(self, loop, sock, source, done):
+        self.loop = loop
+        self.sock = sock
+        self.fd = sock.fileno()
+        self.source = source
+        self.done = done
+        self.fds = set()
+        self.finished = False
+
+    def watch(self, fd, events, callback):
+        self.fds.add(fd)
+        self.loop.watch(fd, events, callback)
+
+    def unwatch(self, fd):
+        self.fds.discard(fd)
+        self.loop.unwatch(fd)
+
+    def start(self):
+        self.sock.setblocking(0)
+        self.run()
+
+    def resume(self):
+        """ The source has more; may be called from any thread. """
+        self.loop.call(self.run)
+
+    def run(self):
+        if self.finished:
+            return
+        try:
+            result = self.source.send(self.sock, self)
+        except Exception, msg:
+            logger.info(msg)
+            self.finish(False)
+            return
+        if result == WAIT_WRITE:
+            self.watch(self.fd, WRITE, self.run)
+        else:
+            self.unwatch(self.fd)
+            if result is True:
+                self.finish(True)
+
+    def finish(self, ok):
+        self.finished = True
+        for fd in list(self.fds):
+            self.unwatch(fd)
+        self.loop.transfers.discard(self)
+        try:
+            self.source.close()
+        except Exception, msg:
+            logger.info(msg)
+        try:
+            self.sock.setblocking(1)
+        except socket.error:
+            ok = False
+        try:
+            self.done(self.source.count, ok)
+        except Exception:
+            logger.exception('Error finishing a stream')
+
+class Loop(object):
+    def __init__(self):
+        self.poller = Poller()
+        self.callbacks = {}     # fd -> function to call when it's ready
+        self.calls = deque()
+        self.lock = threading.Lock()
+        self.transfers = set()
+        self.stopped = False
+        self.wake_r, self.wake_w = socket_pair()
+        self.wake_r.setblocking(0)
+        self.watch(self.wake_r.fileno(), READ, self.woken)
+
+    def start(self):
+        t = threading.Thread(target=self.run)
+        t.setDaemon(True)
+        t.start()
+        logger.info('Sending streams with %s' % self.poller.kind)
+
+    def stop(self):
+        self.stopped = True
+        self.wake()
+
+    def wake(self):
+        try:
+            self.wake_w.send('x')
+        except socket.error:
+            pass
+
+    def woken(self):
+        try:
+            self.wake_r.recv(4096)
+        except socket.error:
+            pass
+
+    def call(self, func, *args):
+        """ Run func(*args) in the loop's thread, soon. """
+        self.lock.acquire()
+        self.calls.append((func, args))
+        self.lock.release()
+        self.wake()
+
+    def send(self, sock, source, done):
+        """ Send source to sock, then call done(count, ok), from the
+            loop's thread.
+        """
+        def start():
+            transfer = Transfer(self, sock, source, done)
+            self.transfers.add(transfer)
+            transfer.start()
+        self.call(start)
+
+    # These two are only for the loop's own thread
+    def watch(self, fd, events, callback):
+        self.poller.register(fd, events)
+        self.callbacks[fd] = callback
+
+    def unwatch(self, fd):
+        if self.callbacks.pop(fd, None):
+            self.poller.unregister(fd)
+
+    def run(self):
+        while not self.stopped:
+            try:
+                ready = self.poller.poll(None)
+            except (select.error, IOError), e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            for fd in ready:
+                callback = self.callbacks.get(fd)
+                if callback:
+                    try:
+                        callback()
+                    except Exception:
+                        logger.exception('Error in stream loop')
+            while True:
+                self.lock.acquire()
+                try:
+                    if not self.calls:
+                        break
+                    func, args = self.calls.popleft()
+                finally:
+                    self.lock.release()
+                try:
+                    func(*args)
+                except Exception:
+                    logger.exception('Error in stream loop')
+
+        for transfer in list(self.transfers):
+            transfer.finish(False)
+        self.wake_r.close()
+        self.wake_w.close()
+
+    def status_text(self):
+        return '%d streams in the loop' % len(self.transfers)
@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+
+""" Decrypt .TiVo files
+
+    A .TiVo file is a short header, some metadata chunks, and then an
+    MPEG program stream whose PES payloads are scrambled with Turing.
+    Each scrambled packet carries, in its PES private data, the number
+    of the block it belongs to; the keystream for a block is keyed from
+    the Media Access Key, the plaintext metadata chunk, the stream id
+    and the block number, and runs on across the packets of the block.
+    This decrypts the payloads and clears their scrambling bits, giving
+    a plain MPEG program stream. Transport stream .TiVo files are not
+    handled -- those still need tivodecode.
+
+    pyTivo uses tivodecode when it's installed, and this otherwise. It
+    takes the same arguments, reading from a file or stdin ("-") and
+    writing to stdout or the -o file:
+
+        tivodecoder.py -m mak [-o outfile] file-or-dash
+
+"""
+
+import getopt
+import hashlib
+import logging
+import os
+import struct
+import sys
+
+import config
+import turing
+
+logger = logging.getLogger('pyTivo.tivodecoder')
+
+BLOCKSIZE = 512 * 1024
+TS_FLAG = 0x20      # in the header flags, for a transport stream file
+
+# PES stream ids whose packets can be scrambled; from 0xbb up, the rest
+# (system header, stream map, padding, private 2, ...) are copied as is
+COMPLEX = [0xbd] + range(0xc0, 0xf0)
+
+# Sizes of the optional PES header fields that precede the extension,
+# by their flag bit in the second flags byte
+OPTIONAL = ((0x80, 5), (0x40, 5), (0x20, 6), (0x10, 3), (0x08, 1),
+            (0x04, 1), (0x02, 2))
+
+class FormatError(Exception):
+    pass
+
+def read_header(infile):
+    """ Read the header and metadata chunks, leaving infile at the
+        start of the MPEG data. Returns the header flags and a list of
+        (chunk id, chunk type, data).
+    """
+    header = infile.read(16)
+    if len(header) < 16 or header[:4] != 'TiVo':
+        raise FormatError('not a .TiVo file')
+    flags, = struct.unpack('>H', header[6:8])
+    offset, count = struct.unpack('>LH', header[10:])
+    rawdata = infile.read(offset - 16)
+    if len(rawdata) < offset - 16:
+        raise FormatError('truncated header')
+
+    chunks = []
+    pos = 0
+    for i in xrange(count):
+        chunk_size, data_size, id, enc = struct.unpack('>LLHH',
+            rawdata[pos:pos + 12])
+        chunks.append((id, enc, rawdata[pos + 12:pos + 12 + data_size]))
+        pos += chunk_size
+    return flags, chunks
+
+def stream_key(mak, chunks):
+    """ The base key for the video: from the MAK and the (last)
+        plaintext metadata chunk.
+    """
+    plain = [data for id, enc, data in chunks if enc == 0]
+    if not plain:
+        raise FormatError('no plaintext chunk')
+    return hashlib.sha1(mak + plain[-1]).digest()[:16]
+
+def do_header(p):
+    """ The block number and the scrambled length word from the 16
+        bytes of PES private data in a scrambled packet.
+    """
+    p = [ord(c) for c in p]
+    block_no = crypted = 0
+    if p[0] & 0x80:
+        block_no = (((p[1] & 0x03) << 18) | (p[2] << 10) |
+                    ((p[3] & 0xc0) << 2) | ((p[3] & 0x1f) << 3) |
+                    ((p[4] & 0xe0) >> 5))
+        crypted = (((p[7] & 0x03) << 30) | ((p[8] & 0x7f) << 23) |
+                   (p[9] << 15) | ((p[10] & 0x7f) << 8) | p[11])
+    return block_no, crypted
+
+class Decoder(object):
+    """ Decrypts the program stream of one .TiVo file, keeping a
+        keystream for each stream id, rekeyed when its block changes.
+    """
+    def __init__(self, key):
+        self.key = key
+        self.streams = {}    # stream id -> [block number, Turing]
+
+    def prepare(self, stream_id, block_no):
+        """ The cipher for a packet of the given stream and block """
+        state = self.streams.get(stream_id)
+        key = self.key + chr(stream_id)
+        iv = hashlib.sha1(key + struct.pack('>L', block_no)[1:]).digest()
+        if state is None:
+            state = [block_no, turing.Turing(hashlib.sha1(key).digest(),
+                                             iv)]
+            self.streams[stream_id] = state
+        elif state[0] != block_no:
+            state[0] = block_no
+            state[1].loadiv(iv)
+        return state[1]
+
+    def packet(self, pkt):
+        """ Return the PES packet pkt with its payload decrypted, if
+            it's scrambled.
+        """
+        if len(pkt) < 9:
+            return pkt
+        flags1, flags2, header_len = [ord(c) for c in pkt[6:9]]
+        if (flags1 & 0xc0) != 0x80 or (flags1 & 0x30) != 0x30:
+            return pkt
+        stream_id = ord(pkt[3])
+        start = 9 + header_len
+        cipher = None
+        if flags2 & 0x01:
+            ext = 9
+            for flag, size in OPTIONAL:
+                if flags2 & flag:
+                    ext += size
+            if ext + 17 <= start and ord(pkt[ext]) & 0x80:
+                block_no, crypted = do_header(pkt[ext + 1:ext + 17])
+                cipher = self.prepare(stream_id, block_no)
+                cipher.stream(struct.pack('>L', crypted))
+        if cipher is None:
+            state = self.streams.get(stream_id)
+            if state is None:
+                return pkt
+            cipher = state[1]
+        return ''.join((pkt[:6], chr(flags1 & ~0x30), pkt[7:start],
+                        cipher.stream(pkt[start:])))
+
+    def decode(self, infile, outfile):
+        """ Copy the program stream from infile to outfile, a block at
+            a time, decrypting the scrambled packets. Anything that
+            isn't in a PES packet (pack headers, ...) is copied as is.
+        """
+        buf = ''
+        while True:
+            data = infile.read(BLOCKSIZE)
+            if not data:
+                outfile.write(buf)
+                break
+            buf += data
+            out = []
+            pos = done = 0
+            while True:
+                i = buf.find('\0\0\1', pos)
+                if i < 0:
+                    # keep what could be the start of a start code
+                    i = max(done, len(buf) - 2)
+                    break
+                if i + 6 > len(buf):
+                    break
+                code = ord(buf[i + 3])
+                if code < 0xbb:
+                    pos = i + 3
+                    continue
+                end = i + 6 + struct.unpack('>H', buf[i + 4:i + 6])[0]
+                if end > len(buf):
+                    break
+                out.append(buf[done:i])
+                if code in COMPLEX:
+                    out.append(self.packet(buf[i:end]))
+                else:
+                    out.append(buf[i:end])
+                pos = done = end
+            out.append(buf[done:i])
+            outfile.write(''.join(out))
+            buf = buf[i:]
+
+def decode(mak, infile, outfile):
+    """ Decrypt the .TiVo file infile to outfile, with the given MAK """
+    flags, chunks = read_header(infile)
+    if flags & TS_FLAG:
+        raise FormatError('transport stream files need tivodecode')
+    Decoder(stream_key(mak, chunks)).decode(infile, outfile)
+
+def is_ts(path):
+    """ Whether the .TiVo file at path holds a transport stream """
+    try:
+        f = open(path, 'rb')
+        header = f.read(8)
+        f.close()
+    except IOError:
+        return False
+    return (len(header) == 8 and header[:4] == 'TiVo' and
+            bool(struct.unpack('>H', header[6:8])[0] & TS_FLAG))
+
+def can_decode(ts=False):
+    """ Whether .TiVo video (a transport stream, if ts) can be decrypted
+        here -- only tivodecode handles transport streams.
+    """
+    return not ts or bool(config.get_bin('tivodecode'))
+
+def command(mak):
+    """ The start of a command line to decrypt .TiVo files with mak --
+        tivodecode, if it's found, or else this module; the input file
+        (and -o outfile) follow.
+    """
+    tivodecode_path = config.get_bin('tivodecode')
+    if tivodecode_path:
+        return [tivodecode_path, '-m', mak]
+    script = os.path.abspath(__file__)
+    if script.endswith(('.pyc', '.pyo')):
+        script = script[:-1]
+    return [sys.executable, script, '-m', mak]
+
+def usage():
+    print __doc__
+    sys.exit(2)
+
+def main(argv):
+    try:
+        opts, args = getopt.getopt(argv, 'm:o:', ['mak=', 'out='])
+    except getopt.GetoptError, msg:
+        print msg
+        usage()
+    if len(args) != 1:
+        usage()
+
+    mak = None
+    outfile = sys.stdout
+    for opt, value in opts:
+        if opt in ('-m', '--mak'):
+            mak = value
+        elif opt in ('-o', '--out'):
+            outfile = open(value, 'wb')
+    if not mak:
+        usage()
+
+    if args[0] == '-':
+        infile = sys.stdin
+    else:
+        infile = open(args[0], 'rb')
+    if sys.platform == 'win32':
+        import msvcrt
+        for f in (infile, outfile):
+            msvcrt.setmode(f.fileno(), os.O_BINARY)
+
+    try:
+        decode(mak, infile, outfile)
+    except FormatError, msg:
+        sys.stderr.write('%s: %s\n' % (args[0], msg))
+        sys.exit(1)
+    except IOError:
+        pass    # the reader went away
+    outfile.close()
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,84 @@
+""" Process-wide registry of precompiled Cheetah templates
+
+    Each template file is compiled once into a Template subclass and
+    kept here; per-request rendering only instantiates that class.
+    Files are rechecked at most every CHECK_INTERVAL seconds, and
+    recompiled only when their mtime changes.
+
+"""
+
+import os
+import threading
+import time
+
+from Cheetah.Template import Template
+
+# Settings for the generated code. The bundled Cheetah has no compiled
+# NameMapper, so stack-frame lookups are disabled (the compiler would
+# also do this itself), and autocalling is turned off so that each
+# placeholder is a plain key/attribute lookup, with no callable() test.
+COMPILER_SETTINGS = {'useStackFrames': False,
+                     'useAutocalling': False}
+
+CHECK_INTERVAL = 5
+
+_registry = {}
+_lock = threading.Lock()
+
+class CachedTemplate(object):
+    """A template file and its compiled class."""
+
+    def __init__(self, path):
+        self.path = path
+        self.mtime = None
+        self.checked = 0
+        self.klass = None
+        self.lock = threading.Lock()
+        self.compile()
+
+    def compile(self):
+        mtime = os.path.getmtime(self.path)
+        source = file(self.path, 'rb').read()
+        name = os.path.splitext(os.path.basename(self.path))[0]
+        self.klass = Template.compile(source,
+                                      compilerSettings=COMPILER_SETTINGS,
+                                      moduleName='tmpl_' + name,
+                                      className='tmpl_' + name,
+                                      useCache=False,
+                                      cacheCompilationResults=False)
+        self.mtime = mtime
+        self.checked = time.time()
+
+    def get_class(self):
+        now = time.time()
+        if now - self.checked >= CHECK_INTERVAL:
+            self.lock.acquire()
+            try:
+                if now - self.checked >= CHECK_INTERVAL:
+                    self.checked = now
+                    try:
+                        if os.path.getmtime(self.path) != self.mtime:
+                            self.compile()
+                    except OSError:
+                        pass
+            finally:
+                self.lock.release()
+        return self.klass
+
+    def __call__(self, **kwargs):
+        """Return a new instance of the compiled template. Keyword
+           arguments are passed to the Template constructor (e.g.
+           filter=EncodeUnicode).
+        """
+        return self.get_class()(**kwargs)
+
+def load(path):
+    """Return the CachedTemplate for path, compiling it on first use."""
+    path = os.path.abspath(path)
+    _lock.acquire()
+    try:
+        if path not in _registry:
+            _registry[path] = CachedTemplate(path)
+        return _registry[path]
+    finally:
+        _lock.release()
@@ -60,18 +60,31 @@
 """ Turing Encryption for Python
 
     A Python implementation of Qualcomm's Turing pseudo-random number
-    generator. Loosely based on Greg Rose's TuringFast.c et al. This is
-    immensely slower than the C version, but useful for some limited
-    purposes. For Python 2.5 through 2.7.
+    generator. Loosely based on Greg Rose's TuringFast.c et al. For
+    Python 2.5 through 2.7.
+
+    The keystream is made in batches: the LFSR words for a run of
+    rounds are generated into one preallocated list -- each round
+    consumes five consecutive words of the same sequence -- and then
+    the rounds' outputs are computed from it, all at once with NumPy if
+    it's available, or in a single flat loop if not. Keyed S-boxes are
+    kept for each key, so rekeying with a key seen before is free, and
+    the XOR with the data is done on whole buffers (with NumPy, or
+    else as long integers), never byte by byte.
 
 """
 
 __author__ = 'William McBrine <wmcbrine@gmail.com>'
-__version__ = '1.5'
+__version__ = '1.6'
 
-from itertools import izip
+from binascii import hexlify, unhexlify
 from struct import pack, unpack
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 # 8->32 _SBOX generated by Millan et. al. at Queensland University of
 # Technology. See: E. Dawson, W. Millan, L. Burnett, G. Carter, "On the
 # Design of 8*32 S-boxes". Unpublished report, by the Information
@@ -209,10 +222,14 @@ _SBOX = [
 _MAXKEY = 32      # bytes
 _MAXKIV = 48      # bytes
 _LFSRLEN = 17     # words
+_BATCH = 4096     # rounds generated at a time
+_KEYCACHE = 16    # keyed S-boxes kept
+
+_M = 0xffffffff
 
 def _rotl(w, x):
     """ Rotate w left x bits """
-    return (w << x) | (w >> (32 - x))
+    return ((w << x) | (w >> (32 - x))) & _M
 
 def _fixed_strans(w):
     """ Reversible transformation of a word, based on the S-boxes """
@@ -229,7 +246,19 @@ def _fixed_strans(w):
 def _mixwords(w):
     """ Pseudo-Hadamard Transform """
     total = sum(w)
-    return [(i + total) & 0xffffffff for i in w[:-1] + [0]]
+    return [(i + total) & _M for i in w[:-1] + [0]]
+
+def _xor(a, b):
+    """ a XOR b, for strings of the same length """
+    if not a:
+        return ''
+    if numpy:
+        return (numpy.frombuffer(a, numpy.uint8) ^
+                numpy.frombuffer(b, numpy.uint8)).tostring()
+    return unhexlify('%0*x' % (2 * len(a),
+                     long(hexlify(a), 16) ^ long(hexlify(b), 16)))
+
+_keyed = {}   # key -> (mixed key, S-boxes, S-boxes as arrays)
 
 class KeyLengthError(Exception):
     pass
@@ -240,6 +269,7 @@ class IVLengthError(Exception):
 class Turing(object):
     def __init__(self, key=None, iv=None):
         self.sbox = [[], [], [], []]  # precalculated S-boxes
+        self.pending = ''             # keystream left over by stream()
 
         if key:
             self.setkey(key)
@@ -257,29 +287,40 @@ class Turing(object):
     def setkey(self, key):
         """ Key the cipher.
             Table version; gathers words, mixes them, saves them.
-            Then compiles lookup tables for the keyed S-boxes.
+            Then compiles lookup tables for the keyed S-boxes -- or
+            reuses those already made for the same key.
 
         """
         keylength = len(key)
         if keylength & 3 or keylength > _MAXKEY:
             raise KeyLengthError
+        if key in _keyed:
+            self.mkey, self.sbox, self.arrays = _keyed[key]
+            return
         fmt = '>%dL' % (keylength / 4)
         mkey = _mixwords([_fixed_strans(n) for n in unpack(fmt, key)])
 
         # build S-box lookup tables
-        for l, m in enumerate(self.sbox):
+        sbox = [[], [], [], []]
+        for l, m in enumerate(sbox):
             sh1 = 8 * l
             sh2 = 24 - sh1
             mask = (0xff << sh2) ^ 0xffffffff
             for j in xrange(256):
                 w = 0
                 k = j
-                for i, key in enumerate(mkey):
-                    k = _SBOX[((key >> sh2) & 0xff) ^ k]
+                for i, kw in enumerate(mkey):
+                    k = _SBOX[((kw >> sh2) & 0xff) ^ k]
                     w ^= _rotl(_QBOX[k], i + sh1)
                 m.append( (w & mask) | (k << sh2) )
 
-        self.mkey = mkey
+        arrays = None
+        if numpy:
+            arrays = [numpy.array(m, numpy.uint32) for m in sbox]
+        if len(_keyed) >= _KEYCACHE:
+            _keyed.clear()
+        _keyed[key] = (mkey, sbox, arrays)
+        self.mkey, self.sbox, self.arrays = mkey, sbox, arrays
 
     def loadiv(self, iv):
         """ Load the Initialization Vector.
@@ -306,41 +347,127 @@ class Turing(object):
             j += 1
         # finally mix all the words
         self.lfsr = _mixwords(lfsr)
+        self.pending = ''
+
+    def _words(self, n):
+        """ Step the LFSR n times, returning the whole run of words: the
+            old register, followed by the n new ones. The last
+            _LFSRLEN words are the new register.
+
+        """
+        w = self.lfsr + [0] * n
+        multab = _MULTAB
+        for j in xrange(n):
+            x = w[j]
+            w[j + 17] = (w[j + 15] ^ w[j + 4] ^ ((x & 0xffffff) << 8) ^
+                         multab[x >> 24])
+        self.lfsr = w[n:]
+        return w
 
     def _step(self, n=1):
         """ Step the LFSR """
-        lfsr = self.lfsr
-        while n:
-            oldw = lfsr.pop(0)
-            neww = (lfsr[14] ^ lfsr[3] ^
-                    ((oldw & 0xffffff) << 8) ^ _MULTAB[oldw >> 24])
-            lfsr.append(neww)
-            n -= 1
+        self._words(n)
+
+    def _rounds(self, n):
+        """ The output of n rounds, as a string of 20 * n bytes """
+        # Round r starts from the register at word t = 5 * r, steps it
+        # once, mixes and transforms the words at t + 17, 14, 7, 2 and
+        # 1, steps it three more times, adds the words at t + 18, 16,
+        # 12, 5 and 4, and steps it once more.
+        w = self._words(5 * n)
+        if self.arrays:
+            return self._rounds_numpy(w, n)
+        s0, s1, s2, s3 = self.sbox
+        out = [0] * (5 * n)
+        for t in xrange(0, 5 * n, 5):
+            a = w[t + 17]
+            b = w[t + 14]
+            c = w[t + 7]
+            d = w[t + 2]
+            e = (a + b + c + d + w[t + 1]) & _M
+            a = (a + e) & _M
+            b = (b + e) & _M
+            c = (c + e) & _M
+            d = (d + e) & _M
+            a = (s0[a >> 24] ^ s1[(a >> 16) & 0xff] ^
+                 s2[(a >> 8) & 0xff] ^ s3[a & 0xff])
+            b = (s0[(b >> 16) & 0xff] ^ s1[(b >> 8) & 0xff] ^
+                 s2[b & 0xff] ^ s3[b >> 24])
+            c = (s0[(c >> 8) & 0xff] ^ s1[c & 0xff] ^
+                 s2[c >> 24] ^ s3[(c >> 16) & 0xff])
+            d = (s0[d & 0xff] ^ s1[d >> 24] ^
+                 s2[(d >> 16) & 0xff] ^ s3[(d >> 8) & 0xff])
+            e = (s0[e >> 24] ^ s1[(e >> 16) & 0xff] ^
+                 s2[(e >> 8) & 0xff] ^ s3[e & 0xff])
+            e = a + b + c + d + e
+            out[t] = (a + e + w[t + 18]) & _M
+            out[t + 1] = (b + e + w[t + 16]) & _M
+            out[t + 2] = (c + e + w[t + 12]) & _M
+            out[t + 3] = (d + e + w[t + 5]) & _M
+            out[t + 4] = (e + w[t + 4]) & _M
+        return pack('>%dL' % len(out), *out)
+
+    def _rounds_numpy(self, w, n):
+        """ _rounds(), for all n rounds at once """
+        w = numpy.array(w, numpy.uint32)
+        s0, s1, s2, s3 = self.arrays
+        top = 5 * n
+        a = w[17:top + 17:5]
+        b = w[14:top + 14:5]
+        c = w[7:top + 7:5]
+        d = w[2:top + 2:5]
+        e = a + b + c + d + w[1:top + 1:5]
+        a = a + e
+        b = b + e
+        c = c + e
+        d = d + e
+        a = s0[a >> 24] ^ s1[(a >> 16) & 0xff] ^ s2[(a >> 8) & 0xff] ^ \
+            s3[a & 0xff]
+        b = s0[(b >> 16) & 0xff] ^ s1[(b >> 8) & 0xff] ^ s2[b & 0xff] ^ \
+            s3[b >> 24]
+        c = s0[(c >> 8) & 0xff] ^ s1[c & 0xff] ^ s2[c >> 24] ^ \
+            s3[(c >> 16) & 0xff]
+        d = s0[d & 0xff] ^ s1[d >> 24] ^ s2[(d >> 16) & 0xff] ^ \
+            s3[(d >> 8) & 0xff]
+        e = s0[e >> 24] ^ s1[(e >> 16) & 0xff] ^ s2[(e >> 8) & 0xff] ^ \
+            s3[e & 0xff]
+        e = a + b + c + d + e
+        out = numpy.empty((n, 5), numpy.uint32)
+        out[:, 0] = a + e + w[18:top + 18:5]
+        out[:, 1] = b + e + w[16:top + 16:5]
+        out[:, 2] = c + e + w[12:top + 12:5]
+        out[:, 3] = d + e + w[5:top + 5:5]
+        out[:, 4] = e + w[4:top + 4:5]
+        return out.astype('>u4').tostring()
 
     def _round(self):
         """ A single round """
-        self._step()
-        things = _mixwords([self.lfsr[n] for n in (16, 13, 6, 1, 0)])
-        things = _mixwords([self._strans(i, n)
-                            for i, n in izip(things, (0, 1, 2, 3, 0))])
-        self._step(3)
-        things = [(i + self.lfsr[n]) & 0xffffffff
-                  for i, n in izip(things, (14, 12, 8, 1, 0))]
-        self._step()
-        return pack('>5L', *things)
+        return self._rounds(1)
 
     def gen(self, skip, length):
         """ Generate length characters of output, skipping the first
             skip characters.
 
         """
-        while skip > 20:
-            self._step(5)
-            skip -= 20
-        buf = ''
-        while len(buf) < length + skip:
-            buf += self._round()
-        return buf[skip:length + skip]
+        if skip > 20:
+            rounds = (skip - 1) / 20
+            self._words(5 * rounds)
+            skip -= 20 * rounds
+        return self._gen(length + skip)[skip:]
+
+    def _gen(self, length):
+        """ The next length bytes of keystream, in whole rounds """
+        rounds = (length + 19) / 20
+        if not rounds:
+            return ''
+        if rounds <= _BATCH:
+            return self._rounds(rounds)[:length]
+        buf = []
+        while rounds:
+            batch = min(rounds, _BATCH)
+            buf.append(self._rounds(batch))
+            rounds -= batch
+        return ''.join(buf)[:length]
 
     def crypt(self, source, skip=0):
         """ Return a transformed (encrypted or decrypted) version of the
@@ -348,8 +475,17 @@ class Turing(object):
             data.
 
         """
-        xor_data = self.gen(skip, len(source))
-        fmt = '%dB' % len(source)
-        d2 = unpack(fmt, source)
-        x2 = unpack(fmt, xor_data)
-        return pack(fmt, *(a ^ b for a, b in izip(d2, x2)))
+        return _xor(source, self.gen(skip, len(source)))
+
+    def stream(self, source):
+        """ Transform source, continuing the keystream where the last
+            call to stream() left off, so a long stream can be handled
+            a piece at a time.
+
+        """
+        need = len(source) - len(self.pending)
+        if need > 0:
+            self.pending += self._gen(need + (-need % 20))
+        xor_data = self.pending[:len(source)]
+        self.pending = self.pending[len(source):]
+        return _xor(source, xor_data)
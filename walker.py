@@ -0,0 +1,108 @@
+""" Folder listings for the share plugins
+
+    Built on scandir() where it's available (os.scandir, or the scandir
+    package under Python 2), which gets each entry's type from the
+    directory read itself, so a listing costs at most one stat() per
+    file -- and none, when the caller doesn't need sizes or dates.
+    Without it, each entry is stat()ed once, instead of once to see if
+    it's a folder, and again for its details.
+
+"""
+
+import logging
+import os
+import stat
+import sys
+import unicodedata
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+logger = logging.getLogger('pyTivo.walker')
+
+class Entry(object):
+    """ A file or folder in a listing. The name is the full path, in
+        UTF-8; size, mdate and cdate are None when not asked for.
+    """
+    __slots__ = ('name', 'isdir', 'size', 'mdate', 'cdate')
+
+    def __init__(self, name, isdir, size=None, mdate=None, cdate=None):
+        self.name = name
+        self.isdir = isdir
+        self.size = size
+        self.mdate = mdate
+        self.cdate = cdate
+
+def _entry(name, isdir, st):
+    if st:
+        return Entry(name, isdir, st.st_size, st.st_mtime, st.st_ctime)
+    return Entry(name, isdir)
+
+def _entries(path, need_stat):
+    """ Generate (full path, isdir, stat result or None) for each entry
+        in path, a unicode folder name, skipping hidden ones, and any
+        whose names can't be decoded as UTF-8.
+    """
+    if scandir:
+        entries = scandir(path)
+        while True:
+            try:
+                entry = next(entries)
+            except StopIteration:
+                break
+            except UnicodeError, msg:
+                # The scandir package fails on the bad name, but can go on
+                logger.debug('Skipping an entry in %r: %s' % (path, msg))
+                continue
+            if entry.name.startswith('.'):
+                continue
+            try:
+                isdir = entry.is_dir()
+                st = need_stat and entry.stat() or None
+            except OSError:
+                continue    # e.g. a broken link
+            yield entry.path, isdir, st
+    else:
+        for name in os.listdir(path):
+            if name.startswith('.'):
+                continue
+            try:
+                f = os.path.join(path, name)
+            except UnicodeError:
+                logger.debug('Skipping %r in %r: not UTF-8' % (name, path))
+                continue
+            try:
+                st = os.stat(f)
+            except OSError:
+                continue
+            yield f, stat.S_ISDIR(st.st_mode), need_stat and st or None
+
+def scan(path, recurse=False, file_filter=None, need_stat=True):
+    """ Return a list of Entries for path, a UTF-8 folder name. With
+        recurse, the files in its subfolders are included instead of the
+        subfolders themselves. Files (but not folders) are included only
+        if file_filter(name) is true, if it's given. Unreadable folders
+        are skipped.
+    """
+    files = []
+    try:
+        entries = _entries(unicode(path, 'utf-8'), need_stat)
+        for f, isdir, st in entries:
+            if sys.platform == 'darwin':
+                f = unicodedata.normalize('NFC', f)
+            f = f.encode('utf-8')
+            if isdir:
+                if recurse:
+                    files.extend(scan(f, True, file_filter, need_stat))
+                else:
+                    files.append(_entry(f, True, st))
+            elif not file_filter or file_filter(f):
+                files.append(_entry(f, False, st))
+    except OSError:
+        pass
+    return files
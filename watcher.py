@@ -0,0 +1,324 @@
+""" Watch the shares for changes
+
+    With watch_shares on, the plugins' directory listing caches are kept
+    until something in the folder actually changes, instead of being
+    checked against the folder's mtime on every request (or, for
+    recursive listings, rebuilt every few minutes). Changes are found
+    with inotify on Linux, or elsewhere by checking the mtime of every
+    folder each watch_interval seconds.
+
+    The .meta folders are watched too, and a change in one counts as a
+    change in the folder it describes; a change to a default.txt, which
+    the folders below inherit, counts for all of them.
+
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import struct
+import sys
+import threading
+import unicodedata
+
+import config
+import walker
+
+logger = logging.getLogger('pyTivo.watcher')
+
+# inotify(7)
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+              IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF |
+              IN_ONLYDIR)
+EVENT = struct.Struct('iIII')
+
+active = None   # the running watcher
+caches = []     # (dir_cache, recurse_cache) pairs to invalidate
+changes = 0     # count of invalidations, so far
+lock = threading.Lock()
+
+def register(dir_cache, recurse_cache):
+    """ Have the watcher invalidate this pair of listing caches. """
+    caches.append((dir_cache, recurse_cache))
+
+def covers(path):
+    """ True if path is under a watched share, so its cached listings
+        are good until invalidated.
+    """
+    return active is not None and active.covers(path)
+
+def generation():
+    """ Changes so far; a listing built while this was changing may
+        already be out of date.
+    """
+    return changes
+
+def _normalize(path):
+    if sys.platform == 'darwin':
+        path = unicodedata.normalize('NFC', unicode(path, 'utf-8'))
+        path = path.encode('utf-8')
+    return path
+
+def _under(path, parent):
+    return path == parent or path.startswith(parent + os.path.sep)
+
+def _remove(cache, key):
+    try:
+        del cache[key]
+    except KeyError:
+        pass
+
+def invalidate(path, tree=False):
+    """ Drop the cached listings that include the folder path: its own,
+        and the recursive listings of it and its parents. With tree, the
+        listings of everything under it go too. For a .meta folder, it's
+        the listing of the folder it describes that goes.
+    """
+    global changes
+    path = _normalize(path)
+    if os.path.basename(path) == '.meta':
+        path = os.path.dirname(path)
+        tree = False
+    lock.acquire()
+    changes += 1
+    lock.release()
+    for dc, rc in caches:
+        if tree:
+            for p in dc:
+                if _under(p, path):
+                    _remove(dc, p)
+        else:
+            _remove(dc, path)
+        for p in rc:
+            if _under(path, p) or (tree and _under(p, path)):
+                _remove(rc, p)
+
+def invalidate_all():
+    global changes
+    lock.acquire()
+    changes += 1
+    lock.release()
+    for dc, rc in caches:
+        for cache in (dc, rc):
+            for p in cache:
+                _remove(cache, p)
+
+def _watched(name):
+    """ True for the names whose changes can show in a listing: all
+        but hidden ones -- except .meta, which holds metadata -- and
+        those that aren't UTF-8, which walker.scan() skips.
+    """
+    try:
+        name.decode('utf-8')
+    except UnicodeError:
+        return False
+    return not name.startswith('.') or name == '.meta'
+
+def _subdirs(path):
+    """ The folders in path that walker.scan() lists, and .meta """
+    dirs = [e.name for e in walker.scan(path, need_stat=False) if e.isdir]
+    meta = os.path.join(path, '.meta')
+    if os.path.isdir(meta):
+        dirs.append(meta)
+    return dirs
+
+def list_dirs(path):
+    """ The folders under path (including path), skipping the ones the
+        listings do, but not .meta.
+    """
+    dirs = [path]
+    for d in dirs:
+        dirs.extend(_subdirs(d))
+    return dirs
+
+class Watcher(object):
+    def __init__(self, roots):
+        self.roots = roots
+        self.stopped = threading.Event()
+
+    def covers(self, path):
+        for root in self.roots:
+            if _under(path, root):
+                return True
+        return False
+
+    def start(self):
+        t = threading.Thread(target=self.run)
+        t.setDaemon(True)
+        t.start()
+
+    def stop(self):
+        self.stopped.set()
+
+class InotifyWatcher(Watcher):
+    """ One inotify watch per folder, added as folders appear. """
+    def __init__(self, roots):
+        Watcher.__init__(self, [])
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.add_watch = libc.inotify_add_watch
+        self.add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                                   ctypes.c_uint32]
+        self.rm_watch = libc.inotify_rm_watch
+        self.fd = libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init failed')
+        self.paths = {}     # watch descriptor -> folder
+        for root in roots:
+            if self.watch_tree(root):
+                self.roots.append(root)
+            else:
+                logger.warning('Not watching %s -- try raising '
+                               'fs.inotify.max_user_watches' % root)
+
+    def watch_tree(self, path):
+        for d in list_dirs(path):
+            wd = self.add_watch(self.fd, d, WATCH_MASK)
+            if wd < 0:
+                err = ctypes.get_errno()
+                if err == errno.ENOSPC:
+                    return False
+                continue    # gone already, or unreadable
+            self.paths[wd] = d
+        return True
+
+    def unwatch_tree(self, path):
+        for wd, d in self.paths.items():
+            if _under(d, path):
+                self.rm_watch(self.fd, wd)
+                self.paths.pop(wd, None)
+
+    def run(self):
+        while not self.stopped.isSet():
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                logger.error('inotify: %s' % e)
+                break
+            pos = 0
+            while pos + EVENT.size <= len(data):
+                wd, mask, cookie, length = EVENT.unpack_from(data, pos)
+                name = data[pos + EVENT.size:pos + EVENT.size + length]
+                pos += EVENT.size + length
+                try:
+                    self.handle(wd, mask, name.rstrip('\0'))
+                except Exception, msg:
+                    logger.error('inotify: %s' % msg)
+        os.close(self.fd)
+
+    def stop(self):
+        Watcher.stop(self)
+        # Removing the watches wakes up run(), with IN_IGNORED events
+        for wd in self.paths.keys():
+            self.rm_watch(self.fd, wd)
+
+    def handle(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            logger.info('inotify queue overflow; clearing caches')
+            invalidate_all()
+            return
+        folder = self.paths.get(wd)
+        if folder is None:
+            return
+        if mask & IN_IGNORED:
+            del self.paths[wd]
+            return
+        if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+            invalidate(folder, True)
+            return
+        if not _watched(name):
+            return
+        invalidate(folder, name == 'default.txt')
+        if mask & IN_ISDIR:
+            path = os.path.join(folder, name)
+            if mask & (IN_MOVED_FROM | IN_DELETE):
+                self.unwatch_tree(path)
+                invalidate(path, True)
+            elif mask & (IN_MOVED_TO | IN_CREATE):
+                self.watch_tree(path)
+                invalidate(path, True)
+
+class PollingWatcher(Watcher):
+    """ Checks the mtime of every folder each interval seconds -- a
+        folder's mtime changes when files are added, removed or renamed
+        in it.
+    """
+    def __init__(self, roots, interval):
+        Watcher.__init__(self, roots)
+        self.interval = interval
+        self.mtimes = {}
+        for root in roots:
+            self.scan(root)
+
+    def scan(self, path):
+        for d in list_dirs(path):
+            try:
+                self.mtimes[d] = os.path.getmtime(d)
+            except OSError:
+                pass
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            for d, mtime in self.mtimes.items():
+                try:
+                    current = os.path.getmtime(d)
+                except OSError:
+                    for p in self.mtimes.keys():
+                        if _under(p, d):
+                            del self.mtimes[p]
+                    invalidate(d, True)
+                    continue
+                if current != mtime:
+                    self.mtimes[d] = current
+                    invalidate(d)
+                    self.scan_new(d)
+
+    def scan_new(self, path):
+        """ Start tracking any new folders in path. """
+        for d in _subdirs(path):
+            if d not in self.mtimes:
+                self.scan(d)
+
+def start(interval=60):
+    """ Watch the folders of all the configured shares. """
+    global active
+    roots = []
+    for section, settings in config.getShares():
+        path = settings.get('path')
+        if path and os.path.isdir(path):
+            roots.append(os.path.normpath(path))
+
+    watcher = None
+    if sys.platform.startswith('linux'):
+        try:
+            watcher = InotifyWatcher(roots)
+            logger.info('Watching shares with inotify')
+        except (OSError, AttributeError), msg:
+            logger.info('inotify unavailable: %s' % msg)
+    if not watcher:
+        watcher = PollingWatcher(roots, interval)
+        logger.info('Watching shares every %d seconds' % interval)
+    watcher.start()
+    active = watcher
+
+def stop():
+    global active
+    if active:
+        active.stop()
+        active = None
@@ -0,0 +1,106 @@
+""" Send files to sockets without copying them through Python
+
+    Uses sendfile(2) -- from the os module where it exists, else from
+    the optional pysendfile package, else straight from libc on Linux.
+    Where none of those is available (or the file can't be sent that
+    way), falls back to an ordinary read/write loop.
+
+"""
+
+import errno
+import logging
+import os
+import select
+import socket
+import sys
+
+logger = logging.getLogger('pyTivo.zerocopy')
+
+BLOCKSIZE = 512 * 1024
+CHUNK = 0x7ffff000   # the most Linux will send in one call
+
+def _libc_sendfile():
+    import ctypes
+    import ctypes.util
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    call = libc.sendfile64
+    call.argtypes = [ctypes.c_int, ctypes.c_int,
+                     ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+    call.restype = ctypes.c_ssize_t
+
+    def sendfile(out_fd, in_fd, offset, count):
+        pos = ctypes.c_int64(offset)
+        sent = call(out_fd, in_fd, ctypes.byref(pos), count)
+        if sent < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        return sent
+    return sendfile
+
+try:
+    from os import sendfile
+except ImportError:
+    try:
+        from sendfile import sendfile
+    except ImportError:
+        sendfile = None
+        if sys.platform.startswith('linux'):
+            try:
+                sendfile = _libc_sendfile()
+            except (ImportError, OSError, AttributeError):
+                pass
+
+def copy(infile, sock, offset=0, outfile=None):
+    """ Send infile, from offset to the end, to the connected socket
+        sock. Returns the number of bytes sent. If sendfile() can't be
+        used, the data is read into memory and written to outfile (if
+        given -- it should be the socket's buffered file object) or
+        sock. Errors writing to the socket are raised.
+    """
+    if sendfile:
+        try:
+            return _sendfile_loop(infile.fileno(), sock, offset)
+        except socket.error:
+            raise
+        except (OSError, IOError), e:
+            if e.errno not in (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP):
+                raise socket.error(e.errno, e.strerror)
+            logger.debug('sendfile unavailable: %s' % e.strerror)
+
+    count = 0
+    infile.seek(offset)
+    write = outfile and outfile.write or sock.sendall
+    while True:
+        block = infile.read(BLOCKSIZE)
+        if not block:
+            break
+        write(block)
+        count += len(block)
+    return count
+
+def _sendfile_loop(in_fd, sock, offset):
+    out_fd = sock.fileno()
+    size = os.fstat(in_fd).st_size
+    count = 0
+    while offset < size:
+        try:
+            sent = sendfile(out_fd, in_fd, offset,
+                            min(size - offset, CHUNK))
+        except (OSError, IOError), e:
+            if e.errno == errno.EINTR:
+                continue
+            if e.errno == errno.EAGAIN:
+                # Sockets with a timeout are non-blocking underneath
+                if not select.select([], [out_fd], [],
+                                     sock.gettimeout())[1]:
+                    raise socket.timeout('timed out')
+                continue
+            if count:
+                # Too late to fall back; report it as a write error
+                raise socket.error(e.errno, e.strerror)
+            raise
+        if not sent:
+            break
+        offset += sent
+        count += sent
+    return count